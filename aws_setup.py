@@ -20,20 +20,37 @@
 """
 
 import boto3, random, string, subprocess, botocore
-import os, sys
-import base64
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+import os, sys, time, threading, traceback
+import base64, gzip, hashlib, io, json, tarfile
+from concurrent.futures import ThreadPoolExecutor, wait
+import policy_compiler
 
 conf_source_files = ['config/clear', 'config/private', 'config/clear-or-private', 'config/private-or-clear', 'config/oe-cert.conf',
                      'functions/packages/enroll_cert_lambda_function/enroll_cert_lambda_function.zip', 
                      'functions/packages/generate_certifcate_lambda_function/generate_certifcate_lambda_function.zip',
                      'functions/packages/ipsec_setup_lambda_function/ipsec_setup_lambda_function.zip',
                      'functions/packages/ca_initialize_lambda_function/ca_initialize_lambda_function.zip',
+                     'functions/packages/ipsec_metrics_rollup_lambda_function/ipsec_metrics_rollup_lambda_function.zip',
                      'templates/ipsec-setup.yaml',
-                     'sources/cron.txt', 'sources/cronIPSecStats.sh', 'sources/setup_ipsec.sh',
-                     'README.md', 'aws_setup.py']
+                     'sources/cron.txt', 'sources/ipsec_stats_agent.py', 'sources/setup_ipsec.sh',
+                     'README.md', 'aws_setup.py', 'policy_compiler.py']
+
+# Files of the host bootstrap bundle: name in the bundle -> local file
+bundle_files = [('private', 'config/private'), ('private-or-clear', 'config/private-or-clear'),
+                ('clear-or-private', 'config/clear-or-private'), ('clear', 'config/clear'),
+                ('oe-cert.conf', 'config/oe-cert.conf'),
+                ('ipsec_stats_agent.py', 'sources/ipsec_stats_agent.py'), ('cron.txt', 'sources/cron.txt')]
 
 code_version = "0.4"
 
+# Uploads are incremental: the sha256 of each uploaded file is kept in the object metadata and in the
+# manifest ipsec/sync-manifest.json, a file is uploaded again only if its sha256 changed.
+# Files above the threshold are uploaded in parts
+sync_manifest = 'sync-manifest.json'
+multipart_threshold = 8 * 1024 * 1024
+
 # Create bucket if does not exists
 # if the bucket exists the region must match 
 def createBucket (s3, region, name):
@@ -61,23 +78,172 @@ def createBucket (s3, region, name):
         if e.response['Error']['Code'] == 'AllAccessDisabled':
            raise Exception('Error: The bucket ' + name + ' exist, but can not be accessed. Are you owner of the bucket? ')
 
+# Compiles the policy groups of config/ for a region and VPC (see policy_compiler.py), @vpc tokens are
+# expanded with the VPCs of the region. Returns {local file: compiled content} for sync_files and build_bundle
+def compile_policies(region, vpc_id='any', session=boto3):
+    groups = policy_compiler.load_groups('config')
+    vpcs = None
+    if policy_compiler.needs_vpcs(groups):
+        ec2 = session.client('ec2', region_name=region)
+        vpcs = [v for page in ec2.get_paginator('describe_vpcs').paginate() for v in page['Vpcs']]
+    compiled, report = policy_compiler.compile_groups(groups, vpcs, vpc_id)
+    print('\n'.join(report.lines()))
+    return dict(('config/' + name, text.encode('utf-8')) for name, text in compiled.items())
+
+# Builds the host bootstrap bundle, a tar.gz with the files, MANIFEST.json and SHA256SUMS
+# The content is deterministic, the version is derived from the files checksums
+# contents replaces the content of local files, e.g. the compiled policy groups
+def build_bundle(contents=None):
+    contents = contents or {}
+    files = []
+    for name, f in bundle_files:
+        if f in contents:
+            files.append((name, contents[f]))
+            continue
+        with open(f, 'rb') as fd:
+            files.append((name, fd.read()))
+
+    sums = ''.join(hashlib.sha256(data).hexdigest() + '  ' + name + '\n' for name, data in files)
+    version = hashlib.sha256(sums.encode('utf-8')).hexdigest()[:16]
+    manifest = json.dumps({'version': version, 'code_version': code_version,
+                           'files': dict((name, hashlib.sha256(data).hexdigest()) for name, data in files)},
+                          indent=2, sort_keys=True)
+    files += [('SHA256SUMS', sums.encode('utf-8')), ('MANIFEST.json', manifest.encode('utf-8'))]
+
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as gz:
+        with tarfile.open(fileobj=gz, mode='w') as tar:
+            for name, data in files:
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                info.mode = 0o755 if name.endswith('.sh') else 0o644
+                info.mtime = 0
+                tar.addfile(info, io.BytesIO(data))
+    return version, buf.getvalue()
+
+# Returns the JSON object in the bucket or None if the bucket or object does not exist
+def get_json(s3, bucket, key):
+    try:
+        return json.loads(s3.get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8'))
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('NoSuchKey', 'NoSuchBucket'):
+            return None
+        raise
+
+# Uploads the bootstrap bundle and the pointer bootstrap/current.json to the current version
+# Skipped if the current version is already uploaded
+def upload_bundle(s3, sources_bucket, prefix='ipsec/', dry_run=False, contents=None):
+    version, bundle = build_bundle(contents)
+    current = get_json(s3, sources_bucket, prefix + 'bootstrap/current.json')
+    if current is not None and current.get('version') == version:
+        print('Bootstrap bundle ' + version + ' unchanged')
+        return False
+    if dry_run:
+        print('Bootstrap bundle ' + version + ' would be uploaded')
+        return True
+    key = prefix + 'bootstrap/bundle-' + version + '.tar.gz'
+    s3.put_object(Bucket=sources_bucket, Key=key, Body=bundle)
+    current = {'version': version, 'key': key, 'sha256': hashlib.sha256(bundle).hexdigest()}
+    s3.put_object(Bucket=sources_bucket, Key=prefix + 'bootstrap/current.json', Body=json.dumps(current).encode('utf-8'))
+    print('Bootstrap bundle ' + version + ' uploaded in bucket ' + sources_bucket)
+    return True
+
+# sha256 of a local file, read in blocks
+def file_sha256(f):
+    h = hashlib.sha256()
+    with open(f, 'rb') as fd:
+        for block in iter(lambda: fd.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+# sha256 of the uploaded files: from the manifest, files missing in it from the object metadata
+def remote_sha256(s3, sources_bucket, keys, prefix, threads):
+    manifest = get_json(s3, sources_bucket, prefix + sync_manifest) or {}
+
+    def head(key):
+        try:
+            return s3.head_object(Bucket=sources_bucket, Key=key).get('Metadata', {}).get('sha256')
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NoSuchBucket'):
+                return None
+            raise
+
+    missing = [k for k in keys if k not in manifest]
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        for key, sha256 in zip(missing, pool.map(head, missing)):
+            if sha256:
+                manifest[key] = sha256
+    return manifest
+
+# Uploads the files whose content changed, in parallel. Returns [(change, file)], change is new, changed or unchanged
+# contents replaces the content of local files, e.g. the compiled policy groups
+def sync_files(s3, sources_bucket, files, prefix='ipsec/', threads=8, dry_run=False, contents=None):
+    contents = contents or {}
+    local = dict((prefix + f, hashlib.sha256(contents[f]).hexdigest() if f in contents else file_sha256(f)) for f in files)
+    remote = remote_sha256(s3, sources_bucket, sorted(local.keys()), prefix, threads)
+
+    changes = []
+    for f in files:
+        key = prefix + f
+        changes.append(('unchanged' if remote.get(key) == local[key] else 'changed' if key in remote else 'new', f))
+    for change, f in changes:
+        print('  ' + {'new': '+', 'changed': '~', 'unchanged': '='}[change] + ' ' + f)
+    upload = [f for change, f in changes if change != 'unchanged']
+    print(str(len(upload)) + ' of ' + str(len(files)) + ' files to upload in bucket ' + sources_bucket)
+    if dry_run or not upload:
+        return changes
+
+    config = TransferConfig(multipart_threshold=multipart_threshold, multipart_chunksize=multipart_threshold)
+
+    def put(f):
+        key = prefix + f
+        if f in contents:
+            s3.put_object(Bucket=sources_bucket, Key=key, Body=contents[f], Metadata={'sha256': local[key]})
+        else:
+            s3.upload_file(f, sources_bucket, key, ExtraArgs={'Metadata': {'sha256': local[key]}}, Config=config)
+        return key
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        futures = [(f, pool.submit(put, f)) for f in upload]
+        for f, future in futures:
+            try:
+                key = future.result()
+                remote[key] = local[key]
+                print('File ' + f + ' uploaded in bucket ' + sources_bucket)
+            except Exception as err:
+                print('Error: File ' + f + ' upload failed: ' + str(err))
+                failed.append(f)
+
+    # the manifest records what was uploaded, failed files are retried by the next run
+    s3.put_object(Bucket=sources_bucket, Key=prefix + sync_manifest, Body=json.dumps(remote, indent=2, sort_keys=True).encode('utf-8'))
+    if failed:
+        raise Exception('Error: Upload of ' + ', '.join(failed) + ' to bucket ' + sources_bucket + ' failed')
+    return changes
+
 # Uploads sources to S3
-def upload_files(region, hostcerts_bucket, sources_bucket):
-    #   Create source and config bucket and uplaods config and sources
-    s3 = boto3.client('s3', region_name=region)
+def upload_files(region, hostcerts_bucket, sources_bucket, threads=8, dry_run=False, session=boto3, vpc_id='any'):
+    #   Create source and config bucket and uplaods config and sources, the policy groups compiled
+    policies = compile_policies(region, vpc_id, session)
+    s3 = session.client('s3', region_name=region, config=Config(max_pool_connections=max(10, threads * 2)))
+    if dry_run:
+        print('Dry run, changes to upload in bucket ' + sources_bucket + ':')
+        sync_files(s3, sources_bucket, conf_source_files, threads=threads, dry_run=True, contents=policies)
+        upload_bundle(s3, sources_bucket, dry_run=True, contents=policies)
+        return
+
     createBucket(s3, region, sources_bucket)
 
-    for f in conf_source_files:
-        data = open(f, 'rb')
-        s3.put_object(Bucket=sources_bucket, Key='ipsec/' + f , Body=data)
-        print('File ' + f + ' uploaded in bucket ' + sources_bucket)
+    sync_files(s3, sources_bucket, conf_source_files, threads=threads, contents=policies)
+    upload_bundle(s3, sources_bucket, contents=policies)
 
     createBucket(s3,region, hostcerts_bucket)
 
 # Provisions stack
-def provision_stack(region, hostcerts_bucket, cacrypto_bucket, sources_bucket,vpcId):
-    cf = boto3.client('cloudformation', region_name=region)
-    cf.create_stack(StackName=stackname, TemplateURL='https://s3.amazonaws.com/' + sources_bucket + '/ipsec/templates/ipsec-setup.yaml',
+def provision_stack(region, hostcerts_bucket, cacrypto_bucket, sources_bucket,vpcId, stackname, session=boto3):
+    cf = session.client('cloudformation', region_name=region)
+    # regional endpoint, the sources bucket is in the region of the stack
+    cf.create_stack(StackName=stackname, TemplateURL='https://s3.' + region + '.amazonaws.com/' + sources_bucket + '/ipsec/templates/ipsec-setup.yaml',
                     Parameters=[
                         {'ParameterKey': 'QSS3BucketName', 'ParameterValue': sources_bucket},
                         {'ParameterKey': 'QSS3KeyPrefix', 'ParameterValue': 'ipsec/'},
@@ -95,10 +261,10 @@ def provision_stack(region, hostcerts_bucket, cacrypto_bucket, sources_bucket,vp
         raise Exception(
             'Error: Stack ' + stackname + ' in region ' + region + ' failed. Check AWS Console for more info')
 
-    # Get the Output values
-    outputs = cf.describe_stacks(StackName=stackname)['Stacks'][0]['Outputs']
-    caCmkKey = outputs[1]['OutputValue']
-    certEnrollLamnda = outputs[0]['OutputValue']
+    # Get the Output values by key, CloudFormation does not keep the order of the template
+    outputs = dict((o['OutputKey'], o['OutputValue']) for o in cf.describe_stacks(StackName=stackname)['Stacks'][0]['Outputs'])
+    caCmkKey = outputs['CaKmsKey']
+    certEnrollLamnda = outputs['CertEnrollLambda']
 
     print('Created CA CMK key ' + caCmkKey)
     print('Certificate generation lambda ' + certEnrollLamnda)
@@ -106,7 +272,12 @@ def provision_stack(region, hostcerts_bucket, cacrypto_bucket, sources_bucket,vp
     return caCmkKey, certEnrollLamnda
 
 # Generates a CA key and certificate
-def generate_ca(region, hostcerts_bucket, cacrypto_bucket, leavecakey, caCmkKey, certEnrollLamnda):
+# Returns the password of the CA key if the encrypted key is left in the local folder (file names start with prefix)
+def generate_ca(region, hostcerts_bucket, cacrypto_bucket, leavecakey, caCmkKey, certEnrollLamnda, session=boto3,
+                progress=None, prefix=''):
+    progress = progress or (lambda stage: None)
+    keyfile = prefix + 'ca.key.encrypted.pem'
+    certfile = prefix + 'cacert.pem'
 
 
     # Generate CA key pass with 128 Bytes
@@ -117,7 +288,7 @@ def generate_ca(region, hostcerts_bucket, cacrypto_bucket, leavecakey, caCmkKey,
     p = subprocess.Popen(
             # ECDSA for the future when libreswan supports it 
             # 'openssl ecparam -genkey -name secp384r1 | openssl ec -out ./ca.key.encrypted.pem  -passout pass:' + rnd_token + '  && openssl req -new -extensions v3_ca -sha256 -key ./ca.key.encrypted.pem -x509 -days 3650 -out ./cacert.pem -subj "/CN=ipsec.' + region + '" -passin pass:' + rnd_token,
-            'openssl genrsa -aes256 -out ./ca.key.encrypted.pem  -passout pass:' + rnd_token + ' 4096 && openssl req -new -extensions v3_ca -sha256 -key ./ca.key.encrypted.pem -x509 -days 3650 -out ./cacert.pem -subj "/CN=ipsec.' + region + '" -passin pass:' + rnd_token,
+            'openssl genrsa -aes256 -out ./' + keyfile + '  -passout pass:' + rnd_token + ' 4096 && openssl req -new -extensions v3_ca -sha256 -key ./' + keyfile + ' -x509 -days 3650 -out ./' + certfile + ' -subj "/CN=ipsec.' + region + '" -passin pass:' + rnd_token,
         shell=True, stdout=subprocess.PIPE)
     p.wait()
 
@@ -127,44 +298,158 @@ def generate_ca(region, hostcerts_bucket, cacrypto_bucket, leavecakey, caCmkKey,
         print('Certificate and key generated. Subject CN=ipsec.' + region + ' Valid 10 years')
 
     # Make cacrypto bucket
-    s3 = boto3.client('s3', region_name=region)
+    s3 = session.client('s3', region_name=region)
 
     createBucket(s3, region, cacrypto_bucket)
 
     # Upload the encrypted key and CA cert
-    f = open("ca.key.encrypted.pem",'rb')
-    s3.put_object(Bucket=cacrypto_bucket, Key='ca.key.encrypted.pem', Body=f)
+    with open(keyfile, 'rb') as f:
+        s3.put_object(Bucket=cacrypto_bucket, Key='ca.key.encrypted.pem', Body=f)
     print('Encrypted CA key uploaded in bucket ' + cacrypto_bucket)
-    f = open("cacert.pem", 'rb')
-    s3.put_object(Bucket=cacrypto_bucket, Key='ca.cert.pem', Body=f)
+    with open(certfile, 'rb') as f:
+        s3.put_object(Bucket=cacrypto_bucket, Key='ca.cert.pem', Body=f)
     print('CA cert uploaded in bucket ' + cacrypto_bucket)
 
     if leavecakey == 'yes':
-        print('The CA certificate(cacert.pem) and key(cakey.pem) are in the local folder')
-        print('Key encryption password follows on next line. Keep the password secret')
-        print(rnd_token)
+        print('The CA certificate(' + certfile + ') and key(' + keyfile + ') are in the local folder')
+        password = rnd_token
     else:
-        os.remove('cacert.pem')
-        os.remove('ca.key.encrypted.pem')
+        os.remove(certfile)
+        os.remove(keyfile)
         print('CA cert and key remove from local folder')
+        password = None
 
     # Encrypt the key with CA CMK
-    kms = boto3.client('kms', region_name=region)
+    progress('lambda-env')
+    kms = session.client('kms', region_name=region)
     ency_token = base64.b64encode(kms.encrypt(KeyId=caCmkKey, Plaintext=rnd_token)['CiphertextBlob']).decode(
         encoding="utf-8")
 
-    lmb = boto3.client('lambda', region_name=region)
+    lmb = session.client('lambda', region_name=region)
 
     env = lmb.get_function_configuration(FunctionName=certEnrollLamnda)['Environment']
     env['Variables']['CA_PWD'] = ency_token
-    boto3.client('lambda', region_name=region).update_function_configuration(FunctionName=certEnrollLamnda,
-                                                                             Environment=env)
+    lmb.update_function_configuration(FunctionName=certEnrollLamnda, Environment=env)
     print('Lambda function' + certEnrollLamnda + ' updated')
     
     # Restrict the CA key for encryption. Remove allow kms:encrypt action
+    progress('key-policy')
     policy_response = kms.get_key_policy( KeyId=caCmkKey, PolicyName='default')
     kms.put_key_policy( KeyId=caCmkKey, PolicyName='default', Policy=policy_response['Policy'].replace('"kms:Encrypt",','') )
     print('Resource policy for CA CMK hardened - removed action kms:encrypt') 
+    return password
+
+
+# A region (and VPC) to provision with its own buckets and stack
+# With more than one target the names get the suffix <region>[-<last 8 chars of vpc-id>]
+class Target(object):
+
+    def __init__(self, region, vpc_id, names, rnd, suffixed):
+        self.region = region
+        self.vpc_id = vpc_id
+        self.name = region + ('-' + vpc_id[-8:] if vpc_id != 'any' else '')
+        suffix = '-' + self.name if suffixed else ''
+        self.conf_sources_bucket, self.hostcerts_bucket, self.cacrypto_bucket, self.stackname = [
+            n.replace('[Random]', rnd) + suffix for n in names]
+        self.prefix = self.name + '-' if suffixed else ''
+        self.log = 'aws_setup-' + self.name + '.log' if suffixed else None
+        self.stage = 'waiting'
+        self.started = None
+        self.ended = None
+        self.error = None
+        self.password = None
+
+    def progress(self, stage):
+        self.stage = stage
+        self.started = self.started or time.time()
+
+    def elapsed(self):
+        if self.started is None:
+            return 0
+        return int((self.ended or time.time()) - self.started)
+
+
+# Provisions a target: buckets and upload, stack, CA and the certificate lambda
+def provision(target, args):
+    session = boto3.session.Session()
+    target.progress('upload')
+    upload_files(target.region, target.hostcerts_bucket, target.conf_sources_bucket, args.upload_threads, session=session,
+                 vpc_id=target.vpc_id)
+    target.progress('stack')
+    caCmkKey, certEnrollLamnda = provision_stack(target.region, target.hostcerts_bucket, target.cacrypto_bucket,
+                                                 target.conf_sources_bucket, target.vpc_id, target.stackname, session)
+    if args.ca_use_existing == 'no':
+        target.progress('ca')
+        target.password = generate_ca(target.region, target.hostcerts_bucket, target.cacrypto_bucket,
+                                      args.leave_cakey_in_folder, caCmkKey, certEnrollLamnda, session,
+                                      target.progress, target.prefix)
+
+
+# stdout of each provisioning thread goes to the log of its target, the main thread shows the progress
+class TargetLogs(object):
+
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.local = threading.local()
+
+    def open(self, path):
+        self.local.log = open(path, 'a')
+
+    def close(self):
+        self.local.log.close()
+        del self.local.log
+
+    def write(self, text):
+        getattr(self.local, 'log', self.stdout).write(text)
+
+    def flush(self):
+        getattr(self.local, 'log', self.stdout).flush()
+
+
+def progress_table(targets):
+    lines = ['%-28s %-20s %8s  %s' % ('Target', 'Stage', 'Elapsed', 'Stack')]
+    for t in targets:
+        lines.append('%-28s %-20s %7ds  %s' % (t.name, t.stage, t.elapsed(), t.stackname))
+    return lines
+
+
+# Provisions all targets in parallel, a failed target does not stop the others
+def provision_all(targets, args):
+    logs = TargetLogs(sys.stdout)
+
+    def run(target):
+        logs.open(target.log)
+        try:
+            provision(target, args)
+            target.stage = 'done'
+        except Exception as err:
+            target.error = str(err)
+            print('Provisioning of ' + target.name + ' failed in stage ' + target.stage)
+            traceback.print_exc(file=sys.stdout)
+            target.stage = 'failed (' + target.stage + ')'
+        finally:
+            target.ended = time.time()
+            logs.close()
+
+    sys.stdout = logs
+    try:
+        with ThreadPoolExecutor(max_workers=args.parallel) as pool:
+            futures = [pool.submit(run, t) for t in targets]
+            tty = logs.stdout.isatty()
+            drawn = 0
+            while True:
+                pending = wait(futures, timeout=2 if tty else 30)[1]
+                lines = progress_table(targets)
+                if tty and drawn:
+                    # redraw the table in place
+                    logs.stdout.write('\033[F' * drawn)
+                logs.stdout.write('\n'.join(lines) + '\n')
+                logs.stdout.flush()
+                drawn = len(lines)
+                if not pending:
+                    break
+    finally:
+        sys.stdout = logs.stdout
 
 
 #  Starts the main procedure
@@ -177,8 +462,9 @@ if __name__ == '__main__':
     p = argparse.ArgumentParser(description="Enrolls IPSec encryption in AWS account")
 
     p.add_argument("--region", "-r", default="us-east-1",
-                   metavar="<region>",
-                   help="Region to provision (default:empty)")
+                   metavar="<region>[:<vpc-id>],...",
+                   help="Regions to provision, comma separated. A region may be given more than once with different VPCs, "
+                        "e.g. us-east-1:vpc-1a2b3c4d,us-east-1:vpc-5e6f7a8b,eu-west-1 (default:us-east-1)")
 
     p.add_argument("--conf_sources_bucket", "-s", default="ipsec.configs.sources-[Random]",
                    metavar="<sources_bucket>",
@@ -207,6 +493,18 @@ if __name__ == '__main__':
     p.add_argument("--vpc_id", "-v", default="any",
                    metavar="[vpc-id|any]",
                    help="Operate in provided vpc-id or in any vpc in the region (default)")
+
+    p.add_argument("--dry_run", "-d", default="no",
+                   metavar="[yes|no]",
+                   help="Lists the files that would be uploaded to the conf and sources bucket and exits [no/yes]")
+
+    p.add_argument("--upload_threads", "-t", default=8, type=int,
+                   metavar="<threads>",
+                   help="Parallel uploads of changed files (default:8)")
+
+    p.add_argument("--parallel", "-j", default=12, type=int,
+                   metavar="<targets>",
+                   help="Regions/VPCs provisioned in parallel (default:12)")
     
     print('Provisioning IPsec-Mesh version ' + code_version)
     print('\nUse --help for more options\n')
@@ -217,35 +515,59 @@ if __name__ == '__main__':
     chars = string.ascii_lowercase
     rnd = ''.join(random.sample(chars * 8, 8))
 
-    #   Generate final bucket names if needed
-    conf_sources_bucket = args.conf_sources_bucket.replace('[Random]', rnd)
-    hostcerts_bucket = args.hostcerts_bucket.replace('[Random]', rnd)
-    cacrypto_bucket = args.cacrypto_bucket.replace('[Random]', rnd)
-    stackname = args.stackname.replace('[Random]', rnd)
+    #   Targets, region or region:vpc-id. Names get a suffix per target if there is more than one
+    specs = [r.strip().split(':', 1) + [args.vpc_id] for r in args.region.split(',') if r.strip()]
+    names = [args.conf_sources_bucket, args.hostcerts_bucket, args.cacrypto_bucket, args.stackname]
+    targets = [Target(spec[0], spec[1], names, rnd, len(specs) > 1) for spec in specs]
+    if len(set(t.name for t in targets)) != len(targets):
+        raise Exception('Error: A region and vpc-id is given more than once in --region')
 
     print('Arguments:')
     print('----------------------------')
-    print('Region:                       ' + args.region)
-    print('Vpc ID:                       ' + args.vpc_id)
-    print('Hostcerts bucket:             ' + hostcerts_bucket)
-    print('CA crypto bucket:             ' + cacrypto_bucket)
-    print('Conf and sources bucket:      ' + conf_sources_bucket)
+    for t in targets:
+        print('Region:                       ' + t.region)
+        print('Vpc ID:                       ' + t.vpc_id)
+        print('Hostcerts bucket:             ' + t.hostcerts_bucket)
+        print('CA crypto bucket:             ' + t.cacrypto_bucket)
+        print('Conf and sources bucket:      ' + t.conf_sources_bucket)
+        print('AWS stackname:                ' + t.stackname)
+        print('---------------------------- ')
     print('CA use existing:              ' + args.ca_use_existing)
     print('Leave CA key in local folder: ' + args.leave_cakey_in_folder)
-    print('AWS stackname:                ' + stackname)
     print('---------------------------- ')
 
+    if args.dry_run == 'yes':
+        for t in targets:
+            upload_files(t.region, t.hostcerts_bucket, t.conf_sources_bucket, args.upload_threads, dry_run=True, vpc_id=t.vpc_id)
+        quit()
+
     answer = input('Do you want to proceed ? [yes|no]: ')
     if answer != 'yes':
         print('Did not provide "yes" answer,exiting...')
         quit()
-    
-    upload_files(args.region, hostcerts_bucket, conf_sources_bucket)
-    
-    caCmkKey, certEnrollLamnda = provision_stack(args.region, hostcerts_bucket, cacrypto_bucket, conf_sources_bucket, args.vpc_id)
 
-    if args.ca_use_existing == 'no':
-        generate_ca(args.region, hostcerts_bucket, cacrypto_bucket, args.leave_cakey_in_folder, caCmkKey,
-                    certEnrollLamnda)
+    if len(targets) == 1:
+        provision(targets[0], args)
+    else:
+        print('Provisioning ' + str(len(targets)) + ' targets, ' + str(min(args.parallel, len(targets))) +
+              ' in parallel. Logs in aws_setup-<target>.log')
+        provision_all(targets, args)
+
+        print('')
+        print('Summary:')
+        print('----------------------------')
+        for t in targets:
+            print('%-28s %-6s %5ds  %s' % (t.name, 'failed' if t.error else 'ok', t.elapsed(), t.error or t.stackname))
+        print('---------------------------- ')
+
+    for t in targets:
+        if t.password:
+            print('The CA key of ' + t.name + ' is in the local folder. Key encryption password follows on next line. Keep the password secret')
+            print(t.password)
+
+    failed = [t for t in targets if t.error]
+    if failed:
+        print('Provisioning of ' + ', '.join(t.name for t in failed) + ' failed, see the logs')
+        sys.exit(1)
 
     print('done :-)')
@@ -0,0 +1,461 @@
+"""
+  In-process stand-ins for the AWS clients used by the Lambda functions.
+  They implement only the calls and fields the functions use, keep their state in
+  memory and count every call, so the functions can be run locally without AWS.
+
+  Faults injects a latency into calls and throttles calls above a rate, per
+  service.operation, service or default. Throttled calls are retried with backoff
+  like botocore does (4 retries unless the client is configured otherwise).
+
+  Copyright 2018  Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy of this
+  software and associated documentation files (the "Software"), to deal in the Software
+  without restriction, including without limitation the rights to use, copy, modify,
+  merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+  permit persons to whom the Software is furnished to do so.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+  INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+  PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+  HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+  SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+import copy, datetime, io, json, os, random, threading, time, uuid
+from collections import defaultdict
+
+THROTTLING_CODES = {'lambda': 'TooManyRequestsException', 'ec2': 'RequestLimitExceeded'}
+
+
+def client_error(code, operation):
+    from botocore.exceptions import ClientError
+    return ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+
+class Faults(object):
+    """ Latency in seconds and max calls per second, keyed by service.operation, service or default """
+
+    def __init__(self, latency=None, rate=None):
+        self.latency = latency or {}
+        self.rate = rate or {}
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def _lookup(self, table, op):
+        for key in (op, op.split('.')[0], 'default'):
+            if key in table:
+                return key, table[key]
+        return None, None
+
+    def delay(self, op):
+        key, latency = self._lookup(self.latency, op)
+        return latency or 0
+
+    def throttled(self, op):
+        key, rate = self._lookup(self.rate, op)
+        if not rate:
+            return False
+        # token bucket with a burst of one second
+        with self.lock:
+            now = time.time()
+            tokens, last = self.buckets.get(key, (rate, now))
+            tokens = min(rate, tokens + (now - last) * rate)
+            if tokens < 1:
+                self.buckets[key] = (tokens, now)
+                return True
+            self.buckets[key] = (tokens - 1, now)
+            return False
+
+
+class CallCounter(object):
+
+    def __init__(self, faults=None):
+        self.lock = threading.Lock()
+        self.calls = defaultdict(int)
+        self.faults = faults or Faults()
+
+    def count(self, service, operation):
+        with self.lock:
+            self.calls[service + '.' + operation] += 1
+
+
+class StandIn(object):
+
+    service = None
+    # botocore legacy retry mode
+    retries = 4
+
+    def __init__(self, counter):
+        self.counter = counter
+
+    def client(self, config=None):
+        """ Client view with its own retry configuration, sharing the state """
+        view = copy.copy(self)
+        if config is not None and config.retries and 'total_max_attempts' in config.retries:
+            view.retries = config.retries['total_max_attempts'] - 1
+        elif config is not None and config.retries and 'max_attempts' in config.retries:
+            view.retries = config.retries['max_attempts']
+        return view
+
+    def _call(self, operation):
+        op = self.service + '.' + operation
+        faults = self.counter.faults
+        attempt = 0
+        while True:
+            self.counter.count(self.service, operation)
+            delay = faults.delay(op)
+            if delay:
+                time.sleep(delay)
+            if not faults.throttled(op):
+                return
+            self.counter.count(self.service, operation + '.throttled')
+            if attempt >= self.retries:
+                raise client_error(THROTTLING_CODES.get(self.service, 'ThrottlingException'), operation)
+            attempt += 1
+            time.sleep(random.uniform(0, min(20, 0.05 * 2 ** attempt)))
+
+
+class Context(object):
+    """ Lambda context with the remaining time of an invocation """
+
+    def __init__(self, timeout):
+        self.deadline = time.time() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return int(max(0, self.deadline - time.time()) * 1000)
+
+
+class Paginator(object):
+
+    def __init__(self, method, result_key):
+        self.method = method
+        self.result_key = result_key
+
+    def paginate(self, PaginationConfig=None, **kw):
+        yield self.method(**kw)
+
+
+class EC2(StandIn):
+    """ Instances with state, VPC, private IPs and tags """
+
+    service = 'ec2'
+
+    def __init__(self, counter):
+        StandIn.__init__(self, counter)
+        self.instances = {}
+        self.lock = threading.Lock()
+
+    def add_instance(self, instance_id, ips, tags, vpc_id='vpc-1', state=('running', 16)):
+        self.instances[instance_id] = {
+            'InstanceId': instance_id,
+            'State': {'Name': state[0], 'Code': state[1]},
+            'VpcId': vpc_id,
+            'PrivateDnsName': 'ip-' + ips[0].replace('.', '-') + '.ec2.internal',
+            'NetworkInterfaces': [{'PrivateIpAddresses': [{'PrivateIpAddress': ip} for ip in ips]}],
+            'Tags': [{'Key': k, 'Value': v} for k, v in tags.items()]}
+
+    def tags(self, instance_id):
+        return dict((t['Key'], t['Value']) for t in self.instances[instance_id]['Tags'])
+
+    def _match(self, instance, f):
+        name, values = f['Name'], f['Values']
+        if name == 'instance-state-name':
+            return instance['State']['Name'] in values
+        if name == 'vpc-id':
+            return instance['VpcId'] in values
+        if name == 'tag-key':
+            return any(t['Key'] in values for t in instance['Tags'])
+        if name.startswith('tag:'):
+            return any(t['Key'] == name[4:] and t['Value'] in values for t in instance['Tags'])
+        raise Exception('filter not supported by stand-in: ' + name)
+
+    def describe_instances(self, InstanceIds=None, Filters=None, **kw):
+        self._call('describe_instances')
+        with self.lock:
+            found = [json.loads(json.dumps(i)) for i in self.instances.values()
+                     if (InstanceIds is None or i['InstanceId'] in InstanceIds) and
+                     all(self._match(i, f) for f in (Filters or []))]
+        return {'Reservations': [{'Instances': found}] if found else []}
+
+    def get_paginator(self, operation):
+        return Paginator(getattr(self, operation), 'Reservations')
+
+    def resource(self):
+        return EC2Resource(self)
+
+    def create_tags(self, Resources, Tags):
+        self._call('create_tags')
+        with self.lock:
+            for r in Resources:
+                tags = self.instances[r]['Tags']
+                for t in Tags:
+                    tags[:] = [x for x in tags if x['Key'] != t['Key']] + [dict(t)]
+
+    def delete_tags(self, Resources, Tags):
+        self._call('delete_tags')
+        with self.lock:
+            for r in Resources:
+                self.instances[r]['Tags'] = [x for x in self.instances[r]['Tags'] if not any(
+                    x['Key'] == t['Key'] and ('Value' not in t or x['Value'] == t['Value']) for t in Tags)]
+
+
+class EC2Instance(object):
+    """ boto3 ec2.Instance, loaded with one DescribeInstances on first use """
+
+    def __init__(self, ec2, instance_id):
+        self.ec2 = ec2
+        self.id = instance_id
+        self.data = None
+
+    def _load(self):
+        if self.data is None:
+            self.data = self.ec2.describe_instances(InstanceIds=[self.id])['Reservations'][0]['Instances'][0]
+        return self.data
+
+    @property
+    def private_dns_name(self):
+        return self._load()['PrivateDnsName']
+
+    @property
+    def network_interfaces_attribute(self):
+        return self._load()['NetworkInterfaces']
+
+
+class EC2Resource(object):
+
+    def __init__(self, ec2):
+        self.ec2 = ec2
+
+    def Instance(self, instance_id):
+        return EC2Instance(self.ec2, instance_id)
+
+
+class KMS(StandIn):
+    """ 'Encrypts' by prefixing the plaintext """
+
+    service = 'kms'
+
+    def generate_random(self, NumberOfBytes):
+        self._call('generate_random')
+        return {'Plaintext': os.urandom(NumberOfBytes)}
+
+    def generate_data_key(self, KeyId, NumberOfBytes=32, **kw):
+        self._call('generate_data_key')
+        plaintext = os.urandom(NumberOfBytes)
+        return {'Plaintext': plaintext, 'CiphertextBlob': b'KMS:' + plaintext, 'KeyId': KeyId}
+
+    def encrypt(self, KeyId, Plaintext, **kw):
+        self._call('encrypt')
+        if not isinstance(Plaintext, bytes):
+            Plaintext = Plaintext.encode('utf-8')
+        return {'CiphertextBlob': b'KMS:' + Plaintext, 'KeyId': KeyId}
+
+    def decrypt(self, CiphertextBlob, **kw):
+        self._call('decrypt')
+        return {'Plaintext': CiphertextBlob[len(b'KMS:'):]}
+
+
+class SSM(StandIn):
+    """ SSM agents coming online after agent_polls checks, commands completing after command_polls checks.
+        host(instance_id, script), if given, returns the standard output of the script on an instance.
+        Tag targets are resolved against the instances of ec2, if given """
+
+    service = 'ssm'
+
+    def __init__(self, counter, agent_polls=1, command_polls=1, failing=(), host=None, ec2=None):
+        StandIn.__init__(self, counter)
+        self.host = host
+        self.ec2 = ec2
+        self.agent_polls = agent_polls
+        self.command_polls = command_polls
+        self.failing = set(failing)
+        self.agent_checks = defaultdict(int)
+        self.commands = {}
+        self.lock = threading.Lock()
+
+    def describe_instance_information(self, InstanceInformationFilterList, **kw):
+        self._call('describe_instance_information')
+        ids = [f for f in InstanceInformationFilterList if f['key'] == 'InstanceIds'][0]['valueSet']
+        online = []
+        with self.lock:
+            for i in ids:
+                self.agent_checks[i] += 1
+                if self.agent_checks[i] > self.agent_polls:
+                    online.append({'InstanceId': i, 'PingStatus': 'Online'})
+        return {'InstanceInformationList': online}
+
+    def send_command(self, InstanceIds=None, Targets=None, Parameters=None, **kw):
+        self._call('send_command')
+        command_id = str(uuid.uuid4())
+        if Targets and self.ec2 is not None:
+            with self.ec2.lock:
+                InstanceIds = sorted(i['InstanceId'] for i in self.ec2.instances.values()
+                                     if i['State']['Name'] == 'running' and all(self.ec2._match(i, {'Name': t['Key'], 'Values': t['Values']}) for t in Targets))
+        output = {}
+        if self.host is not None:
+            output = dict((i, self.host(i, Parameters['commands'][0])) for i in InstanceIds or [])
+        with self.lock:
+            # only the size of the script is kept, a large fleet would hold every certificate
+            self.commands[command_id] = {'instances': list(InstanceIds or []), 'checks': 0,
+                                         'script_bytes': len(json.dumps(Parameters)), 'comment': kw.get('Comment', ''),
+                                         'output': output}
+        return {'Command': {'CommandId': command_id, 'TargetCount': len(InstanceIds or [])}}
+
+    def list_commands(self, CommandId, **kw):
+        self._call('list_commands')
+        with self.lock:
+            c = self.commands[CommandId]
+            c['checks'] += 1
+            done = c['checks'] >= self.command_polls
+            errors = len([i for i in c['instances'] if i in self.failing]) if done else 0
+        return {'Commands': [{'CommandId': CommandId, 'TargetCount': len(c['instances']),
+                              'CompletedCount': len(c['instances']) if done else 0, 'ErrorCount': errors,
+                              'Status': ('Failed' if errors else 'Success') if done else 'InProgress'}]}
+
+
+    def list_command_invocations(self, CommandId, **kw):
+        self._call('list_command_invocations')
+        with self.lock:
+            c = self.commands[CommandId]
+            c['checks'] += 1
+            done = c['checks'] >= self.command_polls
+        return {'CommandInvocations': [{'CommandId': CommandId, 'InstanceId': i,
+                                        'Status': ('Failed' if i in self.failing else 'Success') if done else 'InProgress'}
+                                       for i in c['instances']]}
+
+    def get_command_invocation(self, CommandId, InstanceId, **kw):
+        self._call('get_command_invocation')
+        with self.lock:
+            done = self.commands[CommandId]['checks'] >= self.command_polls
+            out = self.commands[CommandId]['output'].get(InstanceId, '') if done else ''
+        # the script does not run, the output comes from host if given, there are no step timings
+        return {'CommandId': CommandId, 'InstanceId': InstanceId, 'StandardOutputContent': out, 'StandardErrorContent': '',
+                'Status': ('Failed' if InstanceId in self.failing else 'Success') if done else 'InProgress'}
+
+    def get_paginator(self, operation):
+        return Paginator(getattr(self, operation), 'CommandInvocations')
+
+
+class Lambda(StandIn):
+    """ Invokes registered python handlers in process """
+
+    service = 'lambda'
+
+    def __init__(self, counter):
+        StandIn.__init__(self, counter)
+        self.functions = {}
+        self.async_events = []
+        self.lock = threading.Lock()
+
+    def register(self, name, handler):
+        self.functions[name] = handler
+
+    def invoke(self, FunctionName, Payload, InvocationType='RequestResponse', **kw):
+        self._call('invoke')
+        event = json.loads(Payload)
+        if InvocationType == 'Event':
+            with self.lock:
+                self.async_events.append((FunctionName, event))
+            return {'StatusCode': 202}
+        try:
+            result = self.functions[FunctionName](event, None)
+        except Exception as e:
+            return {'StatusCode': 200, 'FunctionError': 'Unhandled',
+                    'Payload': io.BytesIO(json.dumps({'errorMessage': str(e)}).encode('utf-8'))}
+        return {'StatusCode': 200, 'Payload': io.BytesIO(json.dumps(result).encode('utf-8'))}
+
+    def take_async_events(self):
+        with self.lock:
+            events = list(self.async_events)
+            del self.async_events[:]
+        return events
+
+    def get_function_concurrency(self, FunctionName):
+        self._call('get_function_concurrency')
+        return {}
+
+
+class S3(StandIn):
+    """ Objects in memory with ETags """
+
+    service = 's3'
+
+    def __init__(self, counter):
+        StandIn.__init__(self, counter)
+        self.objects = {}
+        self.modified = {}
+        self.lock = threading.Lock()
+
+    def _etag(self, body):
+        import hashlib
+        return '"' + hashlib.md5(body).hexdigest() + '"'
+
+    def put_object(self, Bucket, Key, Body=b'', **kw):
+        self._call('put_object')
+        if hasattr(Body, 'read'):
+            Body = Body.read()
+        if not isinstance(Body, bytes):
+            Body = Body.encode('utf-8')
+        with self.lock:
+            self.objects[(Bucket, Key)] = (Body, kw.get('Metadata', {}))
+            self.modified[(Bucket, Key)] = datetime.datetime.utcnow()
+        return {'ETag': self._etag(Body)}
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None, Config=None, **kw):
+        # the transfer manager of boto3, one call here whatever the number of parts
+        self._call('upload_file')
+        with open(Filename, 'rb') as f:
+            body = f.read()
+        with self.lock:
+            self.objects[(Bucket, Key)] = (body, (ExtraArgs or {}).get('Metadata', {}))
+            self.modified[(Bucket, Key)] = datetime.datetime.utcnow()
+
+    def _error(self, code, operation):
+        return client_error(code, operation)
+
+    def delete_object(self, Bucket, Key, **kw):
+        self._call('delete_object')
+        with self.lock:
+            self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def delete_objects(self, Bucket, Delete, **kw):
+        self._call('delete_objects')
+        with self.lock:
+            for o in Delete['Objects']:
+                self.objects.pop((Bucket, o['Key']), None)
+        return {}
+
+    def list_objects_v2(self, Bucket, Prefix='', **kw):
+        self._call('list_objects_v2')
+        with self.lock:
+            keys = sorted(k for b, k in self.objects if b == Bucket and k.startswith(Prefix))
+        return {'Contents': [{'Key': k, 'LastModified': self.modified.get((Bucket, k), datetime.datetime.utcnow())} for k in keys],
+                'KeyCount': len(keys), 'IsTruncated': False}
+
+    def get_paginator(self, operation):
+        return Paginator(getattr(self, operation), 'Contents')
+
+    def get_object(self, Bucket, Key, **kw):
+        self._call('get_object')
+        with self.lock:
+            if (Bucket, Key) not in self.objects:
+                raise self._error('NoSuchKey', 'GetObject')
+            body, meta = self.objects[(Bucket, Key)]
+        if kw.get('IfNoneMatch') == self._etag(body):
+            # botocore raises the 304 of a conditional GET as an error
+            raise self._error('304', 'GetObject')
+        return {'Body': io.BytesIO(body), 'ETag': self._etag(body), 'ContentLength': len(body), 'Metadata': meta}
+
+    def head_object(self, Bucket, Key, **kw):
+        self._call('head_object')
+        with self.lock:
+            if (Bucket, Key) not in self.objects:
+                raise self._error('404', 'HeadObject')
+            body, meta = self.objects[(Bucket, Key)]
+        return {'ETag': self._etag(body), 'ContentLength': len(body), 'Metadata': meta}
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn=3600):
+        return 'https://' + Params['Bucket'] + '.s3.amazonaws.com/' + Params['Key'] + '?X-Amz-Expires=' + str(ExpiresIn)
@@ -0,0 +1,356 @@
+#!/usr/bin/python
+"""
+  End-to-end enrollment benchmark. Runs the real handlers of
+	 ipsec_setup_lambda_function        - EC2 events and the scheduled ticks
+	 generate_certifcate_lambda_function - invoked by the setup for each certificate
+	 enroll_cert_lambda_function        - re-enrollment of the whole fleet
+  against the in-process stand-ins of S3, KMS, EC2, SSM and Lambda (aws_standins.py) with
+  injected latencies and throttling, for one or more fleet sizes. No AWS access is needed.
+
+  It reports the latency percentiles of each stage, the API calls per enrolled host and the
+  wall time of the setup and of the re-enrollment. The ticks run back to back; in AWS they are
+  one minute apart, so the deployed setup takes about ticks minutes longer.
+
+    python3 benchmarks/enrollment_benchmark.py --fleet 10,100,1000 --latency default=0.01 --rate lambda.invoke=50
+
+  The idempotency records of the setup are kept in a file (IdempotencyFile), --duplicates n
+  delivers each EC2 event n more times to measure the suppression of the duplicates.
+
+  Stages
+	 issue         - one GenerateCertificate invocation
+	 setup-event   - IPSecSetup invocation of the EC2 running event
+	 setup-tick    - IPSecSetup scheduled tick
+	 host-setup    - EC2 event until the instance is tagged IPSec:enabled
+	 reenroll      - ReenrollCertificate invocation (lists the fleet, fans out the setups)
+	 renew-event, renew-tick, host-renewal - the same for the re-enrollment
+	 host-csr      - key and certificate request generated on a host (--csr)
+
+  Requires openssl and the python packages boto3 and cryptography.
+
+  Copyright 2018  Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy of this
+  software and associated documentation files (the "Software"), to deal in the Software
+  without restriction, including without limitation the rights to use, copy, modify,
+  merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+  permit persons to whom the Software is furnished to do so.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+  INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+  PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+  HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+  SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+import os, sys, json, time, base64, shutil, tempfile, threading, contextlib, io
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+for f in ('generate_certifcate_lambda_function', 'ipsec_setup_lambda_function', 'enroll_cert_lambda_function'):
+    sys.path.insert(0, os.path.join(root, 'functions', 'source', f))
+sys.path.insert(0, root)
+
+import boto3
+import aws_standins
+import aws_setup
+import cert_engine
+import generate_certifcate_lambda_function as generate
+import ipsec_setup_lambda_function as setup
+import enroll_cert_lambda_function as enroll
+import aws_clients, artifact_cache
+from issuance_benchmark import generate_test_ca, percentile
+
+CA_PASSWORD = 'benchmark'
+
+GENERATE_ENV = {'CA_BUCKET': 'ca', 'CA_FILE': 'ca.cert.pem', 'CA_KEY_FILE': 'ca.key.encrypted.pem',
+                'CA_PWD': base64.b64encode(b'KMS:' + CA_PASSWORD.encode('utf-8')).decode('utf-8'),
+                'CERTS_BUCKET': 'certs', 'P12_CMS_KEYID': 'alias/benchmark-USER', 'ISSUER_ENGINE': 'python'}
+
+SETUP_ENV = {'SelectorTagName': 'IPSec', 'SelectorTagValue': 'todo', 'ResultTagValue': 'enabled',
+             'SourceBucket': 'sources', 'SourcePrefix': '', 'CertificateEnrollLambda': 'GenerateCertificate',
+             'IPSecSetUpScript': 'setup_ipsec.sh', 'VpcId': 'any', 'AgentWaitSeconds': '300'}
+
+ENROLL_ENV = {'IPSecSetupLambda': 'IPSecSetup', 'SelectorTagName': 'IPSec', 'SelectorTagValue': 'enabled',
+              'VpcId': 'any', 'AWS_REGION': 'us-east-1', 'FanOutThreads': '8'}
+
+# timeouts of the functions in the template
+SETUP_TIMEOUT = 180
+ENROLL_TIMEOUT = 300
+
+STAGES = ['issue', 'setup-event', 'setup-tick', 'host-setup', 'reenroll', 'renew-event', 'renew-tick', 'host-renewal', 'host-csr']
+
+
+class FunctionOS(object):
+    """ os module of one function: its own environment, everything else from os """
+
+    def __init__(self, environ):
+        self.environ = environ
+
+    def __getattr__(self, name):
+        return getattr(os, name)
+
+
+class Timings(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = defaultdict(list)
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.stages[stage].append(seconds)
+
+    def timed(self, stage, fn, *args):
+        t = time.time()
+        try:
+            return fn(*args)
+        finally:
+            self.add(stage, time.time() - t)
+
+
+class TrackingEC2(aws_standins.EC2):
+    """ Records when an instance gets the result tag """
+
+    def __init__(self, counter, result_tag):
+        aws_standins.EC2.__init__(self, counter)
+        self.result_tag = result_tag
+        self.tagged = {}
+
+    def create_tags(self, Resources, Tags):
+        aws_standins.EC2.create_tags(self, Resources, Tags)
+        if any(t['Key'] == self.result_tag[0] and t['Value'] == self.result_tag[1] for t in Tags):
+            now = time.time()
+            with self.lock:
+                for r in Resources:
+                    self.tagged[r] = now
+
+
+class Fleet(object):
+
+    def __init__(self, args, size, ca):
+        self.args = args
+        self.size = size
+        self.timings = Timings()
+        self.counter = aws_standins.CallCounter(aws_standins.Faults(args.latency, args.rate))
+        self.ec2 = TrackingEC2(self.counter, ('IPSec', 'enabled'))
+        self.ssm = aws_standins.SSM(self.counter, agent_polls=args.agent_polls, command_polls=args.command_polls, host=self.host)
+        self.lmb = aws_standins.Lambda(self.counter)
+        self.s3 = aws_standins.S3(self.counter)
+        self.kms = aws_standins.KMS(self.counter)
+        self.services = {'ec2': self.ec2, 'ssm': self.ssm, 'lambda': self.lmb, 's3': self.s3, 'kms': self.kms}
+        self.failed = 0
+
+        boto3.client = lambda service, config=None, **kw: self.services[service].client(config)
+        boto3.resource = lambda service, **kw: self.ec2.resource()
+        # the clients and artifacts cached by the lambdas belong to the previous fleet
+        aws_clients.reset()
+        artifact_cache.reset()
+
+        self.lmb.register('GenerateCertificate', lambda event, context: self.timings.timed(
+            'issue', generate.lambda_handler, event, context))
+
+        # fixtures are stored without counting or faults
+        counter, self.s3.counter = self.s3.counter, aws_standins.CallCounter()
+        self.s3.put_object(Bucket='ca', Key='ca.cert.pem', Body=ca.cert)
+        self.s3.put_object(Bucket='ca', Key='ca.key.encrypted.pem', Body=ca.key)
+        self.s3.put_object(Bucket='sources', Key='setup_ipsec.sh', Body=open(os.path.join(root, 'sources', 'setup_ipsec.sh'), 'rb'))
+        cwd = os.getcwd()
+        os.chdir(root)
+        with contextlib.redirect_stdout(io.StringIO()):
+            aws_setup.upload_bundle(self.s3, 'sources', prefix='')
+        os.chdir(cwd)
+        self.s3.counter = counter
+
+        self.ids = ['i-%08d' % i for i in range(size)]
+        for i, instance_id in enumerate(self.ids):
+            self.ec2.add_instance(instance_id, ['10.%d.%d.%d' % (i // 62500, i // 250 % 250, i % 250 + 4)], {'IPSec': 'todo'})
+
+    def host(self, instance_id, script):
+        # the key and certificate request of the CSR mode, generated on the host
+        if "csrRequest='true'" not in script:
+            return ''
+        hostname = self.ec2.instances[instance_id]['PrivateDnsName']
+        return 'IPSEC-CSR ' + self.timings.timed('host-csr', host_request, hostname)
+
+    def invoke_all(self, stage, events):
+        def run(event):
+            try:
+                self.timings.timed(stage, setup.lambda_handler, event, aws_standins.Context(SETUP_TIMEOUT))
+            except Exception as err:
+                with self.timings.lock:
+                    self.failed += 1
+                print('IPSecSetup failed: ' + str(err))
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as pool:
+            list(pool.map(run, events))
+
+    def in_flight(self):
+        return any(t['Key'] == 'IPSecSetupState' for i in self.ec2.instances.values() for t in i['Tags'])
+
+    def ticks(self, stage):
+        ticks = 0
+        while self.in_flight() and ticks < self.args.max_ticks:
+            ticks += 1
+            try:
+                self.timings.timed(stage, setup.lambda_handler, {'ipsec-setup': 'tick'}, aws_standins.Context(SETUP_TIMEOUT))
+            except Exception as err:
+                print('IPSecSetup tick failed: ' + str(err)[:200])
+        return ticks
+
+    def host_times(self, stage, started):
+        for instance_id in self.ids:
+            if instance_id in self.ec2.tagged:
+                self.timings.add(stage, self.ec2.tagged[instance_id] - started[instance_id])
+
+    def calls(self):
+        return dict(self.counter.calls)
+
+    def run(self):
+        result = {'fleet': self.size}
+
+        # EC2 running events of the whole fleet
+        t = time.time()
+        started = dict((i, t) for i in self.ids)
+        # duplicate deliveries of the EC2 events are suppressed by the idempotency records
+        self.invoke_all('setup-event', [{'detail': {'instance-id': i}} for i in self.ids] * (1 + self.args.duplicates))
+        result['setup_ticks'] = self.ticks('setup-tick')
+        result['setup_wall'] = time.time() - t
+        self.host_times('host-setup', started)
+        result['setup_done'] = len(self.ec2.tagged)
+        setup_calls = self.calls()
+
+        if not self.args.no_renewal:
+            self.ec2.tagged.clear()
+            t = time.time()
+            self.timings.timed('reenroll', enroll.lambda_handler, {'renew-all': True}, aws_standins.Context(ENROLL_TIMEOUT))
+            events = [e for name, e in self.lmb.take_async_events() if name == 'IPSecSetup']
+            started = dict((i, t) for i in self.ids)
+            self.invoke_all('renew-event', events)
+            result['renewal_ticks'] = self.ticks('renew-tick')
+            result['renewal_wall'] = time.time() - t
+            self.host_times('host-renewal', started)
+            result['renewal_done'] = len(self.ec2.tagged)
+
+        all_calls = self.calls()
+        result['failed'] = self.failed
+        result['calls_per_host'] = {
+            'setup': dict((k, v / float(self.size)) for k, v in setup_calls.items()),
+            'renewal': dict((k, (v - setup_calls.get(k, 0)) / float(self.size)) for k, v in all_calls.items()
+                            if v - setup_calls.get(k, 0) > 0)}
+        result['stages'] = dict((stage, {'n': len(v), 'p50': percentile(v, 50), 'p95': percentile(v, 95),
+                                         'p99': percentile(v, 99), 'max': max(v)})
+                                for stage, v in self.timings.stages.items() if v)
+        return result
+
+
+def host_request(hostname):
+    """ Certificate request (DER, base64) of a new key as setup_ipsec.sh prints it """
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.primitives import hashes, serialization
+    key = cert_engine.generate_key()
+    csr = x509.CertificateSigningRequestBuilder().subject_name(
+        x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, hostname)])).sign(key, hashes.SHA256(), cert_engine.default_backend())
+    return base64.b64encode(csr.public_bytes(serialization.Encoding.DER)).decode('ascii')
+
+
+def report(r):
+    print('')
+    print('fleet %d: setup %.2fs wall, %d ticks, %d/%d enabled' % (r['fleet'], r['setup_wall'], r['setup_ticks'], r['setup_done'], r['fleet']))
+    if 'renewal_wall' in r:
+        print('         renewal %.2fs wall, %d ticks, %d/%d renewed' % (r['renewal_wall'], r['renewal_ticks'], r['renewal_done'], r['fleet']))
+    print('         failed invocations %d' % r['failed'])
+    print('  %-14s %6s %9s %9s %9s %9s' % ('stage', 'n', 'p50', 'p95', 'p99', 'max'))
+    for stage in STAGES:
+        if stage in r['stages']:
+            s = r['stages'][stage]
+            print('  %-14s %6d %8.3fs %8.3fs %8.3fs %8.3fs' % (stage, s['n'], s['p50'], s['p95'], s['p99'], s['max']))
+    setup_calls, renewal_calls = r['calls_per_host']['setup'], r['calls_per_host']['renewal']
+    print('  %-40s %9s %9s' % ('API calls per host', 'setup', 'renewal'))
+    for op in sorted(set(setup_calls) | set(renewal_calls)):
+        print('  %-40s %9.2f %9.2f' % (op, setup_calls.get(op, 0), renewal_calls.get(op, 0)))
+    print('  %-40s %9.2f %9.2f' % ('total', sum(v for k, v in setup_calls.items() if not k.endswith('.throttled')),
+                                   sum(v for k, v in renewal_calls.items() if not k.endswith('.throttled'))))
+
+
+def parse_faults(text):
+    """ key=value,key=value -> {key: float} """
+    faults = {}
+    for item in filter(None, (text or '').split(',')):
+        key, value = item.split('=', 1)
+        faults[key.strip()] = float(value)
+    return faults
+
+
+if __name__ == '__main__':
+    import argparse
+
+    p = argparse.ArgumentParser(description="Benchmarks the enrollment end-to-end against in-process AWS stand-ins")
+    p.add_argument("--fleet", default='10,100', help="Comma separated fleet sizes (default:10,100)")
+    p.add_argument("--concurrency", type=int, default=50, help="Concurrent IPSecSetup invocations of events (default:50)")
+    p.add_argument("--latency", default='default=0.005', help="Injected latency in seconds: service.operation|service|default=s,... (default: default=0.005)")
+    p.add_argument("--rate", default='', help="Calls per second above which calls are throttled: service.operation|service|default=n,...")
+    p.add_argument("--agent-polls", type=int, default=1, help="Checks until the SSM agent is online (default:1)")
+    p.add_argument("--command-polls", type=int, default=2, help="Checks until the SSM command completes (default:2)")
+    p.add_argument("--max-ticks", type=int, default=50, help="Scheduled ticks to run at most per phase (default:50)")
+    p.add_argument("--batch", action='store_true', help="Batch mode of the IPSecSetup")
+    p.add_argument("--envelope", action='store_true', help="Envelope encryption of the P12 password with a cached data key")
+    p.add_argument("--delivery", action='store_true', help="Hands the certificates over in S3 instead of the SSM command")
+    p.add_argument("--csr", action='store_true', help="CSR mode, the hosts generate their keys and the issuer only signs")
+    p.add_argument("--duplicates", type=int, default=0, help="Deliveries of each EC2 event beyond the first (default:0)")
+    p.add_argument("--fan-out-rate", default='100', help="FanOutRate of ReenrollCertificate, empty for its default (default:100)")
+    p.add_argument("--keygen", choices=['reuse', 'real'], default='reuse', help="reuse one host key (measures everything but the key generation) or generate each (default:reuse)")
+    p.add_argument("--key-bits", type=int, default=cert_engine.KEY_BITS, help="Host key size (default:%d)" % cert_engine.KEY_BITS)
+    p.add_argument("--no-renewal", action='store_true', help="Only the setup, no re-enrollment")
+    p.add_argument("--json", help="Writes the results to this file")
+    p.add_argument("--verbose", action='store_true', help="Shows the output of the functions")
+    args = p.parse_args()
+    args.latency = parse_faults(args.latency)
+    args.rate = parse_faults(args.rate)
+
+    if not cert_engine.available():
+        raise Exception('Python package cryptography is required for the benchmark')
+
+    if args.batch:
+        SETUP_ENV.update({'BatchMode': 'true', 'BatchWindowSeconds': '0'})
+    if args.envelope:
+        GENERATE_ENV['P12_PWD_ENVELOPE'] = 'true'
+    if args.delivery:
+        SETUP_ENV['DeliveryBucket'] = GENERATE_ENV['CERTS_BUCKET']
+    if args.csr:
+        SETUP_ENV['EnrollmentMode'] = 'csr'
+    if args.fan_out_rate:
+        ENROLL_ENV['FanOutRate'] = args.fan_out_rate
+    generate.os = FunctionOS(GENERATE_ENV)
+    setup.os = FunctionOS(SETUP_ENV)
+    enroll.os = FunctionOS(ENROLL_ENV)
+
+    generate_key = cert_engine.generate_key
+    if args.keygen == 'reuse':
+        key = generate_key(args.key_bits)
+        cert_engine.generate_key = lambda key_bits=None: key
+    else:
+        cert_engine.generate_key = lambda key_bits=None: generate_key(args.key_bits)
+
+    folder = tempfile.mkdtemp()
+    results = []
+    try:
+        ca = generate_test_ca(folder, CA_PASSWORD)
+        for size in [int(n) for n in args.fleet.split(',')]:
+            # the instance ids repeat across fleets, records of their own
+            SETUP_ENV['IdempotencyFile'] = os.path.join(folder, 'idempotency-%d.json' % size)
+            fleet = Fleet(args, size, ca)
+            if args.verbose:
+                r = fleet.run()
+            else:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    r = fleet.run()
+            results.append(r)
+            report(r)
+    finally:
+        shutil.rmtree(folder)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
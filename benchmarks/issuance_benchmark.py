@@ -0,0 +1,104 @@
+#!/usr/bin/python
+"""
+  Compares certificate issuance with genCert.sh (openssl processes) against
+  the in-process issuer cert_engine of generate_certifcate_lambda_function.
+
+  A throw-away CA is generated in a temporary folder, no AWS access is needed.
+  Requires openssl, bash and the python packages boto3 and cryptography.
+
+    python3 benchmarks/issuance_benchmark.py --iterations 20
+
+  Copyright 2018  Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy of this
+  software and associated documentation files (the "Software"), to deal in the Software
+  without restriction, including without limitation the rights to use, copy, modify,
+  merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+  permit persons to whom the Software is furnished to do so.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+  INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+  PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+  HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+  SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+import os, sys, time, shutil, subprocess, tempfile, base64
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'functions', 'source',
+                                'generate_certifcate_lambda_function'))
+
+import cert_engine
+from ca_cache import CaMaterial
+from generate_certifcate_lambda_function import issue_with_openssl, ca_keys
+
+HOSTNAME = 'ip-10-0-0-10.ec2.internal'
+IPS = ['10.0.0.10', '10.0.1.10']
+
+
+def generate_test_ca(folder, password):
+    p = subprocess.Popen(
+        'openssl genrsa -aes256 -out ./ca.key.encrypted.pem -passout pass:' + password + ' 4096 2>/dev/null && ' +
+        'openssl req -new -extensions v3_ca -sha256 -key ./ca.key.encrypted.pem -x509 -days 30 -out ./cacert.pem ' +
+        '-subj "/CN=ipsec.benchmark" -passin pass:' + password,
+        shell=True, cwd=folder)
+    p.wait()
+    if p.returncode != 0:
+        raise Exception('Error in execution of openssl script: ' + str(p.returncode))
+    return CaMaterial(None, open(os.path.join(folder, 'cacert.pem')).read(),
+                      open(os.path.join(folder, 'ca.key.encrypted.pem')).read(), password, None, None)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def report(name, timings):
+    print('%-10s n=%-4d mean=%7.3fs  p50=%7.3fs  p95=%7.3fs  max=%7.3fs' % (
+        name, len(timings), sum(timings) / len(timings), percentile(timings, 50), percentile(timings, 95), max(timings)))
+
+
+def check_p12(j, password):
+    from cryptography.hazmat.primitives.serialization import pkcs12
+    key, cert, cas = pkcs12.load_key_and_certificates(base64.b64decode(j['CERT_P12_B64']), password.encode('utf-8'))
+    if key is None or cert is None or len(cas) != 1:
+        raise Exception('PKCS12 bundle incomplete')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    p = argparse.ArgumentParser(description="Benchmarks certificate issuance: genCert.sh vs in-process")
+    p.add_argument("--iterations", "-i", type=int, default=10, help="Certificates to issue per engine (default:10)")
+    args = p.parse_args()
+
+    if not cert_engine.available():
+        raise Exception('Python package cryptography is required for the benchmark')
+
+    folder = tempfile.mkdtemp()
+    workdir = os.path.join(folder, 'work')
+    os.mkdir(workdir)
+    exportpassword = base64.b64encode(os.urandom(128)).decode('utf-8')
+    try:
+        ca = generate_test_ca(folder, 'benchmark')
+
+        timings = []
+        for i in range(args.iterations):
+            t = time.time()
+            j = issue_with_openssl(HOSTNAME, IPS, ca, exportpassword, workdir=workdir)
+            timings.append(time.time() - t)
+        check_p12(j, exportpassword)
+        report('openssl', timings)
+
+        timings = []
+        for i in range(args.iterations):
+            t = time.time()
+            cacert, cakey = ca_keys(ca)
+            j = cert_engine.issue(cacert, cakey, HOSTNAME, IPS, exportpassword)
+            timings.append(time.time() - t)
+        check_p12(j, exportpassword)
+        report('python', timings)
+    finally:
+        shutil.rmtree(folder)
@@ -0,0 +1,121 @@
+#!/usr/bin/python
+"""
+  Runs the IPSec setup state machine of ipsec_setup_lambda_function end-to-end
+  against the in-process stand-ins for EC2, SSM, Lambda and S3, no AWS access needed.
+
+    python3 benchmarks/setup_local_run.py --instances 5 --agent-polls 2 --command-polls 3
+
+  Copyright 2018  Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy of this
+  software and associated documentation files (the "Software"), to deal in the Software
+  without restriction, including without limitation the rights to use, copy, modify,
+  merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+  permit persons to whom the Software is furnished to do so.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+  INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+  PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+  HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+  SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+import os, sys, json, time
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(root, 'functions', 'source', 'ipsec_setup_lambda_function'))
+sys.path.insert(0, root)
+
+import aws_standins
+import aws_setup
+from setup_state_machine import SetupConfig, SetupMachine, MemoryStateStore
+from idempotency import MemoryIdempotencyStore
+
+ENV = {'SelectorTagName': 'IPSec', 'SelectorTagValue': 'todo', 'ResultTagValue': 'enabled',
+       'SourceBucket': 'sources', 'CertificateEnrollLambda': 'GenerateCertificate',
+       'IPSecSetUpScript': 'setup_ipsec.sh', 'VpcId': 'any'}
+
+
+def fake_certificate(event, context):
+    if 'instance-ids' in event:
+        csrs = event.get('csrs') or {}
+        results = dict((i, fake_certificate(dict({'instance-id': i}, **({'csr': csrs[i]} if i in csrs else {})), context))
+                       for i in event['instance-ids'])
+        return {'results': results, 'issued': len(results), 'failed': 0}
+    if 'csr' in event:
+        return {"ERR": "", "CERT_PEM_B64": "cGVt", "CERT_P12_B64": "", "CERT_CA_PEM_B64": "Y2E=",
+                "CERT_NOT_AFTER": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() + 30 * 86400))}
+    return {"ERR": "", "CERT_PEM_B64": "", "CERT_P12_B64": "cDEy", "CERT_P12_ENCRYPTED_PWD": "cHdk",
+            "CERT_NOT_AFTER": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() + 30 * 86400))}
+
+
+if __name__ == '__main__':
+    import argparse
+
+    p = argparse.ArgumentParser(description="Runs the IPSec setup state machine against local stand-ins")
+    p.add_argument("--instances", "-n", type=int, default=5, help="Instances to set up (default:5)")
+    p.add_argument("--agent-polls", type=int, default=2, help="Checks until the SSM agent is online (default:2)")
+    p.add_argument("--command-polls", type=int, default=3, help="Checks until the SSM command completes (default:3)")
+    p.add_argument("--max-ticks", type=int, default=20, help="Scheduled ticks to run at most (default:20)")
+    p.add_argument("--batch", action='store_true', help="Batch mode, one SSM command per batch of instances")
+    p.add_argument("--delivery", action='store_true', help="Hands the certificates over in S3 instead of the SSM command")
+    p.add_argument("--csr", action='store_true', help="CSR mode, the hosts generate their keys")
+    p.add_argument("--duplicates", type=int, default=0, help="Deliveries of each EC2 event beyond the first, suppressed (default:0)")
+    p.add_argument("--policy", action='store_true', help="Pushes the policies to the instances set up afterwards")
+    args = p.parse_args()
+
+    counter = aws_standins.CallCounter()
+    ec2 = aws_standins.EC2(counter)
+    # a host answers the CSR request with a certificate request
+    ssm = aws_standins.SSM(counter, agent_polls=args.agent_polls, command_polls=args.command_polls,
+                           host=lambda i, script: 'IPSEC-CSR Y3Ny' if "csrRequest='true'" in script else '', ec2=ec2)
+    lmb = aws_standins.Lambda(counter)
+    s3 = aws_standins.S3(counter)
+    lmb.register('GenerateCertificate', fake_certificate)
+    s3.put_object(Bucket='sources', Key='setup_ipsec.sh', Body=open(os.path.join(root, 'sources', 'setup_ipsec.sh'), 'rb'))
+    # bootstrap bundle as uploaded by aws_setup.py
+    os.chdir(root)
+    aws_setup.upload_bundle(s3, 'sources', prefix='')
+
+    env = dict(ENV)
+    if args.batch:
+        env.update({'BatchMode': 'true', 'BatchWindowSeconds': '0'})
+    if args.delivery:
+        env['DeliveryBucket'] = 'certs'
+    if args.csr:
+        env['EnrollmentMode'] = 'csr'
+    m = SetupMachine(SetupConfig(env), ec2, ssm, lmb, s3, MemoryStateStore(), idempotency=MemoryIdempotencyStore())
+
+    ids = ['i-%08d' % i for i in range(args.instances)]
+    for i, instance_id in enumerate(ids):
+        ec2.add_instance(instance_id, ['10.0.%d.%d' % (i // 250, i % 250 + 4)], {'IPSec': 'todo'})
+
+    # EC2 running events
+    for instance_id in ids:
+        m.start(instance_id, False)
+
+    ticks = 0
+    while m.store.in_flight() and ticks < args.max_ticks:
+        ticks += 1
+        m.tick()
+        # EventBridge delivers again while the setup is in flight
+        if ticks == 1:
+            for n in range(args.duplicates):
+                for instance_id in ids:
+                    m.start(instance_id, False)
+
+    if args.policy:
+        command_ids = m.push_policies()
+        status = m.policy_status(command_ids)
+        while status['status'].get('InProgress'):
+            status = m.policy_status(command_ids)
+        print('policy push: ' + json.dumps(status, sort_keys=True))
+
+    print('')
+    print('ticks: ' + str(ticks))
+    print('tags:  ' + json.dumps(dict((i, ec2.tags(i)) for i in ids)))
+    print('calls: ' + json.dumps(dict(counter.calls), sort_keys=True))
+    print('command bytes: ' + json.dumps(sorted(c['script_bytes'] for c in ssm.commands.values())))
+    print('suppressed: ' + str(m.suppressed))
+    print('left in S3: ' + json.dumps(sorted(k for b, k in s3.objects if b == 'certs')))
@@ -1,5 +1,7 @@
 #
 # Initialization of CA with certificate and key. Updatesthe ca cert issue lamnbda function with ca password 
+# The stages ca-keygen, ca-upload and ca-configure are emitted as EMF spans (see tracing.py), the AWS
+# calls as the span aws-calls (see aws_clients.py)
 #
 # Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
 #
@@ -16,8 +18,12 @@
 # OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 # 
-import json, os, subprocess, base64, boto3, threading, logging
+import json, os, subprocess, base64, threading, logging, time
 import cfnresponse 
+import aws_clients
+from tracing import Tracer, new_trace_id
+
+tracer = Tracer('CAInitialize')
 
 def timeout(event, context):
     logging.error('Execution is about to time out, sending failure response to CloudFormation')
@@ -32,6 +38,8 @@ def lambda_handler(event, context):
     timer =  threading.Timer((context.get_remaining_time_in_millis() / 1000.00) - 0.5, timeout, args=[event, context])
     timer.start()
     status = cfnresponse.SUCCESS    
+    trace = new_trace_id()
+    start = time.time()
  
     try:
         region = event['ResourceProperties']['region']
@@ -41,50 +49,53 @@ def lambda_handler(event, context):
         print(event)
         print(cacrypto_bucket)
   
-        # Generate CA key pass with 128 Bytes
-        kmsclient = boto3.client('kms')
-        print("Generating key password with KMS (128 Bytes)"); 
-        random=kmsclient.generate_random(NumberOfBytes=128)
-        rnd_token=base64.b64encode(random[u'Plaintext']).decode(encoding="utf-8")
-        print("Generated ca password"); 
+        with tracer.span('ca-keygen', trace):
+            # Generate CA key pass with 128 Bytes
+            kmsclient = aws_clients.client('kms', region_name=region)
+            print("Generating key password with KMS (128 Bytes)"); 
+            random=kmsclient.generate_random(NumberOfBytes=128)
+            rnd_token=base64.b64encode(random[u'Plaintext']).decode(encoding="utf-8")
+            print("Generated ca password"); 
   
-        # Generation the key and cert with openssl
-        p = subprocess.Popen(
-                'openssl genrsa -aes256 -out /tmp/ca.key.encrypted.pem  -passout pass:' + rnd_token + ' 4096 && openssl req -new -extensions v3_ca -sha256 -key /tmp/ca.key.encrypted.pem -x509 -days 3650 -out /tmp/cacert.pem -subj "/CN=ipsec.' + region + '" -passin pass:' + rnd_token,
-            shell=True, stdout=subprocess.PIPE)
-        p.wait()
-        if p.returncode != 0:
-            raise Exception('Error in execution of openssl script: ' + str(p.returncode))
-        else:
-            print('Certificate and key generated. Subject CN=ipsec.' + region + ' Valid 10 years')
-      
-        # Upload the encrypted key and CA cert
-        f = open("/tmp/ca.key.encrypted.pem",'rb')
-        s3 = boto3.client('s3', region_name=region)
-        s3.put_object(Bucket=cacrypto_bucket, Key='ca.key.encrypted.pem', Body=f)
-        print('Encrypted CA key uploaded in bucket ' + cacrypto_bucket)
-        f = open("/tmp/cacert.pem", 'rb')
-        s3.put_object(Bucket=cacrypto_bucket, Key='ca.cert.pem', Body=f)
-        print('CA cert uploaded in bucket ' + cacrypto_bucket)
-    
-        os.remove('/tmp/cacert.pem')
-        os.remove('/tmp/ca.key.encrypted.pem')
+            # Generation the key and cert with openssl
+            p = subprocess.Popen(
+                    'openssl genrsa -aes256 -out /tmp/ca.key.encrypted.pem  -passout pass:' + rnd_token + ' 4096 && openssl req -new -extensions v3_ca -sha256 -key /tmp/ca.key.encrypted.pem -x509 -days 3650 -out /tmp/cacert.pem -subj "/CN=ipsec.' + region + '" -passin pass:' + rnd_token,
+                shell=True, stdout=subprocess.PIPE)
+            p.wait()
+            if p.returncode != 0:
+                raise Exception('Error in execution of openssl script: ' + str(p.returncode))
+            else:
+                print('Certificate and key generated. Subject CN=ipsec.' + region + ' Valid 10 years')
+
+        with tracer.span('ca-upload', trace):
+            # Upload the encrypted key and CA cert
+            f = open("/tmp/ca.key.encrypted.pem",'rb')
+            s3 = aws_clients.client('s3', region_name=region)
+            s3.put_object(Bucket=cacrypto_bucket, Key='ca.key.encrypted.pem', Body=f)
+            print('Encrypted CA key uploaded in bucket ' + cacrypto_bucket)
+            f = open("/tmp/cacert.pem", 'rb')
+            s3.put_object(Bucket=cacrypto_bucket, Key='ca.cert.pem', Body=f)
+            print('CA cert uploaded in bucket ' + cacrypto_bucket)
     
-        # Encrypt the key with CA CMK
-        kms = boto3.client('kms', region_name=region)
-        ency_token = base64.b64encode(kms.encrypt(KeyId=caCmkKey, Plaintext=rnd_token)['CiphertextBlob']).decode(
-            encoding="utf-8")
+            os.remove('/tmp/cacert.pem')
+            os.remove('/tmp/ca.key.encrypted.pem')
+
+        with tracer.span('ca-configure', trace):
+            # Encrypt the key with CA CMK
+            kms = aws_clients.client('kms', region_name=region)
+            ency_token = base64.b64encode(kms.encrypt(KeyId=caCmkKey, Plaintext=rnd_token)['CiphertextBlob']).decode(
+                encoding="utf-8")
     
-        lmb = boto3.client('lambda', region_name=region)
-        env = lmb.get_function_configuration(FunctionName=certEnrollLamnda)['Environment']
-        env['Variables']['CA_PWD'] = ency_token
-        boto3.client('lambda', region_name=region).update_function_configuration(FunctionName=certEnrollLamnda, Environment=env)
-        print('Lambda function' + certEnrollLamnda + ' updated')
+            lmb = aws_clients.client('lambda', region_name=region)
+            env = lmb.get_function_configuration(FunctionName=certEnrollLamnda)['Environment']
+            env['Variables']['CA_PWD'] = ency_token
+            lmb.update_function_configuration(FunctionName=certEnrollLamnda, Environment=env)
+            print('Lambda function' + certEnrollLamnda + ' updated')
         
-        # Restrict the CA key for encryption. Remove allow kms:encrypt action
-        policy_response = kms.get_key_policy( KeyId=caCmkKey, PolicyName='default')
-        kms.put_key_policy( KeyId=caCmkKey, PolicyName='default', Policy=policy_response['Policy'].replace('"kms:Encrypt",','') )
-        print('Resource policy for CA CMK hardened - removed action kms:encrypt') 
+            # Restrict the CA key for encryption. Remove allow kms:encrypt action
+            policy_response = kms.get_key_policy( KeyId=caCmkKey, PolicyName='default')
+            kms.put_key_policy( KeyId=caCmkKey, PolicyName='default', Policy=policy_response['Policy'].replace('"kms:Encrypt",','') )
+            print('Resource policy for CA CMK hardened - removed action kms:encrypt')
         
     except Exception as e:
         logging.error('Exception: %s' % e, exc_info=True)
@@ -92,5 +103,6 @@ def lambda_handler(event, context):
         
     finally:
         timer.cancel()
+        tracer.record('aws-calls', trace, start, **aws_clients.report())
         cfnresponse.send(event, context, status, {}, None)
 
@@ -0,0 +1,116 @@
+"""
+    Timing spans of the enrollment, emitted as CloudWatch Embedded Metric Format (EMF) log lines
+
+   A trace id is created where an enrollment starts (EC2 event, re-enrollment run) and passed on
+   in the invoke payloads ("trace-id", "parent-id"), the setup state and the SSM command, so the
+   spans of all lambdas and of the host are found with one CloudWatch Logs Insights query
+	  fields @timestamp, Function, Stage, Duration, InstanceId | filter TraceId = '<id>' | sort @timestamp
+
+   Each span is one log line. CloudWatch extracts the metric Duration (milliseconds) in the
+   namespace IPSec/Enrollment with the dimensions Function and Stage, TraceId, SpanId, ParentId,
+   Status and the span properties are kept as searchable fields of the log event.
+
+   The same module is packaged with every lambda, keep the copies identical.
+
+    Copyright 2017-2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+    Licensed under the Apache License, Version 2.0 (the "License").
+    You may not use this file except in compliance with the License.
+    A copy of the License is located at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+   or in the "license" file accompanying this file. This file is distributed
+   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+   express or implied. See the License for the specific language governing
+   permissions and limitations under the License.
+
+"""
+import json, time, os, binascii, threading
+
+NAMESPACE = 'IPSec/Enrollment'
+
+
+def new_id(n=8):
+    return binascii.hexlify(os.urandom(n)).decode('ascii')
+
+
+def new_trace_id():
+    # time prefixed, traces sort by their start
+    return '%08x' % int(time.time()) + new_id(8)
+
+
+def emf(namespace, function, stage, start, duration_ms, fields):
+    line = {'_aws': {'Timestamp': int(start * 1000),
+                     'CloudWatchMetrics': [{'Namespace': namespace, 'Dimensions': [['Function', 'Stage']],
+                                            'Metrics': [{'Name': 'Duration', 'Unit': 'Milliseconds'}]}]},
+            'Function': function, 'Stage': stage, 'Duration': round(duration_ms, 3)}
+    line.update(fields)
+    return json.dumps(line, sort_keys=True, separators=(',', ':'))
+
+
+class Span(object):
+    """ Times a with block. Status is error if the block raises """
+
+    def __init__(self, tracer, stage, trace_id, parent_id, properties):
+        self.tracer = tracer
+        self.stage = stage
+        self.trace_id = trace_id
+        self.parent_id = parent_id
+        self.span_id = new_id()
+        self.properties = properties
+        self.start = None
+
+    def set(self, name, value):
+        self.properties[name] = value
+
+    def __enter__(self):
+        self.start = time.time()
+        self.tracer._push(self)
+        return self
+
+    def __exit__(self, kind, value, tb):
+        self.tracer._pop(self)
+        self.tracer.record(self.stage, self.trace_id, self.start, span_id=self.span_id, parent_id=self.parent_id,
+                           status='error' if kind is not None else 'ok', **self.properties)
+        return False
+
+
+class Tracer(object):
+    """ Spans of one function. emit receives each line, default print (the lambda log) """
+
+    def __init__(self, function, namespace=NAMESPACE, emit=None):
+        self.function = function
+        self.namespace = namespace
+        self.emit = emit or print
+        self.local = threading.local()
+
+    def _push(self, span):
+        self.local.__dict__.setdefault('open', []).append(span)
+
+    def _pop(self, span):
+        self.local.open.remove(span)
+
+    def current(self, trace_id):
+        """ Innermost open span of the trace in this thread or None """
+        for span in reversed(self.local.__dict__.get('open', [])):
+            if span.trace_id == trace_id:
+                return span
+        return None
+
+    def span(self, stage, trace_id, parent_id=None, **properties):
+        """ Span of a with block, the parent defaults to the innermost open span of the trace """
+        if parent_id is None and self.current(trace_id) is not None:
+            parent_id = self.current(trace_id).span_id
+        return Span(self, stage, trace_id, parent_id, properties)
+
+    def record(self, stage, trace_id, start, end=None, span_id=None, parent_id=None, status='ok', function=None, **properties):
+        """ Emits a span timed elsewhere, start and end in epoch seconds. Returns the span id """
+        span_id = span_id or new_id()
+        end = time.time() if end is None else end
+        fields = {'TraceId': trace_id, 'SpanId': span_id, 'Status': status}
+        if parent_id:
+            fields['ParentId'] = parent_id
+        fields.update(properties)
+        self.emit(emf(self.namespace, function or self.function, stage, start, max(0.0, end - start) * 1000, fields))
+        return span_id
@@ -1,9 +1,37 @@
 #
 #   Triggers SSM start commant to enroll certicates on selected instances 
+#
+#   Only instances whose certificate expires within the renewal window are re-enrolled.
+#   The expiry is read from the instance tag ExpiryTagName, set by the IPSecSetup lambda when
+#   a certificate is installed. The renewal time of each instance is spread with a jitter
+#   derived from the instance id over the window, so an hourly run renews a flat share of
+#   the fleet instead of all instances at once. Instances without the tag (certificates issued
+#   before the tag) are spread as well: each hourly run renews those whose jitter falls into its
+#   hour of UntaggedSpreadHours. Instances with the state tag of the IPSecSetup lambda have a setup
+#   or renewal in flight and are skipped, their expiry tag changes only once it completed.
+#   Event {"renew-all": true} renews all instances without a setup in flight, also those the IPSecSetup lambda would
+#   suppress as a duplicate of a recent enrollment (see idempotency.py of the IPSecSetup lambda).
+#   Each run is a trace (see tracing.py), its id is passed to the setup of every instance, the
+#   stages list-instances and fan-out are emitted as EMF spans of the stage reenroll.
 #   
 #   Configuration in enviroment variables
 #       - Selector is Tag and Value from the enviroment variable.
 #       - Certificate issuing lambda 
+#       - VpcId               - restricts the enrollment to a VPC (optional, default any)
+#       - ExpiryTagName       - instance tag with the certificate expiry (optional, default IPSecCertExpiry)
+#       - RenewalWindowDays   - renew in the last days before expiry (optional, default 10)
+#       - RenewalMarginDays   - renew without jitter in the last days before expiry (optional, default 2)
+#       - UntaggedSpreadHours - hours the renewal of the instances without expiry tag is spread over
+#                               (optional, default 24)
+#       - StateTagName        - instance tag of a setup in flight, see the IPSecSetup lambda
+#                               (optional, default IPSecSetupState)
+#       - FanOutThreads       - parallel async invokes of the setup lambda (optional, default 8)
+#       - FanOutRate          - max invokes per second (optional). If not set, derived from the
+#                               reserved concurrency of the setup lambda and FanOutSetupSeconds
+#                               (expected duration of one setup, default 60), otherwise 10/s
+#       - FanOutMaxRetries    - retries of a throttled invoke or a Lambda service fault (optional, default 5)
+#   The AWS clients are created once per container (see aws_clients.py), the calls of each run
+#   are emitted as the span aws-calls.
 #
 # Copyright 2017-2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
 #
@@ -18,29 +46,199 @@
 # express or implied. See the License for the specific language governing
 # permissions and limitations under the License.
 #
-import boto3
-import os, time, json
+import botocore
+import aws_clients
+import os, time, json, random, threading, calendar, hashlib
+from concurrent.futures import ThreadPoolExecutor
+from tracing import Tracer, new_trace_id
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+THROTTLING_ERRORS = ('TooManyRequestsException', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded',
+                     'EC2ThrottledException')
+
+# faults of the Lambda service (5xx), retried like a throttled invoke but not counted as throttled
+RETRYABLE_ERRORS = ('ServiceException',)
+
+tracer = Tracer('ReenrollCertificate')
+
+class RateLimiter(object):
+    """ Token bucket shared by the fan-out threads """
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = 1.0
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class FanOutSummary(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {'instances': 0, 'inflight': 0, 'due': 0, 'dispatched': 0, 'throttled': 0, 'retried': 0, 'failed': 0}
+
+    def add(self, name, n=1):
+        with self.lock:
+            self.counts[name] += n
+
+def list_instances(ec2, SelectorTagName, SelectorTagValue, VpcId, ExpiryTagName='IPSecCertExpiry', StateTagName='IPSecSetupState'):
+    # server side filters, all pages. Returns [(instance id, certificate expiry epoch or None, setup in flight)]
+    filters = [{"Name": "tag:" + SelectorTagName, "Values": [SelectorTagValue]},
+               {"Name": "instance-state-name", "Values": ["running"]}]
+    if VpcId != "any":
+        filters.append({"Name": "vpc-id", "Values": [VpcId]})
+
+    ids = []
+    paginator = ec2.get_paginator('describe_instances')
+    for page in paginator.paginate(Filters=filters, PaginationConfig={'PageSize': 1000}):
+        for res in page['Reservations']:
+            for i in res['Instances']:
+                expiry = None
+                in_flight = False
+                for tag in i.get('Tags', []):
+                    if tag['Key'] == StateTagName:
+                        in_flight = True
+                    if tag['Key'] == ExpiryTagName:
+                        try:
+                            expiry = calendar.timegm(time.strptime(tag['Value'], TIME_FORMAT))
+                        except ValueError:
+                            print('Instance ' + i['InstanceId'] + ' has invalid ' + ExpiryTagName + ': ' + tag['Value'])
+                ids.append((i['InstanceId'], expiry, in_flight))
+    return ids
+
+def jitter(key):
+    # stable fraction in [0, 1] of the key
+    return int(hashlib.sha256(key.encode('utf-8')).hexdigest()[:8], 16) / float(0xffffffff)
+
+def renewal_due(instance_id, expiry, now, window, margin, untagged_hours=24):
+    if expiry is None:
+        # unknown expiry, the hourly runs renew an equal share each within untagged_hours
+        hours = max(1, int(untagged_hours))
+        return int(now // 3600) % hours == min(hours - 1, int(jitter(instance_id) * hours))
+    if expiry - now <= margin:
+        return True
+    if expiry - now > window:
+        return False
+    # renewal time spread over [expiry - window, expiry - margin], stable for the instance and certificate
+    return now >= expiry - window + jitter(instance_id + str(expiry)) * (window - margin)
+
+def select_due(instances, now, window, margin, untagged_hours=24):
+    return [i for i, expiry, in_flight in instances if not in_flight and renewal_due(i, expiry, now, window, margin, untagged_hours)]
+
+def fan_out_rate(client, IPSecSetupLambda):
+    if os.environ.get('FanOutRate'):
+        return float(os.environ['FanOutRate'])
+    try:
+        reserved = client.get_function_concurrency(FunctionName=IPSecSetupLambda).get('ReservedConcurrentExecutions')
+    except botocore.exceptions.ClientError as err:
+        print('Can not read reserved concurrency of ' + IPSecSetupLambda + ': ' + str(err))
+        reserved = None
+    if reserved:
+        # keep the setup lambda below its reserved concurrency
+        return max(0.1, reserved / float(os.environ.get('FanOutSetupSeconds', '60')))
+    return 10.0
+
+def invoke(client, limiter, summary, IPSecSetupLambda, payload, retries):
+    for attempt in range(retries + 1):
+        limiter.acquire()
+        try:
+            client.invoke(FunctionName=IPSecSetupLambda, InvocationType='Event', Payload=payload)
+            summary.add('dispatched')
+            return True
+        except botocore.exceptions.ClientError as err:
+            code = err.response['Error']['Code']
+            if code not in THROTTLING_ERRORS and code not in RETRYABLE_ERRORS:
+                print('Failed to invoke ' + IPSecSetupLambda + ': ' + str(err))
+                break
+            if code in THROTTLING_ERRORS:
+                summary.add('throttled')
+            if attempt < retries:
+                summary.add('retried')
+                time.sleep(min(20, (2 ** attempt) * 0.5) * random.uniform(0.5, 1.5))
+    summary.add('failed')
+    return False
+
+def fan_out(client, IPSecSetupLambda, instance_ids, threads, rate, retries, summary=None, trace_id=None, force=False):
+    summary = summary or FanOutSummary()
+    limiter = RateLimiter(rate)
+    trace_id = trace_id or new_trace_id()
+
+    def enroll(instance_id):
+        print("enrolling new certificate on instance " + instance_id)
+        payload = {"detail": {"instance-id": instance_id}, "certificate_only": "true", "trace-id": trace_id}
+        if force:
+            payload['force'] = 'true'
+        invoke(client, limiter, summary, IPSecSetupLambda, json.dumps(payload), retries)
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(enroll, instance_ids))
+    return summary.counts
 
 def lambda_handler(event, context):
 
+    trace = event.get('trace-id') or new_trace_id()
+    start = time.time()
+    try:
+        with tracer.span('reenroll', trace) as span:
+            summary = reenroll(event, trace)
+            span.set('Summary', summary)
+    finally:
+        tracer.record('aws-calls', trace, start, **aws_clients.report())
+    return summary
+
+def reenroll(event, trace):
+
     IPSecSetupLambda=os.environ['IPSecSetupLambda']
     SelectorTagName=os.environ['SelectorTagName']
     SelectorTagValue=os.environ['SelectorTagValue']
+    VpcId=os.environ.get('VpcId', 'any')
     region=os.environ['AWS_REGION']
+    threads=int(os.environ.get('FanOutThreads', '8'))
+    retries=int(os.environ.get('FanOutMaxRetries', '5'))
+    ExpiryTagName=os.environ.get('ExpiryTagName', 'IPSecCertExpiry')
+    window=float(os.environ.get('RenewalWindowDays', '10')) * 86400
+    margin=float(os.environ.get('RenewalMarginDays', '2')) * 86400
+    untagged_hours=int(os.environ.get('UntaggedSpreadHours', '24'))
+    StateTagName=os.environ.get('StateTagName', 'IPSecSetupState')
     
-    print('enrolling new certificates on instances with Tag '+SelectorTagName+':'+SelectorTagValue)
-    
-    ec2 = boto3.client('ec2')
-    response = ec2.describe_instances(
-         Filters=[{"Name":"tag:"+SelectorTagName,"Values":[SelectorTagValue]} ])
+    print('enrolling new certificates on instances with Tag '+SelectorTagName+':'+SelectorTagValue+' trace '+trace)
     
-    for res in response['Reservations']:
-        for i in res['Instances']:
-            print("enrolling new certificate on instance "+ i['InstanceId'])
-                                                         
-            client = boto3.client('lambda')
-            r = client.invoke(
-                 FunctionName=IPSecSetupLambda,    
-                 InvocationType='Event',
-                 LogType='Tail',                 
-                 Payload=json.dumps({ "detail" :  { "instance-id": i['InstanceId']}, "certificate_only":"true"}))
+    ec2 = aws_clients.client('ec2')
+    with tracer.span('list-instances', trace):
+        instances = list_instances(ec2, SelectorTagName, SelectorTagValue, VpcId, ExpiryTagName, StateTagName)
+    in_flight = len([i for i, expiry, busy in instances if busy])
+    if event.get('renew-all'):
+        instance_ids = [i for i, expiry, busy in instances if not busy]
+    else:
+        instance_ids = select_due(instances, time.time(), window, margin, untagged_hours)
+    print('found ' + str(len(instances)) + ' running instances, ' + str(in_flight) + ' with a setup in flight, ' +
+          str(len(instance_ids)) + ' due for renewal')
+
+    summary = FanOutSummary()
+    summary.add('instances', len(instances))
+    summary.add('inflight', in_flight)
+    summary.add('due', len(instance_ids))
+
+    # one client for all invokes, the connection pool sized for the threads. A throttled invoke is retried
+    # by invoke() at the rate of the fan-out, not by botocore
+    client = aws_clients.client('lambda', max_pool_connections=threads, retries={'mode': 'standard', 'total_max_attempts': 1})
+    rate = fan_out_rate(client, IPSecSetupLambda)
+    print('invoking ' + IPSecSetupLambda + ' with ' + str(threads) + ' threads at max ' + str(rate) + ' invokes/s')
+
+    with tracer.span('fan-out', trace, Instances=len(instance_ids)):
+        summary = fan_out(client, IPSecSetupLambda, instance_ids, threads, rate, retries, summary, trace,
+                          bool(event.get('renew-all')))
+    print('enrollment summary ' + json.dumps(summary))
+    return summary
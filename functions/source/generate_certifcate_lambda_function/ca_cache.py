@@ -0,0 +1,98 @@
+"""
+    Warm-container cache of the CA material used by the certificate issuing lambda
+
+   The CA certificate, the encrypted CA key and the decrypted CA key password
+   are kept in process memory across invocations of the same container.
+   An entry is served without any S3/KMS call while it is younger than the TTL,
+   afterwards it is revalidated against the S3 ETags (HeadObject) and only
+   downloaded and decrypted again if one of the objects changed.
+
+   The decrypted password never leaves this process (it is not put in os.environ).
+
+    Copyright 2017-2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+    Licensed under the Apache License, Version 2.0 (the "License").
+    You may not use this file except in compliance with the License.
+    A copy of the License is located at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+   or in the "license" file accompanying this file. This file is distributed
+   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+   express or implied. See the License for the specific language governing
+   permissions and limitations under the License.
+
+"""
+import base64, time
+
+
+class CaMaterial(object):
+    """ CA certificate, encrypted CA key and the decrypted key password """
+
+    def __init__(self, source, cert, key, password, cert_etag, key_etag):
+        self.source = source
+        self.cert = cert
+        self.key = key
+        self.password = password
+        self.cert_etag = cert_etag
+        self.key_etag = key_etag
+        self.loaded = time.time()
+        # CA cert and key objects of the in-process issuer (cert_engine), parsed on first use
+        self.parsed = None
+
+
+class CaCache(object):
+    """ Module level cache of CA material living as long as the lambda container """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entry = None
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+
+    def get(self, s3client, kmsclient, bucket, cacertfile, cakeyfile, capwd):
+        source = (bucket, cacertfile, cakeyfile, capwd)
+        e = self.entry
+
+        if e is not None and e.source == source:
+            if time.time() - e.loaded < self.ttl:
+                self.hits += 1
+                print("CA cache: hit")
+                return e
+
+            print("Revalidating: CA material against S3 ETag")
+            if s3client.head_object(Bucket=bucket, Key=cacertfile)['ETag'] == e.cert_etag and \
+               s3client.head_object(Bucket=bucket, Key=cakeyfile)['ETag'] == e.key_etag:
+                self.revalidations += 1
+                e.loaded = time.time()
+                print("CA cache: revalidated, CA material unchanged")
+                return e
+
+        self.misses += 1
+        print("CA cache: miss")
+
+        print("Downloading: CA certicate")
+        obj = s3client.get_object(Bucket=bucket, Key=cacertfile)
+        cacertificate = obj['Body'].read().decode('utf-8')
+        cert_etag = obj['ETag']
+        print("Downloaded: CA certicate")
+
+        print("Downloading: CA encrypted key")
+        obj = s3client.get_object(Bucket=bucket, Key=cakeyfile)
+        cakey = obj['Body'].read().decode('utf-8')
+        key_etag = obj['ETag']
+        print("Downloaded: CA encrypted key")
+
+        print("Decrypting: CA key password")
+        cakey_password = kmsclient.decrypt(CiphertextBlob=base64.b64decode(capwd))['Plaintext'].decode(encoding="utf-8")
+        print("Decrypted: CA key password")
+
+        self.entry = CaMaterial(source, cacertificate, cakey, cakey_password, cert_etag, key_etag)
+        return self.entry
+
+    def invalidate(self):
+        self.entry = None
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'revalidations': self.revalidations}
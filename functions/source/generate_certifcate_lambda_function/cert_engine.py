@@ -0,0 +1,246 @@
+"""
+    In-process certificate issuance: generates key, signs the certificate with the CA
+    and exports the PKCS12 bundle without forking openssl or writing temp files
+
+   It produces the same certificate profile as genCert.sh
+	  - subject CN=<hostname>, SAN with the private IPs of the instance
+	  - basicConstraints CA:FALSE, keyUsage digitalSignature + keyEncipherment,
+	    subject and authority key identifiers, SHA256, valid 30 days
+	  - PKCS12 with friendly name hostcert (see leftcert in oe-cert.conf),
+	    the CA certificate as chain and AES256 encryption
+
+   sign_request signs a certificate request (CSR) of a key generated on the host instead, with
+   the same profile. The request must be signed with its key, an RSA key of at least
+   MIN_REQUEST_KEY_BITS or an EC key, and may only ask for the hostname and private IPs of the
+   instance. The certificate always carries the hostname and all private IPs of the instance.
+
+   Output is the same JSON structure as genCert.sh
+
+    { 	ERR:  		        error text if exit code not 0,
+	      CERT_PEM_B64:   certifcate in pem format encoded base64,
+	      CERT_P12_B64:	  certificate in p12 format encode64
+    }
+
+   generate_keys generates the keys of a bulk issuance in parallel, one process per CPU.
+
+   Requires the python package cryptography in the lambda package.
+   If it is not available, available() returns False and the caller uses genCert.sh
+
+    Copyright 2017-2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+    Licensed under the Apache License, Version 2.0 (the "License").
+    You may not use this file except in compliance with the License.
+    A copy of the License is located at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+   or in the "license" file accompanying this file. This file is distributed
+   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+   express or implied. See the License for the specific language governing
+   permissions and limitations under the License.
+
+"""
+import base64, datetime, ipaddress, multiprocessing
+
+try:
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa, ec
+    from cryptography.hazmat.primitives.serialization import pkcs12
+except ImportError:
+    x509 = None
+
+KEY_BITS = 4096
+MIN_REQUEST_KEY_BITS = 2048
+VALID_DAYS = 30
+P12_FRIENDLY_NAME = b'hostcert'
+# format of the certificate expiry CERT_NOT_AFTER
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+
+def available():
+    return x509 is not None
+
+
+def load_ca(ca_cert_pem, ca_key_pem, ca_key_password):
+    """ Parses the CA certificate and decrypts the CA key. Returns (cert, key) """
+    cacert = x509.load_pem_x509_certificate(ca_cert_pem.encode('utf-8'), default_backend())
+    cakey = serialization.load_pem_private_key(ca_key_pem.encode('utf-8'), ca_key_password.encode('utf-8'), default_backend())
+    return cacert, cakey
+
+
+def generate_key(key_bits=KEY_BITS):
+    return rsa.generate_private_key(public_exponent=65537, key_size=key_bits, backend=default_backend())
+
+
+def _keygen_worker(conn, count, key_bits):
+    try:
+        conn.send([generate_key(key_bits).private_bytes(serialization.Encoding.DER, serialization.PrivateFormat.PKCS8,
+                                                       serialization.NoEncryption()) for i in range(count)])
+    except Exception as e:
+        print('Key generation worker failed: ' + str(e))
+    conn.close()
+
+
+def generate_keys(count, key_bits=KEY_BITS, workers=None):
+    """ Generates count keys in up to workers processes (default: one per CPU). Uses processes and pipes,
+        multiprocessing.Pool and Queue need /dev/shm which AWS Lambda does not have. Keys of a failed
+        worker are generated in this process """
+    workers = min(count, workers or multiprocessing.cpu_count())
+    keys = []
+    if workers > 1:
+        jobs = []
+        for w in range(workers):
+            receiver, sender = multiprocessing.Pipe(False)
+            p = multiprocessing.Process(target=_keygen_worker, args=(sender, count // workers + (1 if w < count % workers else 0), key_bits))
+            p.start()
+            sender.close()
+            jobs.append((p, receiver))
+        for p, receiver in jobs:
+            try:
+                keys += [serialization.load_der_private_key(der, None, default_backend()) for der in receiver.recv()]
+            except EOFError:
+                pass
+            p.join()
+    while len(keys) < count:
+        keys.append(generate_key(key_bits))
+    return keys
+
+
+def dump_key(key, password):
+    """ PKCS8 PEM of the key encrypted with password, format of the key pool """
+    return key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                             serialization.BestAvailableEncryption(password.encode('utf-8')))
+
+
+def load_key(pem, password):
+    return serialization.load_pem_private_key(pem, password.encode('utf-8'), default_backend())
+
+
+def _authority_key_identifier(cacert):
+    try:
+        ski = cacert.extensions.get_extension_for_class(x509.SubjectKeyIdentifier).value
+        return x509.AuthorityKeyIdentifier.from_issuer_subject_key_identifier(ski)
+    except x509.ExtensionNotFound:
+        return x509.AuthorityKeyIdentifier.from_issuer_public_key(cacert.public_key())
+
+
+def sign(cacert, cakey, hostname, ip_addresses, public_key, valid_days=VALID_DAYS):
+    """ Signs the host certificate for public_key. Returns x509 certificate """
+    now = datetime.datetime.utcnow()
+    builder = x509.CertificateBuilder() \
+        .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, hostname)])) \
+        .issuer_name(cacert.subject) \
+        .public_key(public_key) \
+        .serial_number(x509.random_serial_number()) \
+        .not_valid_before(now) \
+        .not_valid_after(now + datetime.timedelta(days=valid_days)) \
+        .add_extension(x509.SubjectKeyIdentifier.from_public_key(public_key), critical=False) \
+        .add_extension(_authority_key_identifier(cacert), critical=False) \
+        .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=False) \
+        .add_extension(x509.KeyUsage(digital_signature=True, content_commitment=False, key_encipherment=True,
+                                     data_encipherment=False, key_agreement=False, key_cert_sign=False,
+                                     crl_sign=False, encipher_only=False, decipher_only=False), critical=False)
+    if ip_addresses:
+        builder = builder.add_extension(
+            x509.SubjectAlternativeName([x509.IPAddress(ipaddress.ip_address(ip)) for ip in ip_addresses]), critical=False)
+
+    return builder.sign(private_key=cakey, algorithm=hashes.SHA256(), backend=default_backend())
+
+
+def describe(pem):
+    """ Serial number (hex as openssl prints it) and expiry (UTC TIME_FORMAT) of a PEM certificate """
+    cert = x509.load_pem_x509_certificate(pem, default_backend())
+    # cryptography >= 42 deprecates the naive datetime
+    not_after = getattr(cert, 'not_valid_after_utc', None) or cert.not_valid_after
+    serial = '%X' % cert.serial_number
+    return ('0' * (len(serial) % 2)) + serial, not_after.strftime(TIME_FORMAT)
+
+
+def _p12_encryption(export_password):
+    password = export_password.encode('utf-8')
+    try:
+        # PBES2 AES-256-CBC for key and certs, as openssl pkcs12 -aes256
+        return serialization.PrivateFormat.PKCS12.encryption_builder() \
+            .kdf_rounds(2048) \
+            .key_cert_algorithm(pkcs12.PBES.PBESv2SHA256AndAES256CBC) \
+            .hmac_hash(hashes.SHA256()) \
+            .build(password)
+    except AttributeError:
+        # cryptography < 38
+        return serialization.BestAvailableEncryption(password)
+
+
+def export_p12(key, cert, cacert, export_password):
+    return pkcs12.serialize_key_and_certificates(P12_FRIENDLY_NAME, key, cert, [cacert], _p12_encryption(export_password))
+
+
+def check_request(csr, hostname, ip_addresses):
+    """ Validates a certificate request of the host. Returns the error text, empty if valid """
+    if not csr.is_signature_valid:
+        return "The signature of the request does not match its key"
+    key = csr.public_key()
+    if isinstance(key, rsa.RSAPublicKey):
+        if key.key_size < MIN_REQUEST_KEY_BITS:
+            return "RSA key of the request has " + str(key.key_size) + " bits, at least " + str(MIN_REQUEST_KEY_BITS) + " required"
+    elif not isinstance(key, ec.EllipticCurvePublicKey):
+        return "Key type of the request is not supported"
+    names = [a.value for a in csr.subject.get_attributes_for_oid(NameOID.COMMON_NAME)]
+    if [n for n in names if n != hostname]:
+        return "Request for " + ",".join(names) + " does not match the hostname " + hostname
+    try:
+        san = csr.extensions.get_extension_for_class(x509.SubjectAlternativeName).value
+    except x509.ExtensionNotFound:
+        return ""
+    allowed = [x509.IPAddress(ipaddress.ip_address(ip)) for ip in ip_addresses] + [x509.DNSName(hostname)]
+    foreign = [str(n.value) for n in san if n not in allowed]
+    if foreign:
+        return "Request asks for names the instance does not have: " + ",".join(foreign)
+    return ""
+
+
+def sign_request(cacert, cakey, hostname, ip_addresses, csr_der):
+    """ Signs a certificate request (DER) of a key generated on the host.
+        Returns JSON structure as genCert.sh without PKCS12 """
+    try:
+        csr = x509.load_der_x509_csr(csr_der, default_backend())
+        err = check_request(csr, hostname, ip_addresses)
+    except Exception as e:
+        err = "Can not read the request: " + str(e)
+    if err:
+        return {"ERR": err, "CERT_PEM_B64": "", "CERT_P12_B64": ""}
+
+    try:
+        cert = sign(cacert, cakey, hostname, ip_addresses, csr.public_key())
+    except Exception as e:
+        return {"ERR": "Can not sign the request: " + str(e), "CERT_PEM_B64": "", "CERT_P12_B64": ""}
+
+    return {"ERR": "",
+            "CERT_PEM_B64": base64.b64encode(cert.public_bytes(serialization.Encoding.PEM)).decode('utf-8'),
+            "CERT_P12_B64": ""}
+
+
+def issue(cacert, cakey, hostname, ip_addresses, export_password, key_bits=KEY_BITS, key=None):
+    """ Generates key (unless a pre-generated key is given) and certificate and exports them.
+        Returns JSON structure as genCert.sh """
+    try:
+        if key is None:
+            key = generate_key(key_bits)
+    except Exception as e:
+        return {"ERR": "Can not generate certificate key: " + str(e), "CERT_PEM_B64": "", "CERT_P12_B64": ""}
+
+    try:
+        cert = sign(cacert, cakey, hostname, ip_addresses, key.public_key())
+    except Exception as e:
+        return {"ERR": "Can not sign the request: " + str(e), "CERT_PEM_B64": "", "CERT_P12_B64": ""}
+
+    try:
+        p12 = export_p12(key, cert, cacert, export_password)
+    except Exception as e:
+        return {"ERR": "Can not export the certificate to PKCS12: " + str(e), "CERT_PEM_B64": "", "CERT_P12_B64": ""}
+
+    return {"ERR": "",
+            "CERT_PEM_B64": base64.b64encode(cert.public_bytes(serialization.Encoding.PEM)).decode('utf-8'),
+            "CERT_P12_B64": base64.b64encode(p12).decode('utf-8')}
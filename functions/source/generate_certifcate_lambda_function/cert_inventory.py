@@ -0,0 +1,163 @@
+"""
+    Inventory of the issued host certificates, maintained at issuance time, so that the current
+    certificate of an instance or the certificates expiring in a period are found without
+    listing the certificates bucket and parsing every PEM
+
+   Layout in the store (CERTS_BUCKET under INVENTORY_PREFIX, or a local folder as stand-in)
+	  latest/<instance-id>.json           - record of the newest certificate of the instance
+	  manifest/<YYYY-MM-DD>/<serial>.json - record of each certificate, sharded by the day of notAfter
+	  manifest/<YYYY-MM-DD>.jsonl         - compacted shard, one record per line
+
+   A record is
+    {   serial:        certificate serial number (hex),
+        instance-id:   instance the certificate was issued for,
+        hostname:      subject CN,
+        sans:          IP addresses in the subject alternative name,
+        notAfter:      expiry, UTC YYYY-MM-DDTHH:MM:SSZ,
+        issued:        issuance time, UTC YYYY-MM-DDTHH:MM:SSZ,
+        pem:           key of the certificate in the certificates bucket
+    }
+
+   An issuance writes two small objects and reads none, so concurrent issuers do not conflict.
+   compact() (scheduled daily) merges the records of each shard into its .jsonl and removes the
+   shards and latest pointers of certificates expired longer than the retention.
+
+    Copyright 2017-2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+    Licensed under the Apache License, Version 2.0 (the "License").
+    You may not use this file except in compliance with the License.
+    A copy of the License is located at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+   or in the "license" file accompanying this file. This file is distributed
+   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+   express or implied. See the License for the specific language governing
+   permissions and limitations under the License.
+
+"""
+import json, time, calendar
+
+LATEST = 'latest/'
+MANIFEST = 'manifest/'
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+DAY = 86400
+
+
+def epoch(timestamp):
+    return calendar.timegm(time.strptime(timestamp, TIME_FORMAT))
+
+
+def day(seconds):
+    return time.strftime('%Y-%m-%d', time.gmtime(seconds))
+
+
+class CertInventory(object):
+
+    def __init__(self, store, retention_days=90):
+        self.store = store
+        self.retention_days = retention_days
+
+    def record(self, instance_id, hostname, sans, serial, not_after, pem_key, issued=None):
+        """ Adds an issued certificate and makes it the latest of the instance. Returns the record """
+        entry = {'serial': serial, 'instance-id': instance_id, 'hostname': hostname, 'sans': list(sans),
+                 'notAfter': not_after, 'issued': issued or time.strftime(TIME_FORMAT, time.gmtime()), 'pem': pem_key}
+        data = json.dumps(entry, sort_keys=True).encode('utf-8')
+        self.store.put(MANIFEST + not_after[:10] + '/' + serial + '.json', data)
+        self.store.put(LATEST + instance_id + '.json', data)
+        return entry
+
+    def latest(self, instance_id):
+        """ Record of the newest certificate of the instance or None """
+        data = self.store.get(LATEST + instance_id + '.json')
+        return json.loads(data.decode('utf-8')) if data is not None else None
+
+    def shard(self, date):
+        """ Records of the certificates expiring on date (YYYY-MM-DD), compacted and new """
+        records = {}
+        data = self.store.get(MANIFEST + date + '.jsonl')
+        if data is not None:
+            for line in data.decode('utf-8').splitlines():
+                if line:
+                    r = json.loads(line)
+                    records[r['serial']] = r
+        for name in self.store.list(MANIFEST + date + '/'):
+            if name.endswith('.json'):
+                data = self.store.get(MANIFEST + date + '/' + name)
+                if data is not None:
+                    r = json.loads(data.decode('utf-8'))
+                    records[r['serial']] = r
+        return records
+
+    def expiring(self, start, end):
+        """ Records of the certificates with notAfter in [start, end) (epoch seconds), by expiry """
+        found = []
+        d = start - start % DAY
+        while d < end:
+            found += [r for r in self.shard(day(d)).values() if start <= epoch(r['notAfter']) < end]
+            d += DAY
+        return sorted(found, key=lambda r: (r['notAfter'], r['serial']))
+
+    def shards(self):
+        """ Dates of all shards """
+        dates = set()
+        for name in self.store.list(MANIFEST):
+            if name.endswith('.jsonl'):
+                dates.add(name[:-len('.jsonl')])
+            elif '/' in name:
+                dates.add(name.split('/', 1)[0])
+        return sorted(dates)
+
+    def compact(self, now=None, budget=None):
+        """ Merges new records into the compacted shards, removes expired shards.
+            Stops after budget seconds, the next run continues. Returns stats """
+        started = time.time()
+        now = now or started
+        oldest = day(now - self.retention_days * DAY)
+        stats = {'shards': 0, 'merged': 0, 'removed_shards': 0, 'removed_latest': 0}
+        for date in self.shards():
+            if budget is not None and time.time() - started > budget:
+                break
+            stats['shards'] += 1
+            new = [n for n in self.store.list(MANIFEST + date + '/') if n.endswith('.json')]
+            if date < oldest:
+                records = self.shard(date)
+                # an instance whose latest certificate expired long ago is gone
+                for r in records.values():
+                    latest = self.latest(r['instance-id'])
+                    if latest is not None and latest['serial'] == r['serial']:
+                        self.store.delete(LATEST + r['instance-id'] + '.json')
+                        stats['removed_latest'] += 1
+                self.store.delete(MANIFEST + date + '.jsonl')
+                stats['removed_shards'] += 1
+            elif new:
+                records = self.shard(date)
+                self.store.put(MANIFEST + date + '.jsonl', ''.join(
+                    json.dumps(r, sort_keys=True) + '\n' for s, r in sorted(records.items())).encode('utf-8'))
+                stats['merged'] += len(new)
+            # records written after the shard was read stay for the next run
+            for name in new:
+                self.store.delete(MANIFEST + date + '/' + name)
+        return stats
+
+
+if __name__ == '__main__':
+    import argparse
+    from object_store import LocalStore
+
+    p = argparse.ArgumentParser(description="Queries and compacts a local certificate inventory")
+    p.add_argument("--folder", required=True, help="Folder of the inventory (local copy of the inventory prefix)")
+    p.add_argument("--retention-days", type=int, default=90, help="Days expired certificates are kept (default:90)")
+    sub = p.add_subparsers(dest='command')
+    sub.add_parser('latest').add_argument('instance_id')
+    sub.add_parser('expiring').add_argument('--days', type=int, default=30)
+    sub.add_parser('compact')
+    args = p.parse_args()
+
+    inventory = CertInventory(LocalStore(args.folder), args.retention_days)
+    if args.command == 'latest':
+        print(json.dumps(inventory.latest(args.instance_id), indent=2, sort_keys=True))
+    elif args.command == 'expiring':
+        print(json.dumps(inventory.expiring(time.time(), time.time() + args.days * DAY), indent=2, sort_keys=True))
+    else:
+        print(json.dumps(inventory.compact()))
@@ -0,0 +1,119 @@
+"""
+    Envelope encryption of the P12 export password with a cached KMS data key
+
+   A 512 bit data key is generated with KMS (GenerateDataKey on P12_CMS_KEYID) once per
+   container and rotation period and kept in process memory. Each password is encrypted
+   locally, the first 256 bits of the data key encrypt it with AES-256-CBC, the last 256 bits
+   authenticate IV and ciphertext with HMAC-SHA256. Issuing a certificate makes no KMS call
+   while the data key is cached, the host decrypts the data key with one KMS call and the
+   password with openssl (see setup_ipsec.sh).
+
+   The sealed password is returned in the fields
+	  CERT_P12_DATA_KEY      - KMS encrypted data key (CiphertextBlob), base64
+	  CERT_P12_PWD_IV        - AES IV, hex
+	  CERT_P12_ENVELOPE_PWD  - AES-256-CBC (PKCS7 padding) encrypted password, base64
+	  CERT_P12_PWD_MAC       - HMAC-SHA256 of "<CERT_P12_PWD_IV>.<CERT_P12_ENVELOPE_PWD>", hex
+
+   AES runs in-process with the package cryptography if available, otherwise with openssl.
+
+    Copyright 2017-2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+    Licensed under the Apache License, Version 2.0 (the "License").
+    You may not use this file except in compliance with the License.
+    A copy of the License is located at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+   or in the "license" file accompanying this file. This file is distributed
+   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+   express or implied. See the License for the specific language governing
+   permissions and limitations under the License.
+
+"""
+import base64, binascii, hashlib, hmac, os, subprocess, time
+
+try:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import padding
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+except ImportError:
+    Cipher = None
+
+
+class DataKey(object):
+    """ Plaintext and KMS encrypted data key """
+
+    def __init__(self, key_id, plaintext, blob):
+        self.key_id = key_id
+        self.plaintext = plaintext
+        self.blob = blob
+        self.created = time.time()
+
+
+class DataKeyCache(object):
+    """ Module level data key living as long as the lambda container, renewed after ttl seconds """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.entry = None
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, kmsclient, key_id):
+        e = self.entry
+        if e is not None and e.key_id == key_id and time.time() - e.created < self.ttl:
+            self.hits += 1
+            return e
+
+        self.misses += 1
+        print("Generating: data key with KMS")
+        r = kmsclient.generate_data_key(KeyId=key_id, NumberOfBytes=64)
+        print("Generated: data key")
+        self.entry = DataKey(key_id, r['Plaintext'], r['CiphertextBlob'])
+        return self.entry
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+def _aes_cbc(key, iv, data, decrypt=False):
+    if Cipher is not None:
+        cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend())
+        if decrypt:
+            d = cipher.decryptor()
+            unpadder = padding.PKCS7(128).unpadder()
+            return unpadder.update(d.update(data) + d.finalize()) + unpadder.finalize()
+        padder = padding.PKCS7(128).padder()
+        e = cipher.encryptor()
+        return e.update(padder.update(data) + padder.finalize()) + e.finalize()
+
+    p = subprocess.Popen(['openssl', 'enc', '-aes-256-cbc'] + (['-d'] if decrypt else []) +
+                         ['-K', binascii.hexlify(key).decode('ascii'), '-iv', binascii.hexlify(iv).decode('ascii')],
+                         stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    out = p.communicate(data)[0]
+    if p.returncode != 0:
+        raise Exception('Error in execution of openssl enc with exit code:' + str(p.returncode))
+    return out
+
+
+def _mac(data_key, iv_hex, ciphertext):
+    return hmac.new(data_key.plaintext[32:], (iv_hex + '.' + ciphertext).encode('ascii'), hashlib.sha256).hexdigest()
+
+
+def seal(data_key, password):
+    """ Encrypts the password (str) with the data key. Returns the CERT_P12_ fields """
+    iv = os.urandom(16)
+    iv_hex = binascii.hexlify(iv).decode('ascii')
+    ciphertext = base64.b64encode(_aes_cbc(data_key.plaintext[:32], iv, password.encode('utf-8'))).decode('ascii')
+    return {'CERT_P12_DATA_KEY': base64.b64encode(data_key.blob).decode('ascii'),
+            'CERT_P12_PWD_IV': iv_hex,
+            'CERT_P12_ENVELOPE_PWD': ciphertext,
+            'CERT_P12_PWD_MAC': _mac(data_key, iv_hex, ciphertext)}
+
+
+def unseal(data_key, fields):
+    """ Decrypts the password of the CERT_P12_ fields with the plaintext data key """
+    if not hmac.compare_digest(_mac(data_key, fields['CERT_P12_PWD_IV'], fields['CERT_P12_ENVELOPE_PWD']), fields['CERT_P12_PWD_MAC']):
+        raise Exception('Sealed password does not match its MAC')
+    return _aes_cbc(data_key.plaintext[:32], binascii.unhexlify(fields['CERT_P12_PWD_IV']),
+                    base64.b64decode(fields['CERT_P12_ENVELOPE_PWD']), decrypt=True).decode('utf-8')
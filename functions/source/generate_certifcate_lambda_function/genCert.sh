@@ -7,6 +7,14 @@
 #   Input 
 #	- command line hostname
 #	- enviroment variable CA_CERT, CA_KEY, CA_PWD, EXPORT_PWD, SAN
+#	- optional enviroment variable CERT_WORK_DIR, working folder (default /tmp)
+#	- optional enviroment variable CERT_REQ_B64, certificate request (DER, base64) of a key
+#	  generated on the host. It is signed instead of generating a key, CERT_EXPORT_PWD is not
+#	  needed and CERT_P12_B64 is empty. The request is checked as cert_engine.check_request
+#	  does: its signature, an RSA key of at least 2048 bits, no common name other than the
+#	  hostname and no alternative name other than those of CERT_REQ_ALLOWED (the names of the
+#	  instance as openssl prints them, IPAddress:10.0.0.4,DNS:<hostname>). The certificate gets
+#	  the subject /CN=<hostname> and the SAN of the instance (SAN), not the names of the request
 #
 #   Output is JSON structure containing
 #
@@ -84,13 +92,13 @@ emailAddress            = optional
 
 '
 
-if [[ -z "${CA_CERT}" ]] || [[ -z "${CA_KEY}" ]]  || [[ -z "${CERT_EXPORT_PWD}" ]] ; then
+if [[ -z "${CA_CERT}" ]] || [[ -z "${CA_KEY}" ]]  || [[ -z "${CERT_EXPORT_PWD}${CERT_REQ_B64}" ]] ; then
     print "{ \"ERR\":\"Some env variables not defined \", \"CERT_PEM_B64\":\"\",\"CERT_P12_B64\":\"\" }"
     exit 5
 fi
 
-# write on to temp (TO DO can wire write elsewhere)
-cd /tmp
+# write on to temp or CERT_WORK_DIR
+cd "${CERT_WORK_DIR:-/tmp}"
 printf "%016x\n" $RANDOM$RANDOM$RANDOM > serial
 rm index.txt
 touch index.txt
@@ -98,6 +106,60 @@ echo "$openssl" > ./openssl.conf
 echo "$CA_CERT" > ./ca.cert.pem
 echo "$CA_KEY"  > ./ca.cert.key.pem
 
+if [[ -n "${CERT_REQ_B64}" ]]; then
+    # Verifying the request of the host, RSA keys of at least 2048 bits or EC keys as cert_engine.check_request
+    echo "$CERT_REQ_B64" | base64 -d > ./req.der && \
+    openssl req -inform DER -in ./req.der -verify -out ./req.pem > /dev/null 2>&1
+    if [ $? -ne 0 ]; then
+        printf "{ \"ERR\":\"The signature of the request does not match its key\", \"CERT_PEM_B64\":\"\",\"CERT_P12_B64\":\"\" }"
+        rm *
+        exit 4
+    fi
+    text=`openssl req -in ./req.pem -noout -text`
+    algorithm=`echo "$text" | sed -n 's/^ *Public Key Algorithm: *//p' | head -1`
+    bits=`echo "$text" | grep -o 'Public-Key: ([0-9]*' | tr -dc 0-9`
+    case "$algorithm" in
+        rsaEncryption)
+            if [ "${bits:-0}" -lt 2048 ]; then
+                printf "{ \"ERR\":\"RSA key of the request has ${bits:-0} bits, at least 2048 required\", \"CERT_PEM_B64\":\"\",\"CERT_P12_B64\":\"\" }"
+                rm *
+                exit 4
+            fi ;;
+        id-ecPublicKey) ;;
+        *)
+            printf "{ \"ERR\":\"Key type of the request is not supported\", \"CERT_PEM_B64\":\"\",\"CERT_P12_B64\":\"\" }"
+            rm *
+            exit 4 ;;
+    esac
+
+    # The request may only ask for the hostname and the names of the instance
+    foreign=`openssl req -in ./req.pem -noout -subject -nameopt multiline | sed -n 's/^ *commonName *= //p' | grep -vxF "$hostname"`
+    san=`echo "$text" | sed -n '/X509v3 Subject Alternative Name/{n;p;}' | tr -d ' '`
+    for name in ${san//,/ }; do
+        case ",${CERT_REQ_ALLOWED}," in
+            *",$name,"*) ;;
+            *) foreign="$foreign $name" ;;
+        esac
+    done
+    if [ -n "$foreign" ]; then
+        printf "{ \"ERR\":\"Request asks for names the instance does not have\", \"CERT_PEM_B64\":\"\",\"CERT_P12_B64\":\"\" }"
+        rm *
+        exit 4
+    fi
+
+    openssl ca -config ./openssl.conf -in ./req.pem -subj "/CN=$hostname" -out ./cert.pem -batch  -passin pass:$CA_PWD_DECRYPTED > /dev/null
+    if [ $? -ne 0 ]; then
+        printf "{ \"ERR\":\"Can not sign the request\", \"CERT_PEM_B64\":\"\",\"CERT_P12_B64\":\"\" }"
+        rm *
+        exit 2
+    fi
+
+    cert_pem_b64=`base64 ./cert.pem`
+    echo '{ "ERR":"", "CERT_PEM_B64":"'$cert_pem_b64'","CERT_P12_B64":"" }'
+    rm *
+    exit 0
+fi
+
 # Generating key and cert request
 openssl req -new -newkey rsa:4096 -nodes -subj "/CN=$hostname" -out ./req.pem -keyout ./key.pem -config ./openssl.conf > /dev/null
 # Using ECDSA when libreswan supports it 
@@ -1,18 +1,60 @@
 """
     Certificate encrolling function: generates key, certificate request and issues/signs with CA
 
-   This is a wraper around bash function that issues certifcate 
-   and uploads certificate to predefined bucket
+   The certificate is issued by one of two engines, chosen by ISSUER_ENGINE (see use_engine): python
+   generates the key and signs in-process with package cryptography (cert_engine.py, with the key pool
+   and the parallel bulk key generation), openssl runs the bash script genCert.sh. auto takes python
+   if cryptography is in the lambda package, otherwise openssl. Both upload the certificate to
+   CERTS_BUCKET and record it in the certificate inventory
 
    Input 
 	  - instance-id   (instance_id)
+	  - csr (optional) - certificate request (DER, base64) of a key generated on the host. Only
+	                  signed (see cert_engine.sign_request), no key, no PKCS12 and no export password
+	  - instance-ids (instead of instance-id) - bulk issuance, see below
+	  - csrs (optional, with instance-ids) - certificate requests keyed by instance id
+	  - trace-id, parent-id (optional) - trace and span of the caller, see tracing.py. The stages
+	                  ca-cache, kms, describe-instance, sign (key-pool, keygen), upload and inventory
+	                  are emitted as EMF spans of the stage issue (issue-bulk for instance-ids)
 	  - enviroment variable to set: 
 	      CA_BUCKET     - the bucket of CA signing cert
 	      CA_FILE       - the key (aka file) where the CA cert is
 	      CA_KEY_FILE   - file with CA private key 
 	      CA_PWD        - password for the CA private key KMS encrypted
 	      CERTS_BUCKET  - bucket where the certs will be updaloed 
+	      INVENTORY_PREFIX, INVENTORY_RETENTION_DAYS
+	                    - prefix of the certificate inventory in CERTS_BUCKET and days expired
+	                      certificates are kept in it (optional, default inventory/, 90)
 	      P12_CMS_KEYID - CMS KeyId to encrypt the P12 export password
+	      P12_PWD_ENVELOPE, DATA_KEY_TTL
+	                    - true encrypts the P12 export password locally with a KMS data key that is
+	                      reused for DATA_KEY_TTL seconds, see envelope.py (optional, default false, 3600)
+	      CA_CACHE_TTL  - seconds the CA material is reused in a warm container before
+	                      it is revalidated against S3 ETag (optional, default 300)
+	      ISSUER_ENGINE - python (in-process, needs package cryptography), openssl (genCert.sh)
+	                      or auto - python if available otherwise openssl, with a warning in the log
+	                      (optional, default auto)
+	      KEY_POOL_BUCKET - bucket of the pre-generated key pool, used by the python engine. Set
+	                      without package cryptography every invocation fails
+	                      (optional, default empty - no pool, the key is generated per certificate)
+	      KEY_POOL_PREFIX, KEY_POOL_SIZE, KEY_POOL_LOW_WATER, KEY_POOL_MAX_AGE
+	                    - key prefix, keys to keep ready, refill threshold and max key age in seconds
+	                      (optional, default keypool/, 20, 5, 86400)
+	      CLAIMS_TABLE  - DynamoDB table the keys of the pool are claimed in, needed with KEY_POOL_BUCKET
+	                      (hash key k, TTL attribute e), see object_store.py
+	      BULK_WORKERS  - processes generating the keys (python engine) or openssl scripts running
+	                      at once of a bulk issuance (optional, default 0 - one per CPU)
+	      CLIENT_*      - settings of the AWS clients, created once per container (see aws_clients.py).
+	                      The calls of each invocation are emitted as the span aws-calls
+
+   Event {"key-pool": "refill"} (scheduled) tops the key pool up instead of issuing a certificate
+   Events {"inventory": "latest", "instance-id": ...}, {"inventory": "expiring", "days": 30} look up
+   the certificate inventory (see cert_inventory.py), {"inventory": "compact"} (scheduled) compacts it
+
+   Event {"instance-ids": [...]} issues the certificates of several instances in one invocation: one
+   DescribeInstances, the CA loaded once and the keys generated in parallel. Output is
+   {"results": {instance-id: output as below}, "issued": n, "failed": n}, an instance that failed
+   has only ERR in its output and does not fail the others
 
    Output is JSON structure containing
 
@@ -20,6 +62,11 @@
 	      CERT_PEM_B64:          	certifcate in pem format encoded base64,
 	      CERT_P12_B64:	          certificate in p12 format encode64
 	      CERT_P12_ENCRYPTED_PWD  // encrypted P12 password (CiphertextBlob) with P12_CMS_KEYID
+	      CERT_P12_DATA_KEY, CERT_P12_PWD_IV, CERT_P12_ENVELOPE_PWD, CERT_P12_PWD_MAC
+	                              // instead of CERT_P12_ENCRYPTED_PWD if P12_PWD_ENVELOPE is true
+	      CERT_NOT_AFTER          // expiry of the certificate, UTC YYYY-MM-DDTHH:MM:SSZ
+	      CERT_CA_PEM_B64         // CA certificate in pem format encoded base64, instead of the
+	                              // P12 fields if a csr was given
 	   
     }
 
@@ -37,12 +84,206 @@
    permissions and limitations under the License.
    
 """
-import subprocess,os, base64,json, datetime
-import boto3
+import subprocess,os, base64,json, datetime, time, shutil, tempfile, ipaddress
+from concurrent.futures import ThreadPoolExecutor
+import aws_clients
+from ca_cache import CaCache
+import cert_engine
+from key_pool import KeyPool, S3KeyPoolStore
+from object_store import S3Store
+from cert_inventory import CertInventory
+from tracing import Tracer, new_trace_id
+import envelope
+
+# CA cert, encrypted key and decrypted password survive between invocations of a warm container
+ca_cache = CaCache(int(os.environ.get('CA_CACHE_TTL', '300')))
+tracer = Tracer('GenerateCertificate')
+# data key of the envelope encryption of the P12 export passwords
+data_keys = envelope.DataKeyCache(int(os.environ.get('DATA_KEY_TTL', '3600')))
+
+def use_engine():
+    engine = os.environ.get('ISSUER_ENGINE', 'auto')
+    if engine != 'openssl' and not cert_engine.available():
+        # the key pool and the parallel key generation need the python engine, no silent fallback
+        if engine == 'python':
+            raise Exception('ISSUER_ENGINE is python but package cryptography is not in the lambda package')
+        if os.environ.get('KEY_POOL_BUCKET', ''):
+            raise Exception('KEY_POOL_BUCKET is set but package cryptography, needed by the key pool, is not in the lambda package')
+        print('Warning: ISSUER_ENGINE is auto but package cryptography is not in the lambda package, issuing with openssl')
+    return engine != 'openssl' and cert_engine.available()
+
+def ca_keys(ca):
+    # parsed CA cert and decrypted key are kept with the cached CA material
+    if ca.parsed is None:
+        ca.parsed = cert_engine.load_ca(ca.cert, ca.key, ca.password)
+    return ca.parsed
+
+def key_pool(s3client, ca):
+    # pooled keys are encrypted with the CA key password, only this lambda can decrypt it
+    if os.environ.get('KEY_POOL_BUCKET', '') == '':
+        return None
+    store = S3KeyPoolStore(s3client, os.environ['KEY_POOL_BUCKET'], os.environ.get('KEY_POOL_PREFIX', 'keypool/'),
+                           aws_clients.client('dynamodb'), os.environ.get('CLAIMS_TABLE', ''))
+    return KeyPool(store, ca.password,
+                   size=int(os.environ.get('KEY_POOL_SIZE', '20')),
+                   low_water=int(os.environ.get('KEY_POOL_LOW_WATER', '5')),
+                   max_age=int(os.environ.get('KEY_POOL_MAX_AGE', '86400')))
+
+def openssl_name(ip):
+    # IP alternative name as openssl prints it (without spaces), IPv6 uncompressed in upper case
+    address = ipaddress.ip_address(ip)
+    if address.version == 6:
+        return "IPAddress:" + ":".join("%X" % int(g, 16) for g in address.exploded.split(":"))
+    return "IPAddress:" + str(address)
+
+def issue_with_openssl(hostname, ips, ca, exportpassword, workdir=None, csr=None):
+    # the CA material is passed only to the openssl script, not kept in os.environ
+    env = dict(os.environ)
+    env['CA_CERT'] = ca.cert
+    env['CA_KEY'] = ca.key
+    env['CA_PWD_DECRYPTED'] = ca.password
+    env['CERT_EXPORT_PWD'] = exportpassword
+    if csr:
+        env['CERT_REQ_B64'] = csr
+        env['CERT_REQ_ALLOWED'] = ",".join([openssl_name(ip) for ip in ips] + ["DNS:" + hostname])
+    env['SAN'] = ",".join(["IP:" + ip for ip in ips])
+    if workdir:
+        env['CERT_WORK_DIR'] = workdir
+
+    p = subprocess.Popen('bash ./genCert.sh '+ hostname, shell=True, stdout=subprocess.PIPE, env=env,
+                         cwd=os.path.dirname(os.path.abspath(__file__)))
+    out = p.communicate()[0]
+
+    if p.returncode != 0: 
+        # the script prints why it failed in ERR, a rejected request says what is wrong with it
+        try:
+            err = json.loads(out.decode(encoding="utf-8"))['ERR']
+        except Exception:
+            err = out.decode(encoding="utf-8", errors="replace").strip()
+        raise Exception('Error in execution of openssl script with exit code:' + str(p.returncode) + ': ' + err)
+
+    print("Converting: script output to JSON");
+    return json.loads(out.decode(encoding="utf-8").replace(" ",""))
+
+def export_password(kmsclient, p12_cms_keyid, span):
+    # random P12 export password, returns it and its encrypted form for the host
+    if os.environ.get('P12_PWD_ENVELOPE', 'false') == 'true':
+        # no KMS call while the data key is cached
+        exportpassword=base64.b64encode(os.urandom(128)).decode(encoding="utf-8")
+        p12_pwd=envelope.seal(data_keys.get(kmsclient, p12_cms_keyid), exportpassword)
+        span.set('DataKeyStats', data_keys.stats())
+        print("Encrypted: export password with data key " + json.dumps(data_keys.stats()))
+        return exportpassword, p12_pwd
+
+    print("Generating: export password with KMS (128 Bytes)"); 
+    random=kmsclient.generate_random(NumberOfBytes=128)
+    exportpassword=base64.b64encode(random[u'Plaintext']).decode(encoding="utf-8")
+    print("Generated: export password"); 
+
+    print("Encrypting: password with KMS"); 
+    p12_pwd={'CERT_P12_ENCRYPTED_PWD': base64.b64encode(kmsclient.encrypt(KeyId=p12_cms_keyid, Plaintext=exportpassword)[
+        'CiphertextBlob']).decode(encoding="utf-8")}
+    print("Encrypted: export password with KMS"); 
+    return exportpassword, p12_pwd
+
+def describe_hosts(ec2client, instance_ids):
+    # hostname and private IPs by instance id, one DescribeInstances per 1000 instances.
+    # An unknown id fails the whole call, the ids are then described one by one
+    hosts = {}
+    for start in range(0, len(instance_ids), 1000):
+        chunk = instance_ids[start:start + 1000]
+        try:
+            reservations = ec2client.describe_instances(InstanceIds=chunk)['Reservations']
+        except Exception as e:
+            if len(chunk) == 1 or 'InvalidInstanceID' not in str(e):
+                raise
+            for instance_id in chunk:
+                try:
+                    hosts.update(describe_hosts(ec2client, [instance_id]))
+                except Exception as e:
+                    print("Describing instance " + instance_id + " failed: " + str(e))
+            continue
+        for r in reservations:
+            for i in r['Instances']:
+                hosts[i['InstanceId']] = (i['PrivateDnsName'], [net['PrivateIpAddress'] for int in i['NetworkInterfaces']
+                                                                for net in int['PrivateIpAddresses']])
+    return hosts
+
+def certificate_info(pem):
+    # serial and expiry for the inventory and the expiry-aware renewal. Returns (serial, notAfter)
+    if cert_engine.available():
+        return cert_engine.describe(pem)
+    p = subprocess.Popen(['openssl', 'x509', '-noout', '-serial', '-enddate'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    out = p.communicate(pem)[0]
+    if p.returncode != 0:
+        raise Exception('Error in reading the certificate serial and expiry with exit code:' + str(p.returncode))
+    # serial=0A1B...
+    # notAfter=Nov 17 08:00:00 2018 GMT
+    values = dict(line.split('=', 1) for line in out.decode('utf-8').splitlines() if '=' in line)
+    return values['serial'].strip(), time.strftime(cert_engine.TIME_FORMAT, time.strptime(values['notAfter'].strip(), '%b %d %H:%M:%S %Y %Z'))
+
+def inventory(s3client):
+    return CertInventory(S3Store(s3client, os.environ['CERTS_BUCKET'], os.environ.get('INVENTORY_PREFIX', 'inventory/')),
+                         int(os.environ.get('INVENTORY_RETENTION_DAYS', '90')))
+
+def inventory_request(event, context):
+    # lookups and the scheduled compaction of the certificate inventory
+    inv = inventory(aws_clients.client('s3'))
+    if event['inventory'] == 'latest':
+        return inv.latest(event['instance-id'])
+    if event['inventory'] == 'expiring':
+        now = time.time()
+        return inv.expiring(now, now + float(event.get('days', 30)) * 86400)
+    if event['inventory'] == 'compact':
+        print("Compacting: certificate inventory");
+        stats = inv.compact(budget=context.get_remaining_time_in_millis() / 1000.0 - 5 if context else None)
+        print("Compacted: certificate inventory " + json.dumps(stats));
+        return stats
+    raise Exception('Unknown inventory request ' + str(event['inventory']))
+
+def refill_key_pool(context):
+    s3client =  aws_clients.client('s3')
+    ca = ca_cache.get(s3client, aws_clients.client('kms'), os.environ['CA_BUCKET'], os.environ['CA_FILE'],
+                      os.environ['CA_KEY_FILE'], os.environ['CA_PWD'])
+    pool = key_pool(s3client, ca)
+    if pool is None or not use_engine():
+        print("Key pool: not configured (KEY_POOL_BUCKET) or python engine not available. Exit")
+        return {}
+
+    print("Refilling: key pool");
+    # leave time for the last key and the upload before the lambda times out
+    budget = context.get_remaining_time_in_millis() / 1000.0 - 10 if context else None
+    stats = pool.refill(budget)
+    print("Refilled: key pool " + json.dumps(stats));
+    return stats
 
 def lambda_handler(event, context):
 
-    print("Creating certificate for " + event['instance-id']);
+    trace = event.get('trace-id') or new_trace_id()
+    start = time.time()
+    try:
+        return handle(event, context, trace)
+    finally:
+        tracer.record('aws-calls', trace, start, parent_id=event.get('parent-id'), **aws_clients.report())
+
+def handle(event, context, trace):
+
+    if 'instance-ids' in event:
+        with tracer.span('issue-bulk', trace, event.get('parent-id'), Instances=len(event['instance-ids'])):
+            return issue_bulk(event, trace)
+    if event.get('key-pool') == 'refill':
+        with tracer.span('key-pool-refill', trace):
+            return refill_key_pool(context)
+    if 'inventory' in event:
+        with tracer.span('inventory-' + str(event['inventory']), trace):
+            return inventory_request(event, context)
+
+    with tracer.span('issue', trace, event.get('parent-id'), InstanceId=event['instance-id']):
+        return issue(event, trace)
+
+def issue(event, trace):
+
+    print("Creating certificate for " + event['instance-id'] + " trace " + trace);
     
     bucket = os.environ['CA_BUCKET'];
     cacertfile = os.environ['CA_FILE'];
@@ -51,81 +292,199 @@ def lambda_handler(event, context):
     p12_cms_keyid = os.environ['P12_CMS_KEYID'];
     capwd = os.environ['CA_PWD'];
     
-    s3client =  boto3.client('s3')
-    
-    print("Downloading: CA certicate");
-    obj = s3client.get_object(Bucket=bucket, Key=cacertfile)
-    cacertificate=obj['Body'].read().decode('utf-8') 
-    print("Downloaded: CA certicate");
-    
-    print("Downloading: CA encrypted key");
-    obj = s3client.get_object(Bucket=bucket, Key=cakeyfile)
-    cakey=obj['Body'].read().decode('utf-8') 
-    print("Downloaded: CA encrypted key");
-    
-    os.environ['CA_CERT'] = cacertificate;
-    os.environ['CA_KEY'] = cakey;
-    
-    kmsclient = boto3.client('kms')
-
-    print("Generating: export password with KMS (128 Bytes)"); 
-    random=kmsclient.generate_random(NumberOfBytes=128)
-    exportpassword=base64.b64encode(random[u'Plaintext']).decode(encoding="utf-8")
-    print("Generated: export password"); 
+    s3client =  aws_clients.client('s3')
+    kmsclient = aws_clients.client('kms')
 
+    with tracer.span('ca-cache', trace) as span:
+        ca = ca_cache.get(s3client, kmsclient, bucket, cacertfile, cakeyfile, capwd)
+        span.set('CacheStats', ca_cache.stats())
+    print("CA cache stats: " + json.dumps(ca_cache.stats()))
 
-    print("Encrypting: password with KMS"); 
-    p12_pwd=kmsclient.encrypt(KeyId=p12_cms_keyid, Plaintext=exportpassword)
-    print("Encrypted: export password with KMS"); 
-    
-    print("Decrypting: CA key password");
-    cakey_password = kmsclient.decrypt(CiphertextBlob=base64.b64decode(capwd))['Plaintext'].decode(encoding="utf-8")
-    print("Decrypted: CA key password");
+    csr = event.get('csr')
+    if csr:
+        # the key stays on the host, nothing to export
+        exportpassword = ''
+        p12_pwd = {'CERT_CA_PEM_B64': base64.b64encode(ca.cert.encode('utf-8')).decode('utf-8')}
+    else:
+        with tracer.span('kms', trace) as span:
+            exportpassword, p12_pwd = export_password(kmsclient, p12_cms_keyid, span)
     
     # get the instance IPs and hostname 
-    SAN=""
-    ec2 = boto3.resource('ec2')
-    instance = ec2.Instance(event['instance-id'])
-    hostname=instance.private_dns_name
-    for int in instance.network_interfaces_attribute:
-        for net in int['PrivateIpAddresses']:
-            if SAN != "": 
-                SAN=SAN + ",IP:"+net['PrivateIpAddress']
-            else:
-                SAN="IP:" + net['PrivateIpAddress']
-    print("adding follwing IP to certificate " + SAN)
+    with tracer.span('describe-instance', trace):
+        hostname, ips = describe_hosts(aws_clients.client('ec2'), [event['instance-id']])[event['instance-id']]
+    print("adding follwing IP to certificate " + ",".join(ips))
     print("hostname " + hostname)
-    os.environ['SAN'] = SAN
-    
-    os.environ['CA_PWD_DECRYPTED'] = cakey_password
-    os.environ['CERT_EXPORT_PWD'] = exportpassword
-    
-    print("Issuing: certificate with openssl");
-    p = subprocess.Popen('sh ./genCert.sh '+ hostname, shell=True, stdout=subprocess.PIPE)
-    p.wait()
-    os.environ['CA_PWD_DECRYPTED'] = "------------";
-    
-    if p.returncode != 0: 
-        raise Exception('Error in execution of openssl script with exit code:' + str(p.returncode))
-    
-    print("Issued: Script finished");
-    r=''    
-    for line in p.stdout:
-      r=r + line.decode(encoding="utf-8")
     
-    print("Converting: script output to JSON");
-    j=json.loads(r.replace(" ",""))
-    print("Converted: output to JSON");
+    with tracer.span('sign', trace) as span:
+        span.set('Request', bool(csr))
+        if csr and use_engine():
+            span.set('Engine', 'python')
+            print("Signing: certificate request of the host in-process");
+            cacert, cakey = ca_keys(ca)
+            j = cert_engine.sign_request(cacert, cakey, hostname, ips, base64.b64decode(csr))
+            print("Signed: certificate request");
+        elif csr:
+            span.set('Engine', 'openssl')
+            print("Signing: certificate request of the host with openssl");
+            j = issue_with_openssl(hostname, ips, ca, exportpassword, csr=csr)
+            print("Signed: Script finished");
+        elif use_engine():
+            span.set('Engine', 'python')
+            print("Issuing: certificate in-process");
+            cacert, cakey = ca_keys(ca)
+            key = None
+            pool = key_pool(s3client, ca)
+            if pool is not None:
+                with tracer.span('key-pool', trace):
+                    key = pool.take()
+                print("Key pool: " + ("took pre-generated key" if key is not None else "empty, generating key"))
+            span.set('PooledKey', key is not None)
+            j = cert_engine.issue(cacert, cakey, hostname, ips, exportpassword, key=key)
+            print("Issued: certificate in-process");
+        else:
+            span.set('Engine', 'openssl')
+            print("Issuing: certificate with openssl");
+            j = issue_with_openssl(hostname, ips, ca, exportpassword)
+            print("Issued: Script finished");
+
+    if j['ERR'] != "":
+        raise Exception('Error in certificate issuance: ' + j['ERR'])
 
     d = str(datetime.datetime.now())
+    pem = base64.b64decode(j['CERT_PEM_B64'])
     
     print('Uploading: generated cert to bucket '+certsbucket)
-    s3client.put_object(Bucket=certsbucket, Key=d+' - ' + hostname+ '.pem', ServerSideEncryption="AES256", Body=base64.b64decode(j['CERT_PEM_B64']))
+    with tracer.span('upload', trace):
+        s3client.put_object(Bucket=certsbucket, Key=d+' - ' + hostname+ '.pem', ServerSideEncryption="AES256", Body=pem)
     print("Uploaded: certificate to Bucket s3://" + certsbucket + ' Key:' + d + ' - ' + hostname + '.pem')
+
+    with tracer.span('inventory', trace):
+        serial, not_after = certificate_info(pem)
+        inventory(s3client).record(event['instance-id'], hostname, ips, serial, not_after, d + ' - ' + hostname + '.pem')
+    print("Recorded: certificate " + serial + " in inventory")
                                 
-    j['CERT_P12_ENCRYPTED_PWD'] = base64.b64encode(p12_pwd['CiphertextBlob']).decode(encoding="utf-8")
+    j.update(p12_pwd)
+    j['CERT_NOT_AFTER'] = not_after
     print("SUCCESS: Certificate issued")
 
     return(j)
-    
-    
+
+def issue_bulk(event, trace):
+
+    instance_ids = event['instance-ids']
+    csrs = event.get('csrs') or {}
+    print("Creating certificates for " + str(len(instance_ids)) + " instances trace " + trace);
+
+    certsbucket = os.environ['CERTS_BUCKET'];
+    p12_cms_keyid = os.environ['P12_CMS_KEYID'];
+    workers = int(os.environ.get('BULK_WORKERS', '0')) or None
+
+    s3client =  aws_clients.client('s3')
+    kmsclient = aws_clients.client('kms')
+
+    with tracer.span('ca-cache', trace) as span:
+        ca = ca_cache.get(s3client, kmsclient, os.environ['CA_BUCKET'], os.environ['CA_FILE'],
+                          os.environ['CA_KEY_FILE'], os.environ['CA_PWD'])
+        span.set('CacheStats', ca_cache.stats())
+    print("CA cache stats: " + json.dumps(ca_cache.stats()))
+
+    with tracer.span('describe-instance', trace, Instances=len(instance_ids)):
+        hosts = describe_hosts(aws_clients.client('ec2'), instance_ids)
+    results = dict((i, {'ERR': 'Instance ' + i + ' not found'}) for i in instance_ids if i not in hosts)
+    todo = [i for i in instance_ids if i in hosts]
+
+    # the key stays on the host for a csr, nothing to export
+    ca_pem = {'CERT_CA_PEM_B64': base64.b64encode(ca.cert.encode('utf-8')).decode('utf-8')}
+    passwords = {}
+    with tracer.span('kms', trace) as span:
+        for i in todo:
+            passwords[i] = ('', ca_pem) if i in csrs else export_password(kmsclient, p12_cms_keyid, span)
+
+    issued = {}
+    with tracer.span('sign', trace, Instances=len(todo)) as span:
+        span.set('Requests', len([i for i in todo if i in csrs]))
+        if use_engine():
+            span.set('Engine', 'python')
+            cacert, cakey = ca_keys(ca)
+            need = [i for i in todo if i not in csrs]
+            keys = {}
+            pool = key_pool(s3client, ca)
+            if pool is not None and need:
+                with tracer.span('key-pool', trace):
+                    for i in need:
+                        key = pool.take()
+                        if key is None:
+                            break
+                        keys[i] = key
+                print("Key pool: took " + str(len(keys)) + " pre-generated keys");
+            span.set('PooledKeys', len(keys))
+            missing = [i for i in need if i not in keys]
+            if missing:
+                with tracer.span('keygen', trace, Keys=len(missing)):
+                    print("Generating: " + str(len(missing)) + " keys in parallel");
+                    keys.update(zip(missing, cert_engine.generate_keys(len(missing), workers=workers)))
+            print("Issuing: certificates in-process");
+            for i in todo:
+                hostname, ips = hosts[i]
+                try:
+                    if i in csrs:
+                        issued[i] = cert_engine.sign_request(cacert, cakey, hostname, ips, base64.b64decode(csrs[i]))
+                    else:
+                        issued[i] = cert_engine.issue(cacert, cakey, hostname, ips, passwords[i][0], key=keys[i])
+                except Exception as e:
+                    issued[i] = {'ERR': str(e)}
+        else:
+            span.set('Engine', 'openssl')
+            print("Issuing: certificates with openssl");
+
+            def run(i):
+                # genCert.sh empties its working folder, one folder per script
+                workdir = tempfile.mkdtemp()
+                try:
+                    return issue_with_openssl(hosts[i][0], hosts[i][1], ca, passwords[i][0], workdir=workdir, csr=csrs.get(i))
+                except Exception as e:
+                    return {'ERR': str(e)}
+                finally:
+                    shutil.rmtree(workdir, ignore_errors=True)
+            with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+                issued = dict(zip(todo, executor.map(run, todo)))
+        print("Issued: " + str(len(issued)) + " certificates");
+
+    with tracer.span('upload', trace) as span:
+        records = []
+        for i in todo:
+            j = issued[i]
+            if j['ERR'] != "":
+                print("Certificate issuance of " + i + " failed: " + j['ERR'])
+                results[i] = {'ERR': j['ERR']}
+                continue
+            hostname, ips = hosts[i]
+            d = str(datetime.datetime.now())
+            pem = base64.b64decode(j['CERT_PEM_B64'])
+            try:
+                s3client.put_object(Bucket=certsbucket, Key=d+' - ' + hostname+ '.pem', ServerSideEncryption="AES256", Body=pem)
+            except Exception as e:
+                print("Upload of the certificate of " + i + " failed: " + str(e))
+                results[i] = {'ERR': 'Upload failed: ' + str(e)}
+                continue
+            records.append((i, hostname, ips, pem, d + ' - ' + hostname + '.pem'))
+    print("Uploaded: " + str(len(records)) + " certificates to Bucket s3://" + certsbucket)
+
+    with tracer.span('inventory', trace):
+        inv = inventory(s3client)
+        for i, hostname, ips, pem, key in records:
+            j = issued[i]
+            try:
+                serial, not_after = certificate_info(pem)
+                inv.record(i, hostname, ips, serial, not_after, key)
+            except Exception as e:
+                print("Inventory record of " + i + " failed: " + str(e))
+                results[i] = {'ERR': 'Inventory failed: ' + str(e)}
+                continue
+            j.update(passwords[i][1])
+            j['CERT_NOT_AFTER'] = not_after
+            results[i] = j
+
+    failed = len([r for r in results.values() if r.get('ERR')])
+    print("SUCCESS: " + str(len(results) - failed) + " certificates issued, " + str(failed) + " failed")
+    return {'results': results, 'issued': len(results) - failed, 'failed': failed}
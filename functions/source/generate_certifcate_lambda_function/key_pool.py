@@ -0,0 +1,123 @@
+"""
+    Pool of pre-generated host keys, takes the RSA key generation off the issuance path
+
+   A producer (scheduled invocation of the certificate lambda with event {"key-pool": "refill"})
+   keeps up to KEY_POOL_SIZE encrypted keys ready and tops the pool up when it
+   falls below KEY_POOL_LOW_WATER. The issuer takes one key per certificate and only signs.
+
+   Layout in the store (S3 bucket and prefix, or a local folder as stand-in, see object_store.py)
+	  ready/<created epoch>-<uuid>.pem   - PKCS8 key, encrypted with the pool password
+	  claims/<created epoch>-<uuid>      - claim marker, created exclusively by the taker
+
+   A key is used at most once: the taker must create the claim marker exclusively
+   (a conditional PutItem on the claims table, see object_store.py, or O_EXCL) before reading the key, the key is
+   deleted afterwards. Keys older than KEY_POOL_MAX_AGE seconds are never handed out
+   and are removed by the producer, as are claim markers of removed keys.
+
+   A KeyPool lists the ready keys once and takes the following keys from that list (shuffled),
+   a bulk issuance of n certificates lists once, not n times. The pool is listed again only
+   when the keys of the list are all taken or claimed by others.
+
+    Copyright 2017-2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+    Licensed under the Apache License, Version 2.0 (the "License").
+    You may not use this file except in compliance with the License.
+    A copy of the License is located at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+   or in the "license" file accompanying this file. This file is distributed
+   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+   express or implied. See the License for the specific language governing
+   permissions and limitations under the License.
+
+"""
+import time, uuid, random
+import cert_engine
+from object_store import S3Store, LocalStore
+
+READY = 'ready/'
+CLAIMS = 'claims/'
+
+
+# the pool stores are the generic object stores
+S3KeyPoolStore = S3Store
+LocalKeyPoolStore = LocalStore
+
+
+class KeyPool(object):
+
+    def __init__(self, store, password, size=20, low_water=5, max_age=86400, key_bits=cert_engine.KEY_BITS):
+        self.store = store
+        self.password = password
+        self.size = size
+        self.low_water = low_water
+        self.max_age = max_age
+        self.key_bits = key_bits
+        self.ready = []
+
+    def _age(self, name, now):
+        try:
+            return now - int(name.split('-', 1)[0])
+        except ValueError:
+            return self.max_age
+
+    def _list_ready(self, now):
+        ready = [n[:-len('.pem')] for n in self.store.list(READY) if n.endswith('.pem') and self._age(n, now) < self.max_age]
+        # concurrent issuers should not all race for the oldest key
+        random.shuffle(ready)
+        return ready
+
+    def _claim_listed(self, now):
+        while self.ready:
+            name = self.ready.pop()
+            if self._age(name, now) >= self.max_age:
+                continue
+            if not self.store.create_exclusive(CLAIMS + name, str(int(now)).encode('utf-8')):
+                continue
+            pem = self.store.get(READY + name + '.pem')
+            self.store.delete(READY + name + '.pem')
+            if pem is not None:
+                return cert_engine.load_key(pem, self.password)
+        return None
+
+    def take(self):
+        """ Claims and removes one ready key. Returns the private key or None if the pool is empty """
+        now = time.time()
+        key = self._claim_listed(now)
+        if key is None:
+            self.ready = self._list_ready(now)
+            key = self._claim_listed(now)
+        return key
+
+    def refill(self, budget=None):
+        """ Removes expired keys and stale claims, tops the pool up if below low water.
+            Stops generating keys after budget seconds. Returns pool stats """
+        now = time.time()
+        expired = 0
+        ready = []
+        for n in self.store.list(READY):
+            if not n.endswith('.pem'):
+                continue
+            if self._age(n, now) >= self.max_age:
+                self.store.delete(READY + n)
+                expired += 1
+            else:
+                ready.append(n[:-len('.pem')])
+
+        # claim markers are kept until their key can not be handed out anymore
+        for n in self.store.list(CLAIMS):
+            if self._age(n, now) >= self.max_age and n not in ready:
+                self.store.delete(CLAIMS + n)
+
+        generated = 0
+        if len(ready) < self.low_water:
+            for i in range(self.size - len(ready)):
+                if budget is not None and time.time() - now > budget:
+                    break
+                key = cert_engine.generate_key(self.key_bits)
+                name = str(int(time.time())) + '-' + uuid.uuid4().hex
+                self.store.put(READY + name + '.pem', cert_engine.dump_key(key, self.password))
+                generated += 1
+
+        return {'ready': len(ready) + generated, 'generated': generated, 'expired': expired}
@@ -0,0 +1,164 @@
+"""
+    Object stores of the lambdas: a S3 bucket and prefix, or a local folder as stand-in for local
+    runs and benchmarks. Used by the key pool, the certificate inventory and the metrics rollup.
+
+   Names are relative to the prefix or folder and may contain '/'.
+   list(folder) returns the names below folder (recursively) relative to folder.
+   create_exclusive(name, data) writes the object only if no other caller created it before and
+   returns whether it did. The S3 store claims the name with a conditional PutItem on a DynamoDB
+   table (hash key k, TTL attribute e, the idempotency table of the stack) before it writes the
+   object: the conditional PUT of S3 (IfNoneMatch) needs a botocore newer than the one of the
+   lambda runtime. A claim expires after claim_ttl seconds (default 2 days).
+   claim(name, ttl) only claims the name, for ttl seconds, and release(name) gives a claim up: a
+   caller that must finish work before the object is final (the metrics rollup publishes first)
+   claims, works, then puts the object, or releases the claim if the work failed.
+
+   The same module is packaged with the certificate and the metrics rollup lambdas, keep the copies identical.
+
+    Copyright 2017-2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+    Licensed under the Apache License, Version 2.0 (the "License").
+    You may not use this file except in compliance with the License.
+    A copy of the License is located at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+   or in the "license" file accompanying this file. This file is distributed
+   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+   express or implied. See the License for the specific language governing
+   permissions and limitations under the License.
+
+"""
+import os, time
+import botocore
+
+CLAIM_TTL = 2 * 86400
+
+
+class S3Store(object):
+    """ Store in a S3 bucket under a prefix, with a DynamoDB table of claims for create_exclusive """
+
+    def __init__(self, s3client, bucket, prefix, dynamodb=None, claims_table='', claim_ttl=CLAIM_TTL):
+        self.s3 = s3client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.dynamodb = dynamodb
+        self.claims_table = claims_table
+        self.claim_ttl = claim_ttl
+
+    def list(self, folder):
+        names = []
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix + folder):
+            for o in page.get('Contents', []):
+                names.append(o['Key'][len(self.prefix + folder):])
+        return names
+
+    def put(self, name, data):
+        self.s3.put_object(Bucket=self.bucket, Key=self.prefix + name, Body=data, ServerSideEncryption="AES256")
+
+    def _claim_key(self, name):
+        if self.dynamodb is None or not self.claims_table:
+            raise Exception('No claims table, s3://' + self.bucket + '/' + self.prefix + name + ' can not be created exclusively')
+        return {'S': 's3://' + self.bucket + '/' + self.prefix + name}
+
+    def claim(self, name, ttl=None):
+        key = self._claim_key(name)
+        now = int(time.time())
+        try:
+            self.dynamodb.put_item(TableName=self.claims_table,
+                                   Item={'k': key, 's': {'S': 'created'},
+                                         'e': {'N': str(now + (ttl or self.claim_ttl))}},
+                                   ConditionExpression='attribute_not_exists(k) OR e < :now',
+                                   ExpressionAttributeValues={':now': {'N': str(now)}})
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                return False
+            raise
+        return True
+
+    def release(self, name):
+        self.dynamodb.delete_item(TableName=self.claims_table, Key={'k': self._claim_key(name)})
+
+    def create_exclusive(self, name, data):
+        if not self.claim(name):
+            return False
+        self.put(name, data)
+        return True
+
+    def get(self, name):
+        try:
+            return self.s3.get_object(Bucket=self.bucket, Key=self.prefix + name)['Body'].read()
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] == 'NoSuchKey':
+                return None
+            raise
+
+    def delete(self, name):
+        self.s3.delete_object(Bucket=self.bucket, Key=self.prefix + name)
+
+
+class LocalStore(object):
+    """ Store in a local folder """
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    def _path(self, name):
+        path = os.path.join(self.folder, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        return path
+
+    def list(self, folder):
+        top = os.path.join(self.folder, folder)
+        names = []
+        for root, dirs, files in os.walk(top):
+            for f in files:
+                names.append(os.path.relpath(os.path.join(root, f), top).replace(os.sep, '/'))
+        return sorted(names)
+
+    def put(self, name, data):
+        path = self._path(name)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.rename(path + '.tmp', path)
+
+    def claim(self, name, ttl=None):
+        # a marker in .claims/ of the folder, taken over once older than ttl
+        path = self._path(os.path.join('.claims', name))
+        try:
+            if ttl and time.time() - os.path.getmtime(path) > ttl:
+                os.remove(path)
+        except OSError:
+            pass
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600))
+        except OSError:
+            return False
+        return True
+
+    def release(self, name):
+        self.delete(os.path.join('.claims', name))
+
+    def create_exclusive(self, name, data):
+        try:
+            fd = os.open(self._path(name), os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600)
+        except OSError:
+            return False
+        os.write(fd, data)
+        os.close(fd)
+        return True
+
+    def get(self, name):
+        try:
+            with open(os.path.join(self.folder, name), 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def delete(self, name):
+        try:
+            os.remove(os.path.join(self.folder, name))
+        except OSError:
+            pass
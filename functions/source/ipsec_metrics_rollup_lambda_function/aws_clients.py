@@ -0,0 +1,144 @@
+"""
+    AWS clients of the lambdas, created once per container and reused by its warm invocations
+
+   client(service) creates the boto3 client on first use and keeps it at module level, so the
+   client construction (endpoint and credential resolution) and the TLS connections of its pool
+   are paid once per container instead of in every invocation. The clients share one botocore
+   Config, tuned in enviroment variables
+	  CLIENT_RETRY_MODE      - retry mode, adaptive adds client side rate limiting to the retries
+	                           of throttled calls (optional, default adaptive)
+	  CLIENT_MAX_ATTEMPTS    - attempts of a call, the first included (optional, default 8)
+	  CLIENT_MAX_POOL        - connections kept per client, at least the threads sharing the
+	                           client (optional, default 10)
+	  CLIENT_CONNECT_TIMEOUT, CLIENT_READ_TIMEOUT
+	                         - seconds (optional, default 5, 60)
+   A caller may override any Config setting, client('lambda', read_timeout=300), each distinct
+   set of overrides is a client of its own.
+
+   Every call of a client is counted and timed per service through the botocore events
+   before-call and after-call. report() returns the calls since the previous report, their errors,
+   retries and latency, the time spent creating clients and whether it is the first report of the
+   container (cold). The lambdas add it to a span of their invocation, so
+	  filter Stage = 'aws-calls' | stats avg(ClientSetupMs), avg(CallMs) by Function, Cold
+   in CloudWatch Logs Insights compares the cold and warm overheads.
+
+   The same module is packaged with every lambda, keep the copies identical.
+
+    Copyright 2017-2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+    Licensed under the Apache License, Version 2.0 (the "License").
+    You may not use this file except in compliance with the License.
+    A copy of the License is located at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+   or in the "license" file accompanying this file. This file is distributed
+   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+   express or implied. See the License for the specific language governing
+   permissions and limitations under the License.
+
+"""
+import os, threading, time
+import boto3, botocore
+from botocore.config import Config
+
+_lock = threading.Lock()
+_clients = {}
+_calls = {}
+_setup_ms = [0.0]
+_cold = [True]
+
+
+def settings(**overrides):
+    """ Config settings of the clients, with the overrides of a caller """
+    s = {'retries': {'mode': os.environ.get('CLIENT_RETRY_MODE', 'adaptive'),
+                     'total_max_attempts': int(os.environ.get('CLIENT_MAX_ATTEMPTS', '8'))},
+         'max_pool_connections': int(os.environ.get('CLIENT_MAX_POOL', '10')),
+         'connect_timeout': float(os.environ.get('CLIENT_CONNECT_TIMEOUT', '5')),
+         'read_timeout': float(os.environ.get('CLIENT_READ_TIMEOUT', '60'))}
+    s.update(overrides)
+    return s
+
+
+def _create(service, region_name, s):
+    try:
+        return boto3.client(service, region_name=region_name, config=Config(**s))
+    except botocore.exceptions.InvalidRetryConfigurationError:
+        # botocore before retry modes, legacy retries with the same attempts
+        s = dict(s, retries={'max_attempts': max(0, s['retries'].get('total_max_attempts', 5) - 1)})
+        return boto3.client(service, region_name=region_name, config=Config(**s))
+
+
+def _before(context=None, **kw):
+    if context is not None:
+        context['aws_clients_start'] = time.time()
+
+
+def _record(service, context, error, retries):
+    start = (context or {}).get('aws_clients_start')
+    ms = (time.time() - start) * 1000 if start else 0.0
+    with _lock:
+        c = _calls.setdefault(service, {'calls': 0, 'errors': 0, 'retries': 0, 'ms': 0.0})
+        c['calls'] += 1
+        c['errors'] += 1 if error else 0
+        c['retries'] += retries
+        c['ms'] += ms
+
+
+def _instrument(client, service):
+    events = getattr(getattr(client, 'meta', None), 'events', None)
+    if events is None:
+        # not a botocore client (a stand-in of a local run), not counted
+        return
+
+    def after(http_response=None, parsed=None, context=None, **kw):
+        status = getattr(http_response, 'status_code', 200)
+        retries = ((parsed or {}).get('ResponseMetadata') or {}).get('RetryAttempts', 0)
+        _record(service, context, status >= 300, retries)
+
+    def after_error(context=None, **kw):
+        _record(service, context, True, 0)
+
+    events.register('before-call.*.*', _before)
+    events.register('after-call.*.*', after)
+    events.register('after-call-error.*.*', after_error)
+
+
+def client(service, region_name=None, **overrides):
+    """ Client of the service, created on first use with settings(**overrides) """
+    key = (service, region_name, repr(sorted(overrides.items())))
+    c = _clients.get(key)
+    if c is not None:
+        return c
+    with _lock:
+        c = _clients.get(key)
+        if c is None:
+            # boto3 creates clients of the default session one at a time
+            start = time.time()
+            c = _create(service, region_name, settings(**overrides))
+            _instrument(c, service)
+            _setup_ms[0] += (time.time() - start) * 1000
+            _clients[key] = c
+    return c
+
+
+def report():
+    """ Calls by service since the previous report, as span properties """
+    with _lock:
+        calls = dict((s, dict(c, ms=round(c['ms'], 3))) for s, c in _calls.items())
+        r = {'Cold': _cold[0], 'ClientSetupMs': round(_setup_ms[0], 3), 'Clients': len(_clients),
+             'Calls': sum(c['calls'] for c in calls.values()), 'CallMs': round(sum(c['ms'] for c in calls.values()), 3),
+             'Services': calls}
+        _calls.clear()
+        _setup_ms[0] = 0.0
+        _cold[0] = False
+    return r
+
+
+def reset():
+    """ Drops the clients and counts, for local runs that replace boto3.client """
+    with _lock:
+        _clients.clear()
+        _calls.clear()
+        _setup_ms[0] = 0.0
+        _cold[0] = True
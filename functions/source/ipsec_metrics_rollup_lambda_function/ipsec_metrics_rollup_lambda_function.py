@@ -0,0 +1,91 @@
+#
+# Rolls up the IPSec statistics samples of the hosts to fleet, VPC and availability zone metrics
+# (see metric_rollup.py). Runs on a schedule, each run rolls up the complete slots not rolled up yet.
+#
+#   Configuration in enviroment variables
+#       - MetricsBucket       - bucket the hosts write their samples to
+#       - MetricsPrefix       - key prefix of the samples and rollups (optional, default metrics/)
+#       - ClaimsTable         - DynamoDB table the rollups are claimed in, so a slot is published by one run at a time
+#                               (hash key k, TTL attribute e), see object_store.py
+#       - MetricsNamespace    - CloudWatch namespace of the rollups (optional, default IPSec/Fleet)
+#       - RollupResolution    - seconds of a rollup window (optional, default 60)
+#       - SlotSeconds         - seconds of a sample slot, the publish interval of the agents (optional, default 300)
+#       - GraceSeconds        - seconds a slot stays open for late samples (optional, default 120)
+#       - LookbackSlots       - slots looked back at for a missed run (optional, default 12)
+#       - OutlierInstances    - outlier instances kept per window and metric (optional, default 5)
+#       - SampleRetentionSeconds, RollupRetentionSeconds
+#                             - age the samples and the rollups are deleted at, also without lifecycle
+#                               rules of the bucket (optional, default 172800 and 3024000, 0 keeps them)
+#   Each run is a trace, the stage rollup and the AWS calls (aws-calls) are emitted as EMF spans (see tracing.py)
+#
+# Copyright 2017-2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file. This file is distributed
+# on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+import os, time, json
+import aws_clients
+from metric_rollup import MetricRollup
+from object_store import S3Store
+from tracing import Tracer, new_trace_id
+
+# values of up to 150 hosts per datum, a call stays below the request size limit
+DATUMS_PER_CALL = 100
+
+tracer = Tracer('MetricsRollup')
+
+def publisher(namespace):
+    cloudwatch = aws_clients.client('cloudwatch')
+
+    def publish(datums):
+        for i in range(0, len(datums), DATUMS_PER_CALL):
+            cloudwatch.put_metric_data(Namespace=namespace, MetricData=datums[i:i + DATUMS_PER_CALL])
+    return publish
+
+def lambda_handler(event, context):
+
+    trace = event.get('trace-id') or new_trace_id()
+    start = time.time()
+    try:
+        with tracer.span('rollup', trace) as span:
+            r = metric_rollup()
+            done = rollup(r, context)
+            span.set('Slots', len(done))
+            span.set('Samples', sum(s['samples'] for s in done))
+            span.set('Expired', expire(r))
+    finally:
+        tracer.record('aws-calls', trace, start, **aws_clients.report())
+    return done
+
+def metric_rollup():
+    store = S3Store(aws_clients.client('s3'), os.environ['MetricsBucket'], os.environ.get('MetricsPrefix', 'metrics/'),
+                    aws_clients.client('dynamodb'), os.environ['ClaimsTable'])
+    return MetricRollup(store, int(os.environ.get('SlotSeconds', '300')), int(os.environ.get('RollupResolution', '60')),
+                        int(os.environ.get('GraceSeconds', '120')), int(os.environ.get('LookbackSlots', '12')),
+                        int(os.environ.get('OutlierInstances', '5')), publisher(os.environ.get('MetricsNamespace', 'IPSec/Fleet')),
+                        sample_retention=int(os.environ.get('SampleRetentionSeconds', '172800')),
+                        rollup_retention=int(os.environ.get('RollupRetentionSeconds', '3024000')))
+
+def expire(r):
+    # samples and rollups past their retention, a bucket not created by the stack has no lifecycle rules
+    deleted = r.expire()
+    print('IPSec metrics expired: ' + str(deleted) + ' objects')
+    return deleted
+
+def rollup(r, context):
+
+    # leave time for the slot in progress before the lambda times out
+    budget = context.get_remaining_time_in_millis() / 1000.0 - 30 if context else None
+    done = r.run(budget=budget)
+    for s in done:
+        print('rolled up slot ' + json.dumps(s, sort_keys=True))
+    print('IPSec metrics rollup: ' + str(len(done)) + ' slots')
+    return done
@@ -0,0 +1,268 @@
+"""
+    Fleet rollups of the IPSec statistics of the hosts
+
+   The statistics agent of each host (ipsec_stats_agent.py --sink s3) writes its raw samples as
+   JSON lines, one per reading
+	  {"t": <epoch seconds>, "i": <instance id>, "vpc": <vpc id>, "az": <availability zone>,
+	   "m": {"IPSec-Connections": 12, "IPSec-IKE-Errors": 0, ...}}
+   into objects grouped by slot (the sample time rounded down to the slot length)
+	  samples/<slot>/<instance id>-<time of the first sample>.jsonl
+
+   Once a slot is complete, the rollup reads all its objects and, per window of the rollup
+   resolution and metric, the values of all hosts of
+	  the fleet             - no dimension
+	  each VPC              - dimension VpcId
+	  each availability zone - dimension AvailabilityZone
+   and publishes each as one CloudWatch value distribution (Values and Counts), so CloudWatch
+   has the Sum, Average, Minimum, Maximum, SampleCount (hosts) and the percentiles (p50, p99..)
+   over the hosts, plus IPSec-Hosts, the hosts that reported. The metric streams are per VPC and
+   AZ, not per instance.
+
+   The rollup of a slot is kept as
+	  rollups/<slot>.json
+   with the percentiles of each window and scope and the outliers: per window and metric the
+   instances farthest from the fleet median, at most outliers of them. The slot is claimed for
+   claim_ttl seconds (longer than a run) before its values are published and the rollup is written
+   only once they are: a slot is published by one run at a time, and a failed publish releases the
+   claim, so the next run publishes the slot again instead of losing it. A run killed while
+   publishing leaves its claim to expire, the slot is then published again.
+
+   The samples of a slot older than sample_retention seconds and its rollup once older than
+   rollup_retention seconds are deleted by expire, for the lookback slots past the retention: a
+   bucket the stack did not create has no lifecycle rules for them. 0 keeps them.
+
+   Testable offline on recorded samples, a local copy of the prefix:
+	  python3 metric_rollup.py --folder <copy> [--resolution 60] [--slot 300] [--now <epoch>]
+   prints the rollups of the complete slots and writes them to rollups/ of the folder.
+
+    Copyright 2017-2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+    Licensed under the Apache License, Version 2.0 (the "License").
+    You may not use this file except in compliance with the License.
+    A copy of the License is located at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+   or in the "license" file accompanying this file. This file is distributed
+   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+   express or implied. See the License for the specific language governing
+   permissions and limitations under the License.
+
+"""
+import json, math, time
+
+SAMPLES = 'samples/'
+ROLLUPS = 'rollups/'
+
+# units of the agent metrics, others are published without unit
+UNITS = {'IPSec-Connections': 'Count', 'IPSec-IKE-Errors': 'Count', 'IPSec-Connection-Shunts': 'Count',
+         'IPSec-InBytes': 'Bytes', 'IPSec-OutBytes': 'Bytes', 'IPSec-InPackets': 'Count', 'IPSec-OutPackets': 'Count'}
+HOSTS = 'IPSec-Hosts'
+# PutMetricData accepts up to 150 distinct values per datum
+MAX_VALUES = 150
+PERCENTILES = [50, 90, 99]
+
+
+def parse_samples(text):
+    """ Samples of an object, invalid lines are skipped """
+    samples = []
+    for line in text.splitlines():
+        try:
+            s = json.loads(line)
+            samples.append((int(s['t']), s['i'], s.get('vpc') or 'unknown', s.get('az') or 'unknown',
+                            dict((k, float(v)) for k, v in s['m'].items())))
+        except (ValueError, KeyError, TypeError, AttributeError):
+            continue
+    return samples
+
+
+def percentile(values, p):
+    """ Nearest rank percentile of sorted values """
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+def distribution(values, limit=MAX_VALUES):
+    """ Values and counts of at most limit distinct values. Neighbours are merged to their mean, so
+        the sum is kept; the smallest and the largest value stay exact """
+    counts = {}
+    for v in values:
+        counts[v] = counts.get(v, 0) + 1
+    distinct = sorted(counts)
+    if len(distinct) <= limit:
+        return distinct, [counts[v] for v in distinct]
+    inner = distinct[1:-1]
+    groups = limit - 2
+    merged_values = [distinct[0]]
+    merged_counts = [counts[distinct[0]]]
+    for g in range(groups):
+        group = inner[g * len(inner) // groups:(g + 1) * len(inner) // groups]
+        n = sum(counts[v] for v in group)
+        merged_values.append(sum(v * counts[v] for v in group) / float(n))
+        merged_counts.append(n)
+    merged_values.append(distinct[-1])
+    merged_counts.append(counts[distinct[-1]])
+    return merged_values, merged_counts
+
+
+def summary(values):
+    values = sorted(values)
+    s = {'hosts': len(values), 'sum': sum(values), 'min': values[0], 'max': values[-1]}
+    for p in PERCENTILES:
+        s['p' + str(p)] = percentile(values, p)
+    return s
+
+
+def outliers(values, limit):
+    """ Instances farthest from the median, values {instance id: value} """
+    if limit <= 0 or not values:
+        return []
+    median = percentile(sorted(values.values()), 50)
+    far = sorted(((abs(v - median), i, v) for i, v in values.items() if v != median), key=lambda x: (-x[0], x[1]))
+    return [{'InstanceId': i, 'Value': v, 'Median': median} for d, i, v in far[:limit]]
+
+
+def rollup(samples, resolution, outlier_limit=5):
+    """ Rollup of samples: {window: {'scopes': {scope: {metric: summary}}, 'outliers': {metric: [...]}}}
+        and the CloudWatch datums. A scope is (dimension name, value), None for the fleet """
+    # the last sample of an instance in a window counts, a repeated upload is not counted twice
+    latest = {}
+    for t, instance, vpc, az, metrics in sorted(samples, key=lambda s: s[0]):
+        latest[(t // resolution * resolution, instance)] = (vpc, az, metrics)
+
+    windows = {}
+    for (window, instance), (vpc, az, metrics) in latest.items():
+        scopes = windows.setdefault(window, {})
+        for scope in (None, ('VpcId', vpc), ('AvailabilityZone', az)):
+            for name, value in metrics.items():
+                scopes.setdefault(scope, {}).setdefault(name, {})[instance] = value
+
+    result = {}
+    datums = []
+    for window, scopes in sorted(windows.items()):
+        doc = {'scopes': {}, 'outliers': {}}
+        for scope, metrics in sorted(scopes.items(), key=lambda x: x[0] or ('', '')):
+            key = 'fleet' if scope is None else scope[0] + '=' + scope[1]
+            dimensions = [] if scope is None else [{'Name': scope[0], 'Value': scope[1]}]
+            doc['scopes'][key] = dict((name, summary(values.values())) for name, values in sorted(metrics.items()))
+            hosts = max(len(values) for values in metrics.values())
+            datums.append({'MetricName': HOSTS, 'Dimensions': dimensions, 'Timestamp': window, 'Value': hosts, 'Unit': 'Count'})
+            for name, values in sorted(metrics.items()):
+                v, c = distribution(list(values.values()))
+                datums.append({'MetricName': name, 'Dimensions': dimensions, 'Timestamp': window,
+                               'Values': v, 'Counts': c, 'Unit': UNITS.get(name, 'None')})
+                if scope is None:
+                    found = outliers(values, outlier_limit)
+                    if found:
+                        doc['outliers'][name] = found
+        result[window] = doc
+    return result, datums
+
+
+class MetricRollup(object):
+    """ Rolls up the complete slots of a store (S3 prefix or local folder, see object_store.py).
+        publish receives the datums of a slot, None only writes the rollups """
+
+    def __init__(self, store, slot=300, resolution=60, grace=120, lookback=12, outlier_limit=5, publish=None,
+                 claim_ttl=900, sample_retention=2 * 86400, rollup_retention=35 * 86400):
+        if slot % resolution:
+            raise ValueError('The slot (' + str(slot) + 's) must be a multiple of the resolution (' + str(resolution) + 's)')
+        self.store = store
+        self.slot = slot
+        self.resolution = resolution
+        self.grace = grace
+        self.lookback = lookback
+        self.outlier_limit = outlier_limit
+        self.publish = publish
+        self.claim_ttl = claim_ttl
+        self.sample_retention = sample_retention
+        self.rollup_retention = rollup_retention
+
+    def due(self, now):
+        """ Complete slots of the lookback without a rollup, oldest first """
+        last = (int(now) - self.grace) // self.slot * self.slot - self.slot
+        return [s for s in range(last - (self.lookback - 1) * self.slot, last + self.slot, self.slot)
+                if self.store.get(ROLLUPS + str(s) + '.json') is None]
+
+    def samples(self, slot):
+        samples = []
+        names = self.store.list(SAMPLES + str(slot) + '/')
+        for name in names:
+            data = self.store.get(SAMPLES + str(slot) + '/' + name)
+            if data is not None:
+                samples.extend(parse_samples(data.decode('utf-8')))
+        return samples, len(names)
+
+    def run_slot(self, slot):
+        """ Rolls up one slot. Returns its summary, None if it has no samples or was rolled up by another run """
+        samples, objects = self.samples(slot)
+        if not samples:
+            return None
+        windows, datums = rollup(samples, self.resolution, self.outlier_limit)
+        doc = {'slot': slot, 'resolution': self.resolution, 'objects': objects, 'samples': len(samples),
+               'windows': dict((str(w), d) for w, d in windows.items())}
+        name = ROLLUPS + str(slot) + '.json'
+        if not self.store.claim(name, self.claim_ttl):
+            return None
+        try:
+            if self.publish is not None:
+                self.publish(datums)
+        except Exception:
+            self.store.release(name)
+            raise
+        self.store.put(name, json.dumps(doc, sort_keys=True).encode('utf-8'))
+        return {'slot': slot, 'objects': objects, 'samples': len(samples), 'datums': len(datums),
+                'outliers': sum(len(o) for d in windows.values() for o in d['outliers'].values())}
+
+    def expired(self, now, retention):
+        """ The lookback slots that ended retention seconds ago """
+        last = (int(now) - retention) // self.slot * self.slot - self.slot
+        return range(last - (self.lookback - 1) * self.slot, last + self.slot, self.slot)
+
+    def expire(self, now=None):
+        """ Deletes the samples and rollups past their retention. Returns the objects deleted """
+        now = now or time.time()
+        deleted = 0
+        if self.sample_retention:
+            for slot in self.expired(now, self.sample_retention):
+                for name in self.store.list(SAMPLES + str(slot) + '/'):
+                    self.store.delete(SAMPLES + str(slot) + '/' + name)
+                    deleted += 1
+        if self.rollup_retention:
+            for slot in self.expired(now, self.rollup_retention):
+                if self.store.get(ROLLUPS + str(slot) + '.json') is not None:
+                    self.store.delete(ROLLUPS + str(slot) + '.json')
+                    deleted += 1
+        return deleted
+
+    def run(self, now=None, budget=None):
+        """ Rolls up the due slots within budget seconds. Returns the summaries """
+        start = time.time()
+        done = []
+        for slot in self.due(now or time.time()):
+            if budget is not None and time.time() - start > budget:
+                break
+            s = self.run_slot(slot)
+            if s is not None:
+                done.append(s)
+        return done
+
+
+if __name__ == '__main__':
+    import argparse
+    from object_store import LocalStore
+
+    p = argparse.ArgumentParser(description="Rolls up recorded IPSec statistics samples of a local folder")
+    p.add_argument("--folder", required=True, help="Folder of the samples (local copy of the metrics prefix)")
+    p.add_argument("--resolution", type=int, default=60, help="Seconds of a rollup window (default:60)")
+    p.add_argument("--slot", type=int, default=300, help="Seconds of a sample slot (default:300)")
+    p.add_argument("--grace", type=int, default=120, help="Seconds a slot stays open after its end (default:120)")
+    p.add_argument("--lookback", type=int, default=12, help="Slots looked back at (default:12)")
+    p.add_argument("--outliers", type=int, default=5, help="Outlier instances kept per window and metric (default:5)")
+    p.add_argument("--now", type=float, help="Time of the run, epoch seconds (default: now)")
+    args = p.parse_args()
+
+    store = LocalStore(args.folder)
+    r = MetricRollup(store, args.slot, args.resolution, args.grace, args.lookback, args.outliers)
+    for s in r.run(args.now):
+        print(json.dumps(s, sort_keys=True))
+        print(json.dumps(json.loads(store.get(ROLLUPS + str(s['slot']) + '.json').decode('utf-8')), indent=2, sort_keys=True))
@@ -0,0 +1,99 @@
+"""
+    S3 artifacts of the setup lambda (the setup script template, the pointer to the bootstrap
+    bundle), kept per container and revalidated by ETag
+
+   get(s3, bucket, key) returns the object, keyed by bucket and key with its ETag. An object
+   checked less than ArtifactMaxAgeSeconds (default 60) ago is served from memory (hit), an older
+   one is revalidated with a conditional GET, IfNoneMatch its ETag: S3 answers 304 Not Modified
+   without transferring the body (revalidated) or returns the changed object (fetched). With 0
+   every use revalidates, a change uploaded by aws_setup.py is seen at once.
+
+   derived(s3, bucket, key, name, build) keeps what is built from an object with it, the parsed
+   bootstrap pointer or the script template with the placeholders of the configuration already
+   rendered, and builds it again only when the ETag changes.
+
+   report() returns the hits, revalidations, fetches and bytes fetched since the previous report,
+   the lambda adds them to the span aws-calls of its invocation.
+
+    Copyright 2017-2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+    Licensed under the Apache License, Version 2.0 (the "License").
+    You may not use this file except in compliance with the License.
+    A copy of the License is located at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+   or in the "license" file accompanying this file. This file is distributed
+   on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+   express or implied. See the License for the specific language governing
+   permissions and limitations under the License.
+
+"""
+import os, threading, time
+import botocore
+
+_lock = threading.Lock()
+_artifacts = {}
+_counts = {'hits': 0, 'revalidated': 0, 'fetched': 0, 'bytes': 0}
+
+
+class Artifact(object):
+    """ Body and ETag of an object, with the values built from it """
+
+    def __init__(self, etag, body):
+        self.etag = etag
+        self.body = body
+        self.checked = time.time()
+        self.derived = {}
+
+
+def _count(name, n=1):
+    with _lock:
+        _counts[name] += n
+
+
+def get(s3, bucket, key):
+    """ The artifact of the object, from memory, revalidated or fetched """
+    a = _artifacts.get((bucket, key))
+    if a is not None and time.time() - a.checked < float(os.environ.get('ArtifactMaxAgeSeconds', '60')):
+        _count('hits')
+        return a
+    try:
+        obj = s3.get_object(Bucket=bucket, Key=key, **({'IfNoneMatch': a.etag} if a is not None else {}))
+    except botocore.exceptions.ClientError as e:
+        if a is None or e.response['Error']['Code'] not in ('304', 'NotModified'):
+            raise
+        a.checked = time.time()
+        _count('revalidated')
+        return a
+    a = Artifact(obj.get('ETag', ''), obj['Body'].read())
+    _artifacts[(bucket, key)] = a
+    _count('fetched')
+    _count('bytes', len(a.body))
+    return a
+
+
+def derived(s3, bucket, key, name, build):
+    """ build(body) of the current version of the object, built once per ETag """
+    a = get(s3, bucket, key)
+    if name not in a.derived:
+        a.derived[name] = build(a.body)
+    return a.derived[name]
+
+
+def report():
+    """ Cache use since the previous report, as span properties """
+    with _lock:
+        r = {'ArtifactHits': _counts['hits'], 'ArtifactRevalidated': _counts['revalidated'],
+             'ArtifactFetched': _counts['fetched'], 'ArtifactBytes': _counts['bytes']}
+        for name in _counts:
+            _counts[name] = 0
+    return r
+
+
+def reset():
+    """ Drops the artifacts and counts, for local runs with new objects """
+    with _lock:
+        _artifacts.clear()
+        for name in _counts:
+            _counts[name] = 0
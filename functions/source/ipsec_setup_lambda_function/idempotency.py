@@ -0,0 +1,127 @@
+#
+# Idempotency records of the enrollments, suppress duplicate setup events
+#
+# EventBridge may deliver an EC2 event more than once, Lambda retries a failed async invoke and
+# a re-enrollment run can overlap with a launch. A setup claims the key
+#   <instance-id>/<generation>
+# before it does any work, the generation is the certificate it replaces (the expiry tag, none
+# for a new instance). A second event with the same key finds the claim and is suppressed until
+# the record expires. A completed setup records the certificate it installed as done, so a
+# re-enrollment of the new certificate within the TTL is suppressed as well. A failed setup
+# records its claim as failed, the next event (the async retry of Lambda, a later EC2 event or
+# re-enrollment) takes it over and sets the instance up again.
+#
+# A record is {'s': status, 'e': expiry in epoch seconds}, an expired record counts as absent.
+#   DynamoDBIdempotencyStore - conditional PutItem on a table with the hash key k (string),
+#                              the TTL attribute e of the table removes the expired records
+#   FileIdempotencyStore     - JSON file locked with flock, for local runs and benchmarks
+#   MemoryIdempotencyStore   - in memory, for local runs against stubbed clients
+#
+# Copyright 2017-2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file. This file is distributed
+# on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+import fcntl, json, os, threading, time
+import botocore
+
+IN_FLIGHT = 'in-flight'
+COMPLETED = 'done'
+# a failed claim is taken over by the next claim of the key
+FAILED = 'failed'
+
+
+class DynamoDBIdempotencyStore(object):
+    """ Records in a DynamoDB table """
+
+    def __init__(self, dynamodb, table):
+        self.dynamodb = dynamodb
+        self.table = table
+
+    def claim(self, key, status, expires):
+        """ Records the key unless a live record not failed exists. Returns None if claimed, otherwise the live record """
+        now = int(time.time())
+        try:
+            self.dynamodb.put_item(TableName=self.table,
+                                   Item={'k': {'S': key}, 's': {'S': status}, 'e': {'N': str(int(expires))}},
+                                   ConditionExpression='attribute_not_exists(k) OR e < :now OR s = :failed',
+                                   ExpressionAttributeValues={':now': {'N': str(now)}, ':failed': {'S': FAILED}})
+            return None
+        except botocore.exceptions.ClientError as err:
+            if err.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+        item = self.dynamodb.get_item(TableName=self.table, Key={'k': {'S': key}}, ConsistentRead=True).get('Item')
+        if item is None or item['s']['S'] == FAILED:
+            # expired and removed or failed in between, claimed by nobody
+            return self.claim(key, status, expires)
+        return {'s': item['s']['S'], 'e': int(item['e']['N'])}
+
+    def put(self, key, status, expires):
+        self.dynamodb.put_item(TableName=self.table,
+                               Item={'k': {'S': key}, 's': {'S': status}, 'e': {'N': str(int(expires))}})
+
+
+class MemoryIdempotencyStore(object):
+    """ Records in memory """
+
+    def __init__(self):
+        self.records = {}
+        self.lock = threading.Lock()
+
+    def claim(self, key, status, expires):
+        with self.lock:
+            record = self.records.get(key)
+            if record is not None and record['e'] >= time.time() and record['s'] != FAILED:
+                return dict(record)
+            self.records[key] = {'s': status, 'e': int(expires)}
+            return None
+
+    def put(self, key, status, expires):
+        with self.lock:
+            self.records[key] = {'s': status, 'e': int(expires)}
+
+
+class FileIdempotencyStore(object):
+    """ Records in a JSON file, shared by the processes and threads that lock it """
+
+    def __init__(self, path):
+        self.path = path
+
+    def _update(self, change):
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                text = f.read()
+                now = time.time()
+                records = dict((k, r) for k, r in (json.loads(text) if text else {}).items() if r['e'] >= now)
+                result = change(records)
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(records, sort_keys=True))
+                f.flush()
+                os.fsync(f.fileno())
+                return result
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def claim(self, key, status, expires):
+        def change(records):
+            if key in records and records[key]['s'] != FAILED:
+                return records[key]
+            records[key] = {'s': status, 'e': int(expires)}
+            return None
+        return self._update(change)
+
+    def put(self, key, status, expires):
+        def change(records):
+            records[key] = {'s': status, 'e': int(expires)}
+        self._update(change)
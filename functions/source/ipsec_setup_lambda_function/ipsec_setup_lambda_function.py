@@ -3,6 +3,53 @@
 #   
 # Selector is Tag and Value from the enciroment variable 
 #
+# The setup is a resumable state machine (see setup_state_machine.py). Nothing waits inside
+# an invocation: the EC2 event starts the setup, the scheduled event {"ipsec-setup": "tick"}
+# resumes all instances waiting for the SSM agent or for the SSM command result.
+#
+#   AgentWaitSeconds      - max time for the SSM agent to come online (optional, default 120)
+#   CommandTimeoutSeconds - max time for the SSM command to complete (optional, default 3600)
+#   StateTagName          - instance tag holding the setup state (optional, default IPSecSetupState)
+#   ExpiryTagName         - instance tag set to the expiry of the installed certificate (optional, default IPSecCertExpiry)
+#   BatchMode             - true sends one SSM command per batch of instances (optional, default false)
+#   BatchWindowSeconds, BatchMaxInstances, BatchMaxScriptBytes
+#                         - min wait of the oldest ready instance, max instances and max script size
+#                           of a batch (optional, default 30, 50, 60000)
+#   BulkIssueSize         - instances of a batch whose certificates are issued with one invocation of
+#                           the certificate lambda (optional, default 10)
+#   HostStepTimings       - true reads the step timings reported by setup_ipsec.sh (optional, default true)
+#   DeliveryBucket        - bucket the certificates are handed to the hosts in instead of the SSM command
+#                           (optional, default empty: the certificate is inlined into the command)
+#   DeliveryPrefix        - key prefix of the handed over certificates (optional, default delivery/)
+#   DeliveryKmsKey        - KMS key the handed over certificates are encrypted with (optional, default
+#                           empty: SSE-S3), the hosts need kms:Decrypt on it
+#   DeliveryMaxAgeSeconds - age the tick deletes handed over certificates left behind at (optional, default 86400)
+#   EnrollmentMode        - csr generates the key on the host and has its certificate request signed,
+#                           pkcs12 issues key and certificate in the certificate lambda (optional, default pkcs12)
+#   CertRotation          - hot replaces the certificate of a running IPSec in place on re-enrollment, wipe
+#                           recreates the NSS DB (optional, default wipe)
+#   IdempotencyTable      - DynamoDB table of the idempotency records, duplicate events are suppressed
+#                           (optional, default empty: no suppression), see idempotency.py
+#   IdempotencyFile       - JSON file of the idempotency records instead of the table, for local runs
+#   IdempotencyTtlSeconds - seconds a duplicate of an enrollment is suppressed (optional, default 3600)
+#   ArtifactMaxAgeSeconds - seconds the script template and the bootstrap pointer are used before they are
+#                           revalidated with a conditional GET (optional, default 60), see artifact_cache.py
+#   MetricsBucket         - bucket the statistics agents write their readings to, rolled up to fleet metrics
+#                           by the metrics rollup lambda (optional, default empty: per instance metrics)
+#   MetricsPrefix         - key prefix of the readings (optional, default metrics/)
+#
+# Event {"detail": {"instance-id": ...}, "trace-id": ...} continues the trace of the
+# re-enrollment, an EC2 event starts a new trace. "force": "true" skips the duplicate check. Spans are EMF log lines, see tracing.py
+#
+# policy_handler pushes the policy groups and oe-cert.conf to the instances set up, without a re-setup
+# (see SetupMachine.push_policies). {"policy-push": "start"} sends the SSM command, {"policy-push": "status",
+# "command-ids": [...]} reports its progress
+#   PolicyMaxConcurrency, PolicyMaxErrors
+#                         - MaxConcurrency and MaxErrors of the policy push command (optional, default 100%, 10%)
+#
+# The AWS clients are created once per container (see aws_clients.py), the calls of each invocation
+# are emitted as the span aws-calls, with the use of the artifact cache
+#
 # Copyright 2017-2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
 #
 # Licensed under the Apache License, Version 2.0 (the "License").
@@ -16,113 +63,62 @@
 # express or implied. See the License for the specific language governing
 # permissions and limitations under the License.
 #
-import boto3
 import os, time,json
+import aws_clients, artifact_cache
+from setup_state_machine import SetupConfig, SetupMachine, TagStateStore
+from idempotency import DynamoDBIdempotencyStore, FileIdempotencyStore
+from tracing import new_trace_id
 
-def lambda_handler(event, context):
-
-    SelectorTagName=os.environ['SelectorTagName']
-    SelectorTagValue=os.environ['SelectorTagValue']
-    ResultTagValue=os.environ['ResultTagValue']
-    SourceBucket=os.environ['SourceBucket']
-    CertificateEnrollLambda=os.environ['CertificateEnrollLambda']
-    IPSecSetUpScript=os.environ['IPSecSetUpScript']
-    VpcId=os.environ['VpcId']
-    
-    ec2 = boto3.resource('ec2')
-    s3 =  boto3.client('s3')
-    
-    obj = s3.get_object(Bucket=SourceBucket, Key=IPSecSetUpScript)
-    template=obj['Body'].read().decode('utf-8') 
-    
-    
-    print('checking instance '+event["detail"]["instance-id"])
-    ec2 = boto3.resource('ec2')
-    r = ec2.Instance(id=event["detail"]["instance-id"])
+def idempotency():
+    if os.environ.get('IdempotencyTable', ''):
+        return DynamoDBIdempotencyStore(aws_clients.client('dynamodb'), os.environ['IdempotencyTable'])
+    if os.environ.get('IdempotencyFile', ''):
+        return FileIdempotencyStore(os.environ['IdempotencyFile'])
+    return None
 
-    if r.state["Code"] !=16 :
-         raise Exception('Failed. Instance '+ r.instance-id + ' is not running ( state:' + str(r.state["Name"]) + ')')
+def machine():
+    ec2 = aws_clients.client('ec2')
+    # the certificate lambda runs up to 120 seconds, a read timeout before would issue the certificate again
+    lmb = aws_clients.client('lambda', read_timeout=300)
+    return SetupMachine(SetupConfig(os.environ), ec2, aws_clients.client('ssm'), lmb, aws_clients.client('s3'),
+                        TagStateStore(ec2, os.environ.get('StateTagName', 'IPSecSetupState')), idempotency=idempotency())
 
-    # check if the right vpc-id           
-    if  VpcId != "any":
-        if r.vpc_id != VpcId:
-            print("Instance is in VPC " + r.vpc_id + " but operation restricted via params to VPC " + VpcId +  " Exit")
-            return 
-         
-    for tag in r.tags:
-        if tag['Key'] == SelectorTagName and ( tag['Value'] == SelectorTagValue or ( tag['Value'] == ResultTagValue and "certificate_only" in event)):    
-            # We need to  setup IPSec 
-            print('starting the IPSec configration and/or certificate enrollment on instances ' + r.id )
-            
-            ssm = boto3.client('ssm')
-            
-            # wait 120 sec max for the SSM agent on instance to become online 
-            repeat=10
-            while len(ssm.describe_instance_information(InstanceInformationFilterList= [{'key': 'InstanceIds', 'valueSet': [r.id]}, 
-                                                                                        {'key': 'PingStatus',  'valueSet': ['Online']}] )['InstanceInformationList']) < 1 and repeat > 0:
-                time.sleep(12)
-                repeat=repeat-1
-            
-            if repeat==0:
-                raise Exception('Instance not reachable in SSM. Check Instanc e Roles, SSM Agent or SecGroups')
-            
-            try:
-                
-                # Issue a certificate for the host
-                client = boto3.client('lambda')
+def aws_calls(m, trace_id, start):
+    m.tracer.record('aws-calls', trace_id or new_trace_id(), start, **dict(aws_clients.report(), **artifact_cache.report()))
 
-                cert_r = client.invoke(
-                    FunctionName=CertificateEnrollLambda,
-                    InvocationType='RequestResponse',
-                    LogType='Tail',
-                    Payload=json.dumps({"instance-id": r.id})
-                )
+def tick(m, context):
+    # resume every instance with a setup in flight, failures do not stop the others
+    time_left = (lambda: context.get_remaining_time_in_millis() / 1000.0) if context else None
+    failed = m.tick(time_left)
+    if failed:
+        raise Exception('Failed. IPSec setup failed on instances ' + ','.join(failed))
 
-                t = cert_r['Payload']
-                j = json.load(t)
-                
-                print('certificate genenerated')
-                
-                #  templates. change placeholder with values
-                if "certificate_only" in event:
-                    certonly="true"
-                    print('doing certificate reenrollment only')
-                else:
-                    certonly="false"
-                    print('doing ipsec setup and cert enrollment')
+def lambda_handler(event, context):
 
-                script=template.replace("{{configBucket}}",SourceBucket).replace("{{certificate}}",json.dumps(j)).replace("{{certificate_only}}",certonly)
-                print('script template run')
-                response=ssm.send_command(
-                    InstanceIds = [r.id],
-                    #Targets= [{"Key":"tag:"+SelectorTagName,"Values":[SelectorTagValue]} ],
-                    DocumentName='AWS-RunShellScript',
-                    TimeoutSeconds=3600,
-                    Comment='Initial IPSec setup with cert enrollment',
-                    Parameters={"commands":[script],"executionTimeout":["600"],"workingDirectory":["/tmp/"]},
-                    MaxConcurrency='5',
-                    MaxErrors='5',
-                )
-    
-                cmdId = response['Command']['CommandId']
-                print('Started IPSec config in CommandId: ' + cmdId)
-                
-            except Exception as err:
-	            raise err
-            
-            response = ssm.list_commands(CommandId=cmdId)
-            
-            while response['Commands'][0]['CompletedCount'] != response['Commands'][0]['TargetCount']:
-                time.sleep(10)
-                
-                response = ssm.list_commands(CommandId=cmdId)
-    
-            if response['Commands'][0]['ErrorCount'] != 0:
-                  raise Exception('Failed. Confguring IPSec on the instance failed. Check Output Log of E2 SSM Command Id '+ cmdId + '')
-            
-            ec2 = boto3.client('ec2')
-            r = ec2.delete_tags(Resources=[event["detail"]["instance-id"]],Tags=[{"Key": SelectorTagName,"Value":SelectorTagValue}])
-            r = ec2.create_tags(Resources=[event["detail"]["instance-id"]],Tags=[{"Key": SelectorTagName,"Value":ResultTagValue}])
+    start = time.time()
+    m = machine()
+    try:
+        if event.get('ipsec-setup') == 'tick':
+            tick(m, context)
+        else:
+            m.start(event["detail"]["instance-id"], "certificate_only" in event, event.get("trace-id"),
+                    event.get("force") in (True, "true"))
+    finally:
+        aws_calls(m, event.get("trace-id"), start)
             
     print('IPsec configuration exit')
-    
+
+def policy_handler(event, context):
+    # policy push to the instances set up: {"policy-push": "start"} returns the command ids,
+    # {"policy-push": "status", "command-ids": [...], "reports": true} the progress of the push
+    start = time.time()
+    m = machine()
+    try:
+        if event.get('policy-push') == 'status':
+            result = m.policy_status(event['command-ids'], event.get('reports') in (True, 'true'))
+        else:
+            result = {'command-ids': m.push_policies(event.get('trace-id'))}
+    finally:
+        aws_calls(m, event.get('trace-id'), start)
+    print('IPsec policy push: ' + json.dumps(result))
+    return result
@@ -0,0 +1,923 @@
+#
+# Resumable IPSec setup of an instance, modelled as a state machine
+#
+#   wait-for-agent -> issue-cert -> send-command -> await-result -> retag -> done
+#
+# A step either completes and the next step runs in the same invocation, or it has to wait
+# (SSM agent not online yet, command still running). Then the state is persisted and the
+# invocation returns. The next EC2 event or the scheduled tick resumes the instance, no
+# invocation sleeps. The certificate is not persisted, a resume before the command was
+# sent issues it again.
+#
+# With EnrollmentMode csr the host generates its key: after the agent is online a first SSM
+# command (request-csr) has setup_ipsec.sh generate the key in the NSS DB of libreswan and
+# print the certificate request (IPSEC-CSR <base64 DER>) on stdout. await-csr reads it with
+# get_command_invocation and the certificate lambda only signs it, the certificate is sent in
+# the second command as usual. The request is read again from the first command on a resume.
+# If the host can not generate the key, the certificate is issued as PKCS12 (pkcs12, default).
+#
+#   wait-for-agent -> request-csr -> await-csr -> issue-cert | batch-ready -> ...
+#
+# With DeliveryBucket set, the certificate is not inlined into the SSM command. It is stored
+# under DeliveryPrefix (default delivery/) as <token>/<instance-id>.json, encrypted with the
+# KMS key DeliveryKmsKey (the key of the P12 passwords, the hosts can decrypt with it), and the
+# command carries only s3://<bucket>/<prefix><token>/, from which setup_ipsec.sh fetches the
+# object of its own instance. The token is kept in the state, so a resume sends the stored
+# certificate instead of issuing another one. The objects are deleted once the command
+# completed, the tick deletes the ones left behind after DeliveryMaxAgeSeconds (default 86400),
+# also in a bucket without the lifecycle rule of the stack.
+#
+# In batch mode (BatchMode true) an instance with an online agent waits in batch-ready. The
+# scheduled tick issues the certificates of all ready instances and sends one SSM command to
+# up to BatchMaxInstances of them, once the oldest waited BatchWindowSeconds or the batch is
+# full. The certificates are issued with one bulk invocation of the certificate lambda per
+# BulkIssueSize (default 10) instances, an instance it could not issue fails alone. The command carries the certificates of all instances of the batch keyed by instance id
+# (BatchMaxScriptBytes bounds its size), setup_ipsec.sh picks its own. With DeliveryBucket set
+# all instances of the batch share one token and the command text does not depend on the
+# number of instances, a batch is not split. The per-instance
+# results are read with list_command_invocations and the instances are retagged in bulk, each
+# with the expiry of its own certificate (one call per expiry).
+#
+#   batch-ready -> await-batch -> done
+#
+# The state is kept in the instance tag StateTagName (default IPSecSetupState) as compact JSON
+#   s - step, o - certificate only, t - setup started, u - step started, c - SSM command id,
+#   x - certificate expiry, r - trace id, d - delivery token, k - 1 if the host generated the key
+# MemoryStateStore keeps it in memory for local runs against stubbed clients.
+#
+# With an idempotency store (see idempotency.py) an event claims <instance-id>/<generation> before
+# the setup starts or resumes, the generation is the certificate expiry tag (none for a new
+# instance). A duplicate event, an async retry or an overlapping re-enrollment of the same
+# generation within IdempotencyTtlSeconds (default 3600) is suppressed and emitted as a span
+# duplicate-suppressed, its count is the metric of suppressed work. A completed setup records
+# its new certificate as done, a failed setup marks its claim failed (see released), so the next
+# event sets the instance up again. An event with "force" skips the check.
+#
+# Every completed step is emitted as a span (see tracing.py) of the trace of the setup, timed
+# from the step start across invocations. The trace id is passed to the certificate lambda and
+# to setup_ipsec.sh, which reports its step timings on stderr in a line
+#   IPSEC-TRACE {"trace": ..., "exit": ..., "steps": [{"step": ..., "start": ms, "ms": ...}]}
+# that is read with get_command_invocation once the command completed (HostStepTimings, default
+# true) and emitted as spans of the function IPSecHost. A batch command has a trace of its own.
+#
+# With CertRotation hot a re-enrollment replaces the certificate of the running IPSec in place
+# (see switch_certificate in setup_ipsec.sh) instead of recreating the NSS DB (wipe, default).
+# The host adds "rotation": {"mode": hot|restart, "sasBefore": ..., "sasAfter": ..., "disrupted": ...}
+# to its IPSEC-TRACE line, it is logged and kept with the host-setup span.
+#
+# The script template and the bootstrap pointer are read through artifact_cache.py, kept by the
+# container and revalidated by ETag, only when a command is rendered. A host keeps the files it
+# downloads one by one in /root/ipsec with their ETags and downloads only the changed ones, it adds
+# "cache": {"hits": ..., "fetched": ...} to its IPSEC-TRACE line (host-setup span CacheHits, CacheFetched).
+#
+# Copyright 2017-2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# or in the "license" file accompanying this file. This file is distributed
+# on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either
+# express or implied. See the License for the specific language governing
+# permissions and limitations under the License.
+#
+import json, time, calendar
+import botocore
+import artifact_cache
+from tracing import Tracer, new_trace_id, new_id
+from idempotency import IN_FLIGHT, COMPLETED, FAILED
+
+WAIT_FOR_AGENT = 'wait-for-agent'
+REQUEST_CSR = 'request-csr'
+AWAIT_CSR = 'await-csr'
+ISSUE_CERT = 'issue-cert'
+SEND_COMMAND = 'send-command'
+AWAIT_RESULT = 'await-result'
+RETAG = 'retag'
+BATCH_READY = 'batch-ready'
+AWAIT_BATCH = 'await-batch'
+DONE = 'done'
+
+HOST_TRACE = 'IPSEC-TRACE '
+HOST_CSR = 'IPSEC-CSR '
+
+# terminal status of a command invocation
+INVOCATION_FAILED = ('Cancelled', 'TimedOut', 'Failed', 'DeliveryTimedOut', 'ExecutionTimedOut', 'Undeliverable', 'Terminated')
+
+
+class SetupFailed(Exception):
+    pass
+
+
+class TagStateStore(object):
+    """ State in an instance tag """
+
+    def __init__(self, ec2, tag_name):
+        self.ec2 = ec2
+        self.tag_name = tag_name
+
+    def load(self, instance):
+        for tag in instance.get('Tags', []):
+            if tag['Key'] == self.tag_name:
+                return json.loads(tag['Value'])
+        return None
+
+    def save(self, instance_id, state):
+        self.save_many([instance_id], state)
+
+    def save_many(self, instance_ids, state):
+        self.ec2.create_tags(Resources=instance_ids,
+                             Tags=[{"Key": self.tag_name, "Value": json.dumps(state, separators=(',', ':'))}])
+
+    def clear(self, instance_id):
+        self.clear_many([instance_id])
+
+    def clear_many(self, instance_ids):
+        self.ec2.delete_tags(Resources=instance_ids, Tags=[{"Key": self.tag_name}])
+
+    def states(self):
+        """ Persisted state of all running instances with a setup in flight """
+        states = {}
+        paginator = self.ec2.get_paginator('describe_instances')
+        for page in paginator.paginate(Filters=[{"Name": "tag-key", "Values": [self.tag_name]},
+                                                {"Name": "instance-state-name", "Values": ["running"]}]):
+            for res in page['Reservations']:
+                for i in res['Instances']:
+                    states[i['InstanceId']] = self.load(i)
+        return states
+
+    def in_flight(self):
+        """ Instance ids with a persisted state """
+        return list(self.states().keys())
+
+
+class MemoryStateStore(object):
+    """ State in memory, stand-in for the instance tag in local runs """
+
+    def __init__(self):
+        self.saved = {}
+
+    def load(self, instance):
+        return self.saved.get(instance['InstanceId'])
+
+    def save(self, instance_id, state):
+        self.save_many([instance_id], state)
+
+    def save_many(self, instance_ids, state):
+        for i in instance_ids:
+            self.saved[i] = dict(state)
+
+    def clear(self, instance_id):
+        self.clear_many([instance_id])
+
+    def clear_many(self, instance_ids):
+        for i in instance_ids:
+            self.saved.pop(i, None)
+
+    def states(self):
+        return dict((i, dict(st)) for i, st in self.saved.items())
+
+    def in_flight(self):
+        return list(self.saved.keys())
+
+
+class SetupConfig(object):
+
+    def __init__(self, env):
+        self.selector_tag_name = env['SelectorTagName']
+        self.selector_tag_value = env['SelectorTagValue']
+        self.result_tag_value = env['ResultTagValue']
+        self.expiry_tag_name = env.get('ExpiryTagName', 'IPSecCertExpiry')
+        self.source_bucket = env['SourceBucket']
+        self.source_prefix = env.get('SourcePrefix', '')
+        self.certificate_lambda = env['CertificateEnrollLambda']
+        self.setup_script = env['IPSecSetUpScript']
+        self.vpc_id = env['VpcId']
+        self.agent_wait = int(env.get('AgentWaitSeconds', '120'))
+        self.command_timeout = int(env.get('CommandTimeoutSeconds', '3600'))
+        self.batch_mode = env.get('BatchMode', 'false') == 'true'
+        self.batch_window = int(env.get('BatchWindowSeconds', '30'))
+        self.batch_max = int(env.get('BatchMaxInstances', '50'))
+        self.batch_max_bytes = int(env.get('BatchMaxScriptBytes', '60000'))
+        self.bulk_issue_size = int(env.get('BulkIssueSize', '10'))
+        self.bundle_url_seconds = int(env.get('BundleUrlSeconds', '3600'))
+        self.host_timings = env.get('HostStepTimings', 'true') == 'true'
+        self.delivery_bucket = env.get('DeliveryBucket', '')
+        self.delivery_prefix = env.get('DeliveryPrefix', 'delivery/')
+        self.delivery_kms_key = env.get('DeliveryKmsKey', '')
+        self.delivery_max_age = int(env.get('DeliveryMaxAgeSeconds', '86400'))
+        self.csr_mode = env.get('EnrollmentMode', 'pkcs12') == 'csr'
+        self.cert_rotation = env.get('CertRotation', 'wipe')
+        self.idempotency_ttl = int(env.get('IdempotencyTtlSeconds', '3600'))
+        self.policy_max_concurrency = env.get('PolicyMaxConcurrency', '100%')
+        self.policy_max_errors = env.get('PolicyMaxErrors', '10%')
+        self.metrics_bucket = env.get('MetricsBucket', '')
+        self.metrics_prefix = env.get('MetricsPrefix', 'metrics/')
+
+
+class SetupMachine(object):
+
+    def __init__(self, config, ec2, ssm, lmb, s3, store, tracer=None, idempotency=None):
+        self.config = config
+        self.ec2 = ec2
+        self.ssm = ssm
+        self.lmb = lmb
+        self.s3 = s3
+        self.store = store
+        self.template = None
+        self.bundle = None
+        self.tracer = tracer or Tracer('IPSecSetup')
+        self.idempotency = idempotency
+        self.suppressed = 0
+
+    def describe(self, instance_id):
+        r = self.ec2.describe_instances(InstanceIds=[instance_id])
+        return r['Reservations'][0]['Instances'][0]
+
+    def selected(self, instance, certificate_only):
+        for tag in instance.get('Tags', []):
+            if tag['Key'] == self.config.selector_tag_name and (tag['Value'] == self.config.selector_tag_value or (
+                    tag['Value'] == self.config.result_tag_value and certificate_only)):
+                return True
+        return False
+
+    def generation(self, instance_id, instance=None, not_after=None):
+        # idempotency key, the certificate the enrollment replaces
+        if instance is not None:
+            not_after = next((t['Value'] for t in instance.get('Tags', []) if t['Key'] == self.config.expiry_tag_name), None)
+        return instance_id + '/' + (not_after or 'none')
+
+    def duplicate(self, instance_id, instance, state, trace_id):
+        """ Claims the generation of the instance. True if another event claimed it """
+        if self.idempotency is None:
+            return False
+        key = self.generation(instance_id, instance)
+        seen = self.idempotency.claim(key, IN_FLIGHT, time.time() + self.config.idempotency_ttl)
+        if seen is None:
+            return False
+        self.suppressed += 1
+        print('duplicate enrollment of instance ' + instance_id + ' (' + key + ' ' + seen['s'] + '), suppressed')
+        self.tracer.record('duplicate-suppressed', trace_id or (state or {}).get('r') or new_trace_id(), time.time(),
+                           InstanceId=instance_id, Generation=key, Previous=seen['s'])
+        return True
+
+    def released(self, instance_ids):
+        # a failed setup gives up its claim, the next event of the instance is not a duplicate
+        if self.idempotency is None or not instance_ids:
+            return
+        try:
+            instances = [i for r in self.ec2.describe_instances(InstanceIds=list(instance_ids))['Reservations'] for i in r['Instances']]
+            for instance in instances:
+                self.idempotency.put(self.generation(instance['InstanceId'], instance), FAILED,
+                                     time.time() + self.config.idempotency_ttl)
+        except botocore.exceptions.ClientError as err:
+            print('Idempotency records of instances ' + ','.join(instance_ids) + ' not released: ' + str(err))
+
+    def completed(self, instance_ids, not_after):
+        # a re-enrollment of the certificate just installed is a duplicate too
+        if self.idempotency is None or not not_after:
+            return
+        for instance_id in instance_ids:
+            try:
+                self.idempotency.put(self.generation(instance_id, not_after=not_after), COMPLETED,
+                                     time.time() + self.config.idempotency_ttl)
+            except botocore.exceptions.ClientError as err:
+                print('Idempotency record of instance ' + instance_id + ' not written: ' + str(err))
+
+    def start(self, instance_id, certificate_only, trace_id=None, force=False):
+        """ Entry of an EC2 event or re-enrollment. Starts the setup or resumes it if already in flight """
+        print('checking instance ' + instance_id)
+        instance = self.describe(instance_id)
+
+        if instance['State']['Code'] != 16:
+            raise SetupFailed('Failed. Instance ' + instance_id + ' is not running ( state:' + str(instance['State']['Name']) + ')')
+
+        # check if the right vpc-id
+        if self.config.vpc_id != "any" and instance.get('VpcId') != self.config.vpc_id:
+            print("Instance is in VPC " + str(instance.get('VpcId')) + " but operation restricted via params to VPC " + self.config.vpc_id + " Exit")
+            return None
+
+        state = self.store.load(instance)
+        if state is None and not self.selected(instance, certificate_only):
+            print('instance ' + instance_id + ' not selected by tag ' + self.config.selector_tag_name)
+            return None
+
+        if not force and self.duplicate(instance_id, instance, state, trace_id):
+            return None
+
+        if state is not None:
+            print('setup of instance ' + instance_id + ' already in step ' + state['s'] + ', resuming')
+            return self.advance(instance_id, state)
+
+        trace_id = trace_id or new_trace_id()
+        print('starting the IPSec configration and/or certificate enrollment on instances ' + instance_id + ' trace ' + trace_id)
+        now = int(time.time())
+        return self.advance(instance_id, {'s': WAIT_FOR_AGENT, 'o': 1 if certificate_only else 0, 't': now, 'u': now, 'r': trace_id})
+
+    def resume(self, instance_id):
+        """ Resumes one instance """
+        state = self.store.load(self.describe(instance_id))
+        if state is None:
+            return None
+        return self.advance(instance_id, state)
+
+    def tick(self, time_left=None):
+        """ Entry of the scheduled tick. Resumes all setups in flight, dispatches and collects batches.
+            Failures do not stop the other instances. Returns the failed instance ids """
+        failed = []
+        states = self.store.states()
+        for instance_id, state in states.items():
+            if state is None or state['s'] in (BATCH_READY, AWAIT_BATCH):
+                continue
+            if time_left is not None and time_left() < 30:
+                print('Not enough time left, remaining instances are resumed by the next tick')
+                return failed
+            try:
+                self.advance(instance_id, state)
+            except Exception as err:
+                print('IPsec setup of instance ' + instance_id + ' failed: ' + str(err))
+                failed.append(instance_id)
+
+        if self.config.batch_mode:
+            failed += self.collect_batches(states)
+            failed += self.dispatch_batches(states)
+        try:
+            self.sweep_deliveries()
+        except botocore.exceptions.ClientError as err:
+            print('Delivered certificates not swept: ' + str(err))
+        return failed
+
+    def advance(self, instance_id, state):
+        """ Runs steps until one has to wait or the setup is done. Returns the step reached """
+        ctx = {}
+        step = state['s']
+        trace_id = state.setdefault('r', new_trace_id())
+        # the first step may have started in an earlier invocation
+        started = state['u']
+        try:
+            while step != DONE:
+                ctx['span'] = new_id()
+                try:
+                    next_step = getattr(self, 'step_' + step.replace('-', '_'))(instance_id, state, ctx)
+                except Exception:
+                    self.tracer.record(step, trace_id, started, span_id=ctx['span'], status='error', InstanceId=instance_id)
+                    raise
+                if next_step is None:
+                    # step waits, resume later
+                    self.store.save(instance_id, state)
+                    print('instance ' + instance_id + ' waits in step ' + step)
+                    return step
+                self.tracer.record(step, trace_id, started, span_id=ctx['span'], InstanceId=instance_id)
+                print('instance ' + instance_id + ' step ' + step + ' done')
+                step = state['s'] = next_step
+                started = time.time()
+                state['u'] = int(started)
+        except Exception:
+            self.store.clear(instance_id)
+            self.released([instance_id])
+            raise
+        if 't' in state:
+            self.tracer.record('setup', trace_id, state['t'], InstanceId=instance_id, CertificateOnly=bool(state['o']))
+        return DONE
+
+    def step_wait_for_agent(self, instance_id, state, ctx):
+        online = self.ssm.describe_instance_information(InstanceInformationFilterList=[
+            {'key': 'InstanceIds', 'valueSet': [instance_id]},
+            {'key': 'PingStatus', 'valueSet': ['Online']}])['InstanceInformationList']
+        if len(online) > 0:
+            if self.config.csr_mode:
+                return REQUEST_CSR
+            return BATCH_READY if self.config.batch_mode else ISSUE_CERT
+        if time.time() - state['u'] > self.config.agent_wait:
+            raise SetupFailed('Instance not reachable in SSM. Check Instanc e Roles, SSM Agent or SecGroups')
+        return None
+
+    def step_request_csr(self, instance_id, state, ctx):
+        script = self.render('', 'true' if state['o'] else 'false', state['r'], csr_request='true')
+        response = self.ssm.send_command(
+            InstanceIds=[instance_id],
+            DocumentName='AWS-RunShellScript',
+            TimeoutSeconds=3600,
+            Comment='IPSec host key and certificate request trace ' + state['r'],
+            Parameters={"commands": [script], "executionTimeout": ["600"], "workingDirectory": ["/tmp/"]},
+            MaxConcurrency='5',
+            MaxErrors='5',
+        )
+        state['c'] = response['Command']['CommandId']
+        print('Requested the certificate request in CommandId: ' + state['c'])
+        return AWAIT_CSR
+
+    def step_await_csr(self, instance_id, state, ctx):
+        command = self.ssm.list_commands(CommandId=state['c'])['Commands'][0]
+        if command['CompletedCount'] != command['TargetCount']:
+            if time.time() - state['u'] > self.config.command_timeout:
+                raise SetupFailed('Failed. SSM Command Id ' + state['c'] + ' did not complete in time')
+            return None
+        self.host_steps(state['c'], instance_id, state['r'], ctx['span'])
+        if command['ErrorCount'] == 0:
+            ctx['csr'] = self.read_csr(state['c'], instance_id)
+        if ctx.get('csr'):
+            state['k'] = 1
+        else:
+            print('No certificate request of instance ' + instance_id + ' in SSM Command Id ' + state['c'] + ', issuing PKCS12')
+        return BATCH_READY if self.config.batch_mode else ISSUE_CERT
+
+    def read_csr(self, command_id, instance_id):
+        # the request stays in the output of the command, read again on a resume
+        out = self.ssm.get_command_invocation(CommandId=command_id, InstanceId=instance_id).get('StandardOutputContent', '')
+        for line in out.splitlines():
+            if line.startswith(HOST_CSR):
+                return line[len(HOST_CSR):].strip()
+        return None
+
+    def host_csr(self, instance_id, state, ctx=None):
+        """ Certificate request of the host or None if the key is generated by the certificate lambda """
+        if not state.get('k'):
+            return None
+        csr = (ctx or {}).get('csr') or self.read_csr(state['c'], instance_id)
+        if not csr:
+            raise SetupFailed('Failed. Certificate request of instance ' + instance_id + ' not found in SSM Command Id ' + state['c'])
+        return csr
+
+    def issue_certificate(self, instance_id, trace_id, parent_id, csr=None):
+        payload = {"instance-id": instance_id, "trace-id": trace_id, "parent-id": parent_id}
+        if csr:
+            payload['csr'] = csr
+        cert_r = self.lmb.invoke(
+            FunctionName=self.config.certificate_lambda,
+            InvocationType='RequestResponse',
+            LogType='Tail',
+            Payload=json.dumps(payload)
+        )
+        if cert_r.get('FunctionError'):
+            raise SetupFailed('Failed. Certificate issuance for instance ' + instance_id + ' failed: ' + cert_r['Payload'].read().decode('utf-8'))
+        return json.load(cert_r['Payload'])
+
+    def issue_certificates(self, instance_ids, trace_id, parent_id, csrs):
+        """ Bulk issuance, returns the output of the certificate lambda keyed by instance id """
+        payload = {"instance-ids": instance_ids, "trace-id": trace_id, "parent-id": parent_id}
+        if csrs:
+            payload['csrs'] = csrs
+        cert_r = self.lmb.invoke(
+            FunctionName=self.config.certificate_lambda,
+            InvocationType='RequestResponse',
+            Payload=json.dumps(payload)
+        )
+        if cert_r.get('FunctionError'):
+            raise SetupFailed('Failed. Certificate issuance for ' + str(len(instance_ids)) + ' instances failed: ' + cert_r['Payload'].read().decode('utf-8'))
+        return json.load(cert_r['Payload'])['results']
+
+    def host_certificate(self, j):
+        # the host needs only the PKCS12 and its encrypted password (KMS or envelope),
+        # or the certificate and the CA certificate if it generated the key
+        if j.get('CERT_P12_B64'):
+            return dict((k, v) for k, v in j.items() if k.startswith('CERT_P12_'))
+        return {'CERT_PEM_B64': j['CERT_PEM_B64'], 'CERT_CA_PEM_B64': j.get('CERT_CA_PEM_B64', '')}
+
+    def delivery_key(self, token, instance_id):
+        return self.config.delivery_prefix + token + '/' + instance_id + '.json'
+
+    def delivery_url(self, token):
+        return 's3://' + self.config.delivery_bucket + '/' + self.config.delivery_prefix + token + '/'
+
+    def deliver(self, token, instance_id, certificate):
+        # with the KMS key reading the object needs kms:Decrypt, as the encrypted P12 password does
+        encryption = {'ServerSideEncryption': 'AES256'}
+        if self.config.delivery_kms_key:
+            encryption = {'ServerSideEncryption': 'aws:kms', 'SSEKMSKeyId': self.config.delivery_kms_key}
+        self.s3.put_object(Bucket=self.config.delivery_bucket, Key=self.delivery_key(token, instance_id),
+                           Body=json.dumps(certificate).encode('utf-8'), ContentType='application/json', **encryption)
+
+    def discard(self, token, instance_ids):
+        # best effort, the lifecycle rule of the bucket expires what is left
+        try:
+            for start in range(0, len(instance_ids), 1000):
+                self.s3.delete_objects(Bucket=self.config.delivery_bucket, Delete={
+                    'Objects': [{'Key': self.delivery_key(token, i)} for i in instance_ids[start:start + 1000]], 'Quiet': True})
+        except botocore.exceptions.ClientError as err:
+            print('Delivered certificates of ' + token + ' not deleted: ' + str(err))
+
+    def sweep_deliveries(self, now=None):
+        """ Deletes the delivered certificates older than DeliveryMaxAgeSeconds, of setups that did
+            not complete. Returns the number deleted """
+        if not self.config.delivery_bucket or not self.config.delivery_max_age:
+            return 0
+        cutoff = (now or time.time()) - self.config.delivery_max_age
+        old = []
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.config.delivery_bucket, Prefix=self.config.delivery_prefix):
+            old += [o['Key'] for o in page.get('Contents', []) if calendar.timegm(o['LastModified'].utctimetuple()) < cutoff]
+        for start in range(0, len(old), 1000):
+            self.s3.delete_objects(Bucket=self.config.delivery_bucket, Delete={
+                'Objects': [{'Key': k} for k in old[start:start + 1000]], 'Quiet': True})
+        if old:
+            print('Deleted ' + str(len(old)) + ' delivered certificates older than ' + str(self.config.delivery_max_age) + 's')
+        return len(old)
+
+    def step_issue_cert(self, instance_id, state, ctx):
+        # Issue a certificate for the host
+        j = self.issue_certificate(instance_id, state['r'], ctx['span'], self.host_csr(instance_id, state, ctx))
+        state['x'] = j.get('CERT_NOT_AFTER', '')
+        if self.config.delivery_bucket:
+            state['d'] = new_id()
+            self.deliver(state['d'], instance_id, self.host_certificate(j))
+            print('certificate genenerated and stored under ' + self.delivery_key(state['d'], instance_id))
+        else:
+            ctx['certificate'] = self.host_certificate(j)
+            print('certificate genenerated')
+        return SEND_COMMAND
+
+    def metrics_url(self):
+        # the statistics agent writes its readings for the fleet rollup, empty: per instance metrics
+        if not self.config.metrics_bucket:
+            return ''
+        return 's3://' + self.config.metrics_bucket + '/' + self.config.metrics_prefix
+
+    def render(self, certificate, certonly, trace_id, delivery='', csr_request='false', policy_only='false'):
+        bundle = self.load_bundle()
+        return self.load_template().replace(
+            "{{bundleUrl}}", bundle['url']).replace("{{bundleVersion}}", bundle['version']).replace(
+            "{{bundleSha256}}", bundle['sha256']).replace("{{traceId}}", trace_id).replace(
+            "{{deliveryUrl}}", delivery).replace("{{csrRequest}}", csr_request).replace(
+            "{{policyOnly}}", policy_only).replace(
+            "{{certificate}}", certificate).replace(
+            "{{certificate_only}}", certonly)
+
+    def load_bundle(self):
+        # bootstrap bundle uploaded by aws_setup.py, without it the host downloads the files one by one
+        # the presigned URL is renewed at half of its validity, a host may run the script later than it is sent
+        if self.bundle is None or time.time() > self.bundle['expires']:
+            try:
+                current = artifact_cache.derived(self.s3, self.config.source_bucket, self.config.source_prefix + 'bootstrap/current.json',
+                                                 'pointer', lambda body: json.loads(body.decode('utf-8')))
+                url = self.s3.generate_presigned_url('get_object', Params={'Bucket': self.config.source_bucket, 'Key': current['key']},
+                                                     ExpiresIn=self.config.bundle_url_seconds)
+                self.bundle = {'url': url, 'version': current['version'], 'sha256': current['sha256'],
+                               'expires': time.time() + self.config.bundle_url_seconds / 2}
+            except botocore.exceptions.ClientError as e:
+                if e.response['Error']['Code'] not in ('NoSuchKey', 'AccessDenied'):
+                    raise
+                print('no bootstrap bundle, files are downloaded one by one')
+                self.bundle = {'url': '', 'version': '', 'sha256': '', 'expires': float('inf')}
+        return self.bundle
+
+    def load_template(self):
+        # read once per invocation, the placeholders of the configuration are rendered once per version of the script
+        if self.template is not None:
+            return self.template
+        static = [("{{configBucket}}", self.config.source_bucket), ("{{rotation}}", self.config.cert_rotation),
+                  ("{{metricsUrl}}", self.metrics_url())]
+
+        def prerender(body):
+            template = body.decode('utf-8')
+            for placeholder, value in static:
+                template = template.replace(placeholder, value)
+            return template
+        self.template = artifact_cache.derived(self.s3, self.config.source_bucket, self.config.setup_script,
+                                               'template ' + repr(static), prerender)
+        return self.template
+
+    def step_send_command(self, instance_id, state, ctx):
+        if 'certificate' not in ctx and 'd' not in state:
+            # resumed after the certificate was issued but before the command was sent
+            return ISSUE_CERT
+
+        #  templates. change placeholder with values
+        if state['o']:
+            certonly = "true"
+            print('doing certificate reenrollment only')
+        else:
+            certonly = "false"
+            print('doing ipsec setup and cert enrollment')
+
+        if 'd' in state:
+            script = self.render('', certonly, state['r'], self.delivery_url(state['d']))
+        else:
+            script = self.render(json.dumps(ctx['certificate']), certonly, state['r'])
+        print('script template run')
+        response = self.ssm.send_command(
+            InstanceIds=[instance_id],
+            DocumentName='AWS-RunShellScript',
+            TimeoutSeconds=3600,
+            Comment='Initial IPSec setup with cert enrollment trace ' + state['r'],
+            Parameters={"commands": [script], "executionTimeout": ["600"], "workingDirectory": ["/tmp/"]},
+            MaxConcurrency='5',
+            MaxErrors='5',
+        )
+        state['c'] = response['Command']['CommandId']
+        print('Started IPSec config in CommandId: ' + state['c'])
+        return AWAIT_RESULT
+
+    def step_await_result(self, instance_id, state, ctx):
+        command = self.ssm.list_commands(CommandId=state['c'])['Commands'][0]
+        if command['CompletedCount'] != command['TargetCount']:
+            if time.time() - state['u'] > self.config.command_timeout:
+                raise SetupFailed('Failed. SSM Command Id ' + state['c'] + ' did not complete in time')
+            return None
+        self.host_steps(state['c'], instance_id, state['r'], ctx['span'])
+        if 'd' in state:
+            self.discard(state.pop('d'), [instance_id])
+        if command['ErrorCount'] != 0:
+            raise SetupFailed('Failed. Confguring IPSec on the instance failed. Check Output Log of E2 SSM Command Id ' + state['c'] + '')
+        return RETAG
+
+    def host_steps(self, command_id, instance_id, trace_id, parent_id=None, force=False):
+        # step timings reported by setup_ipsec.sh on stderr, a missing report does not fail the setup
+        # returns the report of the host, None if there is none
+        if not self.config.host_timings and not force:
+            return None
+        try:
+            out = self.ssm.get_command_invocation(CommandId=command_id, InstanceId=instance_id).get('StandardErrorContent', '')
+        except botocore.exceptions.ClientError as err:
+            print('No step timings of instance ' + instance_id + ': ' + str(err))
+            return None
+        report = None
+        for line in out.splitlines():
+            if not line.startswith(HOST_TRACE):
+                continue
+            try:
+                report = json.loads(line[len(HOST_TRACE):])
+                steps = report['steps']
+                status = 'ok' if report['exit'] == 0 else 'error'
+                span_id = new_id()
+                for i, s in enumerate(steps):
+                    # a failed script stops in its last step
+                    self.tracer.record('host-' + s['step'], trace_id, s['start'] / 1000.0, (s['start'] + s['ms']) / 1000.0,
+                                       parent_id=span_id, status=status if i == len(steps) - 1 else 'ok',
+                                       function='IPSecHost', InstanceId=instance_id)
+                rotation = {}
+                if report.get('rotation'):
+                    r = report['rotation']
+                    print('instance ' + instance_id + ' rotated its certificate (' + r['mode'] + '), ' + str(r['disrupted']) +
+                          ' of ' + str(r['sasBefore']) + ' SAs disrupted')
+                    rotation = {'Rotation': r['mode'], 'SAsBefore': r['sasBefore'], 'SAsAfter': r['sasAfter'], 'SAsDisrupted': r['disrupted']}
+                if report.get('policy'):
+                    r = report['policy']
+                    print('instance ' + instance_id + ' updated policies ' + ','.join(r['changed']) + ' (' + r['mode'] + '), ' +
+                          str(r['disrupted']) + ' of ' + str(r['sasBefore']) + ' SAs disrupted')
+                    rotation = {'PolicyReload': r['mode'], 'PoliciesChanged': len(r['changed']), 'SAsBefore': r['sasBefore'],
+                                'SAsAfter': r['sasAfter'], 'SAsDisrupted': r['disrupted']}
+                if report.get('cache'):
+                    rotation.update({'CacheHits': report['cache']['hits'], 'CacheFetched': report['cache']['fetched']})
+                if steps:
+                    self.tracer.record('host-setup', trace_id, steps[0]['start'] / 1000.0,
+                                       (steps[-1]['start'] + steps[-1]['ms']) / 1000.0, span_id=span_id, parent_id=parent_id,
+                                       status=status, function='IPSecHost', InstanceId=instance_id, ExitCode=report['exit'], **rotation)
+            except (ValueError, KeyError, TypeError) as err:
+                print('Invalid step timings of instance ' + instance_id + ': ' + str(err))
+                report = None
+        return report
+
+    def result_tags(self, not_after):
+        # the expiry of the installed certificate is the inventory of the expiry-aware renewal
+        tags = [{"Key": self.config.selector_tag_name, "Value": self.config.result_tag_value}]
+        if not_after:
+            tags.append({"Key": self.config.expiry_tag_name, "Value": not_after})
+        return tags
+
+    def step_retag(self, instance_id, state, ctx):
+        self.ec2.delete_tags(Resources=[instance_id], Tags=[{"Key": self.config.selector_tag_name, "Value": self.config.selector_tag_value}])
+        self.ec2.create_tags(Resources=[instance_id], Tags=self.result_tags(state.get('x')))
+        self.store.clear(instance_id)
+        self.completed([instance_id], state.get('x'))
+        return DONE
+
+    def step_batch_ready(self, instance_id, state, ctx):
+        # dispatched together with other instances by the tick
+        return None
+
+    def step_await_batch(self, instance_id, state, ctx):
+        # collected together with the other instances of the command by the tick
+        return None
+
+    def dispatch_batches(self, states):
+        """ Sends one command per batch of ready instances. Returns the instance ids that failed """
+        failed = []
+        now = time.time()
+        for certonly in (0, 1):
+            ready = sorted([(st['u'], i) for i, st in states.items()
+                            if st is not None and st['s'] == BATCH_READY and st['o'] == certonly])
+            if not ready or (now - ready[0][0] < self.config.batch_window and len(ready) < self.config.batch_max):
+                continue
+            ids = [i for u, i in ready]
+            for start in range(0, len(ids), self.config.batch_max):
+                failed += self.send_batch(ids[start:start + self.config.batch_max], certonly, states)
+        return failed
+
+    def send_batch(self, instance_ids, certonly, states):
+        certificates = {}
+        not_after = {}
+        failed = []
+        # the batch command has a trace of its own, the issuance is recorded in the trace of each instance
+        trace_id = new_trace_id()
+        csrs = {}
+        for instance_id in instance_ids:
+            try:
+                csr = self.host_csr(instance_id, states[instance_id])
+                if csr:
+                    csrs[instance_id] = csr
+            except Exception as err:
+                print('IPsec setup of instance ' + instance_id + ' failed: ' + str(err))
+                failed.append(instance_id)
+        ids = [i for i in instance_ids if i not in failed]
+        for start in range(0, len(ids), self.config.bulk_issue_size):
+            chunk = ids[start:start + self.config.bulk_issue_size]
+            started = time.time()
+            try:
+                with self.tracer.span('bulk-issue-cert', trace_id, Instances=len(chunk)) as span:
+                    results = self.issue_certificates(chunk, trace_id, span.span_id, dict((i, csrs[i]) for i in chunk if i in csrs))
+            except Exception as err:
+                results = dict((i, {'ERR': str(err)}) for i in chunk)
+            for instance_id in chunk:
+                j = results.get(instance_id) or {'ERR': 'no certificate returned'}
+                self.tracer.record('batch-issue-cert', states[instance_id].get('r') or trace_id, started,
+                                   status='error' if j.get('ERR') else 'ok', InstanceId=instance_id, BatchTraceId=trace_id)
+                if j.get('ERR'):
+                    print('IPsec setup of instance ' + instance_id + ' failed: ' + j['ERR'])
+                    failed.append(instance_id)
+                    continue
+                certificates[instance_id] = self.host_certificate(j)
+                not_after[instance_id] = j.get('CERT_NOT_AFTER', '')
+        if failed:
+            self.store.clear_many(failed)
+            self.released(failed)
+
+        if self.config.delivery_bucket:
+            # the command text is the same for any number of instances, no split
+            ids = [i for i in instance_ids if i in certificates]
+            for start in range(0, len(ids), self.config.batch_max):
+                token = new_id()
+                delivered = {}
+                for instance_id in ids[start:start + self.config.batch_max]:
+                    try:
+                        self.deliver(token, instance_id, certificates[instance_id])
+                        delivered[instance_id] = certificates[instance_id]
+                    except botocore.exceptions.ClientError as err:
+                        print('IPsec setup of instance ' + instance_id + ' failed: ' + str(err))
+                        failed.append(instance_id)
+                        self.store.clear(instance_id)
+                        self.released([instance_id])
+                if delivered:
+                    self.send_batch_command(delivered, certonly, not_after, trace_id if start == 0 else new_trace_id(), token)
+            return failed
+
+        # split so that no command script exceeds the max size
+        batch = {}
+        for instance_id in [i for i in instance_ids if i in certificates]:
+            candidate = dict(batch)
+            candidate[instance_id] = certificates[instance_id]
+            if batch and len(self.render(json.dumps(candidate), 'true' if certonly else 'false', trace_id)) > self.config.batch_max_bytes:
+                self.send_batch_command(batch, certonly, not_after, trace_id)
+                candidate = {instance_id: certificates[instance_id]}
+                trace_id = new_trace_id()
+            batch = candidate
+        if batch:
+            self.send_batch_command(batch, certonly, not_after, trace_id)
+        return failed
+
+    def send_batch_command(self, certificates, certonly, not_after, trace_id, token=None):
+        instance_ids = sorted(certificates.keys())
+        if token:
+            script = self.render('', 'true' if certonly else 'false', trace_id, self.delivery_url(token))
+        else:
+            script = self.render(json.dumps(certificates), 'true' if certonly else 'false', trace_id)
+        response = self.ssm.send_command(
+            InstanceIds=instance_ids,
+            DocumentName='AWS-RunShellScript',
+            TimeoutSeconds=3600,
+            Comment='IPSec setup with cert enrollment of ' + str(len(instance_ids)) + ' instances trace ' + trace_id,
+            Parameters={"commands": [script], "executionTimeout": ["600"], "workingDirectory": ["/tmp/"]},
+            # results are tracked per instance, a failed host must not stop the others
+            MaxConcurrency='100%',
+            MaxErrors='100%',
+        )
+        command_id = response['Command']['CommandId']
+        print('Started IPSec config of ' + str(len(instance_ids)) + ' instances in CommandId: ' + command_id + ' trace ' + trace_id)
+        # the instances of the batch share the state but for the expiry of their own certificate,
+        # saved in one call for the instances whose certificates expire at the same time
+        started = int(time.time())
+        by_expiry = {}
+        for instance_id in instance_ids:
+            by_expiry.setdefault(not_after.get(instance_id, ''), []).append(instance_id)
+        for x, ids in sorted(by_expiry.items()):
+            state = {'s': AWAIT_BATCH, 'o': certonly, 'u': started, 'c': command_id, 'x': x, 'r': trace_id}
+            if token:
+                state['d'] = token
+            self.store.save_many(ids, state)
+
+    def collect_batches(self, states):
+        """ Reads the per-instance results of the batch commands, retags in bulk. Returns the instance ids that failed """
+        commands = {}
+        for instance_id, st in states.items():
+            if st is not None and st['s'] == AWAIT_BATCH:
+                commands.setdefault(st['c'], []).append(instance_id)
+
+        ok = []
+        failed = []
+        now = time.time()
+        for command_id, instance_ids in commands.items():
+            status = {}
+            paginator = self.ssm.get_paginator('list_command_invocations')
+            for page in paginator.paginate(CommandId=command_id):
+                for inv in page['CommandInvocations']:
+                    status[inv['InstanceId']] = inv['Status']
+            errors = 0
+            finished = []
+            for instance_id in instance_ids:
+                st = status.get(instance_id)
+                if st == 'Success':
+                    ok.append(instance_id)
+                elif st in INVOCATION_FAILED or now - states[instance_id]['u'] > self.config.command_timeout:
+                    print('Failed. Confguring IPSec on the instance ' + instance_id + ' failed (' + str(st) +
+                          '). Check Output Log of E2 SSM Command Id ' + command_id)
+                    failed.append(instance_id)
+                    errors += 1
+                else:
+                    continue
+                finished.append(instance_id)
+                if st is not None:
+                    self.host_steps(command_id, instance_id, states[instance_id].get('r', ''))
+            if finished and states[finished[0]].get('d'):
+                self.discard(states[finished[0]]['d'], finished)
+            if len(finished) == len(instance_ids):
+                # the whole batch is collected, all its instances share one state
+                batch = states[instance_ids[0]]
+                self.tracer.record('await-batch', batch.get('r', ''), batch['u'], status='error' if errors else 'ok',
+                                   CommandId=command_id, Instances=len(finished), Errors=errors)
+
+        if ok:
+            self.ec2.delete_tags(Resources=ok, Tags=[{"Key": self.config.selector_tag_name, "Value": self.config.selector_tag_value}])
+            by_expiry = {}
+            for instance_id in ok:
+                by_expiry.setdefault(states[instance_id].get('x'), []).append(instance_id)
+            for not_after, instance_ids in by_expiry.items():
+                self.ec2.create_tags(Resources=instance_ids, Tags=self.result_tags(not_after))
+                self.completed(instance_ids, not_after)
+            print('IPSec configured on ' + str(len(ok)) + ' instances')
+        if ok or failed:
+            self.store.clear_many(ok + failed)
+            self.released(failed)
+        return failed
+
+    def policy_targets(self):
+        # the instances set up in the VPC, a tag target of SSM can not be restricted to a VPC
+        filters = [{'Name': 'tag:' + self.config.selector_tag_name, 'Values': [self.config.result_tag_value]},
+                   {'Name': 'vpc-id', 'Values': [self.config.vpc_id]},
+                   {'Name': 'instance-state-name', 'Values': ['running']}]
+        ids = []
+        for page in self.ec2.get_paginator('describe_instances').paginate(Filters=filters):
+            for reservation in page['Reservations']:
+                ids += [i['InstanceId'] for i in reservation['Instances']]
+        return sorted(ids)
+
+    def push_policies(self, trace_id=None):
+        """ Entry of a policy push. Sends the policy groups and oe-cert.conf to every instance set up, the hosts
+            replace the files that changed and reread them without a restart. Returns the command ids """
+        trace_id = trace_id or new_trace_id()
+        script = self.render('', 'false', trace_id, policy_only='true')
+        if self.config.vpc_id == 'any':
+            # one command for the fleet, SSM resolves the tag and throttles the hosts
+            targets = [{'Targets': [{'Key': 'tag:' + self.config.selector_tag_name, 'Values': [self.config.result_tag_value]}]}]
+        else:
+            ids = self.policy_targets()
+            targets = [{'InstanceIds': ids[i:i + 50]} for i in range(0, len(ids), 50)]
+        command_ids = []
+        with self.tracer.span('push-policies', trace_id, Commands=len(targets)):
+            for target in targets:
+                response = self.ssm.send_command(
+                    DocumentName='AWS-RunShellScript',
+                    TimeoutSeconds=3600,
+                    Comment='IPSec policy push trace ' + trace_id,
+                    Parameters={"commands": [script], "executionTimeout": ["600"], "workingDirectory": ["/tmp/"]},
+                    MaxConcurrency=self.config.policy_max_concurrency,
+                    MaxErrors=self.config.policy_max_errors,
+                    **target)
+                command_ids.append(response['Command']['CommandId'])
+        print('Started IPSec policy push in CommandIds: ' + ','.join(command_ids) + ' trace ' + trace_id)
+        return command_ids
+
+    def policy_status(self, command_ids, reports=False):
+        """ Progress of a policy push: the invocations by status, the failed instances and, with reports,
+            the policy reports of the hosts (files changed, SAs disrupted) """
+        status = {}
+        failed = []
+        changed = 0
+        disrupted = 0
+        for command_id in command_ids:
+            paginator = self.ssm.get_paginator('list_command_invocations')
+            for page in paginator.paginate(CommandId=command_id):
+                for inv in page['CommandInvocations']:
+                    status[inv['Status']] = status.get(inv['Status'], 0) + 1
+                    if inv['Status'] in INVOCATION_FAILED:
+                        failed.append(inv['InstanceId'])
+                    elif inv['Status'] == 'Success' and reports:
+                        report = self.host_steps(command_id, inv['InstanceId'], '', force=True)
+                        if report and report.get('policy'):
+                            changed += 1 if report['policy']['changed'] else 0
+                            disrupted += report['policy']['disrupted']
+        result = {'status': status, 'failed': sorted(failed)}
+        if reports:
+            result.update({'changed': changed, 'disrupted': disrupted})
+        return result
@@ -0,0 +1,238 @@
+#!/usr/bin/python
+"""
+  Compiles the opportunistic IPsec policy groups of config/ (private, clear, private-or-clear,
+  clear-or-private) to a minimal set of CIDRs before they are uploaded.
+
+  Libreswan instantiates a kernel policy for every CIDR of every group, and an address takes the
+  policy of the longest (most specific) CIDR that contains it, whatever its group. The compiler
+  keeps this effective policy of every address and
+    - normalizes each CIDR (host bits cleared, 10.1.2.3/16 -> 10.1.0.0/16)
+    - resolves a CIDR listed in more than one group by the precedence
+          private > clear > private-or-clear > clear-or-private
+      (traffic listed as private is never sent in clear, a clear exception wins over the
+      opportunistic groups)
+    - drops a CIDR inside a larger CIDR of the same group (no more specific CIDR of another
+      group in between), a CIDR fully covered by more specific CIDRs, and merges adjacent CIDRs
+      of the same group
+    - expands the tokens @vpc (the VPC being provisioned, all VPCs of the region if any) and
+      @vpc-<id> to the IPv4 and IPv6 CIDR blocks of the VPC, from a region/VPC description
+      (the Vpcs of ec2 describe-vpcs)
+  A more specific CIDR of another group (clear 172.31.0.0/30 in private 172.31.0.0/16) is an
+  exception and is kept.
+
+    python3 policy_compiler.py [--config config] [--vpcs describe-vpcs.json] [--vpc_id vpc-1a2b3c4d] [--output <folder>]
+
+  reports the kernel policies (CIDRs of all groups) before and after and writes the compiled
+  groups to the output folder. aws_setup.py compiles the groups of each region/VPC it provisions
+  and uploads the compiled groups instead of the hand-edited files.
+
+  Copyright 2018  Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy of this
+  software and associated documentation files (the "Software"), to deal in the Software
+  without restriction, including without limitation the rights to use, copy, modify,
+  merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+  permit persons to whom the Software is furnished to do so.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+  INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+  PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+  HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+  SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+import ipaddress, json, os
+
+# the groups in precedence order, a CIDR listed in more than one group goes to the first
+GROUPS = ['private', 'clear', 'private-or-clear', 'clear-or-private']
+
+VPC_TOKEN = '@vpc'
+
+
+class PolicyGroup(object):
+    """ A policy group file: its comment header and its entries (CIDRs or VPC tokens) with line numbers """
+
+    def __init__(self, name, header, entries):
+        self.name = name
+        self.header = header
+        self.entries = entries
+
+
+class CompileReport(object):
+    """ What the compiler changed, one line per change """
+
+    def __init__(self):
+        self.before = {}
+        self.after = {}
+        self.changes = []
+
+    def add(self, text):
+        self.changes.append(text)
+
+    def lines(self):
+        lines = ['Policies: %d before, %d after compilation' % (sum(self.before.values()), sum(self.after.values()))]
+        for name in GROUPS:
+            if name in self.before:
+                lines.append('  %-18s %4d -> %d' % (name, self.before[name], self.after.get(name, 0)))
+        return lines + ['  ' + c for c in self.changes]
+
+
+# Parses a group file. Comment lines before the first entry are its header, kept in the compiled file
+def parse_group(name, text):
+    header = []
+    entries = []
+    for number, line in enumerate(text.splitlines(), 1):
+        value = line.split('#', 1)[0].strip()
+        if not value:
+            if not entries and line.strip():
+                header.append(line.rstrip())
+            continue
+        entries.append((number, value))
+    return PolicyGroup(name, header, entries)
+
+
+def load_groups(folder='config'):
+    groups = []
+    for name in GROUPS:
+        with open(os.path.join(folder, name)) as f:
+            groups.append(parse_group(name, f.read()))
+    return groups
+
+
+def needs_vpcs(groups):
+    return any(value.startswith(VPC_TOKEN) for g in groups for number, value in g.entries)
+
+
+# CIDR blocks of the VPCs a token stands for
+def vpc_cidrs(token, vpcs, vpc_id):
+    wanted = token[1:] if token != VPC_TOKEN else vpc_id
+    cidrs = []
+    for vpc in vpcs:
+        if wanted not in (None, 'any') and vpc['VpcId'] != wanted:
+            continue
+        cidrs += [a['CidrBlock'] for a in vpc.get('CidrBlockAssociationSet', [{'CidrBlock': vpc.get('CidrBlock')}])
+                  if a.get('CidrBlock') and a.get('CidrBlockState', {}).get('State', 'associated') == 'associated']
+        cidrs += [a['Ipv6CidrBlock'] for a in vpc.get('Ipv6CidrBlockAssociationSet', [])
+                  if a.get('Ipv6CidrBlockState', {}).get('State', 'associated') == 'associated']
+    if not cidrs:
+        raise ValueError('No VPC CIDR blocks for ' + token + (' (VPC ' + vpc_id + ')' if token == VPC_TOKEN else ''))
+    return cidrs
+
+
+# CIDRs of a group, tokens expanded and host bits cleared
+def group_networks(group, vpcs, vpc_id, report):
+    networks = []
+    for number, value in group.entries:
+        if value.startswith(VPC_TOKEN):
+            if vpcs is None:
+                raise ValueError(group.name + ':' + str(number) + ': ' + value + ' needs a region/VPC description')
+            cidrs = vpc_cidrs(value, vpcs, vpc_id)
+            report.add(group.name + ': ' + value + ' expanded to ' + ', '.join(cidrs))
+        else:
+            cidrs = [value]
+        for cidr in cidrs:
+            try:
+                net = ipaddress.ip_network(cidr, strict=False)
+            except ValueError as e:
+                raise ValueError(group.name + ':' + str(number) + ': ' + str(e))
+            if str(net) != cidr and cidr == value:
+                report.add(group.name + ': ' + cidr + ' normalized to ' + str(net))
+            networks.append(net)
+    return networks
+
+
+def _parent(entries, net):
+    # longest CIDR of any group strictly containing net
+    for prefixlen in range(net.prefixlen - 1, -1, -1):
+        candidate = net.supernet(new_prefix=prefixlen)
+        if candidate in entries:
+            return candidate
+    return None
+
+
+def _covered(entries, net):
+    # every address of net matches a CIDR at least as specific as net
+    if net in entries:
+        return True
+    if net.prefixlen == net.max_prefixlen or not any(
+            n.version == net.version and n.prefixlen > net.prefixlen and n.supernet(new_prefix=net.prefixlen) == net for n in entries):
+        return False
+    return all(_covered(entries, half) for half in net.subnets())
+
+
+# Minimal CIDRs with the same effective policy of every address. entries: {network: group}
+def minimize(entries, report):
+    changed = True
+    while changed:
+        changed = False
+        for net in sorted(entries, key=lambda n: (n.version, n.prefixlen, n)):
+            if net not in entries:
+                continue
+            group = entries[net]
+            parent = _parent(entries, net)
+            if parent is not None and entries[parent] == group:
+                report.add(group + ': ' + str(net) + ' dropped, inside ' + str(parent))
+                del entries[net]
+                changed = True
+                continue
+            if net.prefixlen < net.max_prefixlen and all(_covered(entries, half) for half in net.subnets()):
+                report.add(group + ': ' + str(net) + ' dropped, covered by more specific CIDRs')
+                del entries[net]
+                changed = True
+                continue
+            if net.prefixlen == 0:
+                continue
+            supernet = net.supernet()
+            sibling = [half for half in supernet.subnets() if half != net][0]
+            if entries.get(sibling) == group and supernet not in entries:
+                report.add(group + ': ' + str(net) + ' and ' + str(sibling) + ' merged to ' + str(supernet))
+                del entries[net]
+                del entries[sibling]
+                entries[supernet] = group
+                changed = True
+    return entries
+
+
+# Compiles the groups. Returns ({group name: file text}, report)
+def compile_groups(groups, vpcs=None, vpc_id='any'):
+    report = CompileReport()
+    entries = {}
+    for group in sorted(groups, key=lambda g: GROUPS.index(g.name)):
+        networks = group_networks(group, vpcs, vpc_id, report)
+        report.before[group.name] = len(networks)
+        for net in networks:
+            if net not in entries:
+                entries[net] = group.name
+            elif entries[net] != group.name:
+                report.add(group.name + ': ' + str(net) + ' dropped, also in ' + entries[net] + ' which takes precedence')
+    minimize(entries, report)
+
+    compiled = {}
+    for group in groups:
+        nets = sorted((n for n, g in entries.items() if g == group.name), key=lambda n: (n.version, n))
+        report.after[group.name] = len(nets)
+        compiled[group.name] = '\n'.join(group.header + [str(n) for n in nets]) + '\n'
+    return compiled, report
+
+
+if __name__ == '__main__':
+    import argparse
+
+    p = argparse.ArgumentParser(description="Compiles the IPsec policy groups to a minimal set of CIDRs")
+    p.add_argument("--config", default="config", help="Folder of the policy groups (default:config)")
+    p.add_argument("--vpcs", help="Region/VPC description, JSON output of aws ec2 describe-vpcs, to expand @vpc tokens")
+    p.add_argument("--vpc_id", default="any", help="VPC of the @vpc token (default:any, all VPCs of the description)")
+    p.add_argument("--output", help="Folder the compiled groups are written to (default: report only)")
+    args = p.parse_args()
+
+    vpcs = None
+    if args.vpcs:
+        with open(args.vpcs) as f:
+            vpcs = json.load(f)['Vpcs']
+    compiled, report = compile_groups(load_groups(args.config), vpcs, args.vpc_id)
+    print('\n'.join(report.lines()))
+    if args.output:
+        for name, text in compiled.items():
+            with open(os.path.join(args.output, name), 'w') as f:
+                f.write(text)
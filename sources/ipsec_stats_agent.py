@@ -0,0 +1,380 @@
+#!/usr/bin/python
+"""
+  Resident IPSec statistics agent, replaces cronIPSecStats.sh
+
+  Every --resolution seconds (10 - 300, default 60) it reads
+	 ipsec whack --globalstatus	  - active IPSec SAs, IKE errors, shunts
+	 ipsec whack --trafficstatus  - byte and packet counters of each IPSec SA
+  once, buffers the values and publishes them every --publish-interval seconds to a sink
+	 cloudwatch  - PutMetricData with many values per call (boto3 or, if not installed, one awscli call)
+	 emf         - CloudWatch Embedded Metric Format lines, e.g. for the CloudWatch agent
+	 file        - one JSON line per value, for tests
+	 s3          - one JSON line per reading to --output s3://<bucket>/<prefix>/, rolled up to fleet,
+	               VPC and availability zone metrics by the metrics rollup lambda instead of one
+	               metric stream per instance (see metric_rollup.py)
+  Publishes are aligned to multiples of --publish-interval, so the readings of all hosts up to
+  the same time are published at about the same time.
+
+  Counters of libreswan are cumulative. The agent reports the increase since the previous
+  reading and never clears them (the cron script ran --clearstats, which raced with the reads).
+
+  The agent is started by cron every minute under flock, so only one runs and it is
+  restarted if it stops:
+	 * * * * * flock -n /var/run/ipsec-stats-agent.lock python /root/ipsec/ipsec_stats_agent.py
+
+  Runs with python 2.7 and 3.
+
+  Copyright 2018  Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy of this
+  software and associated documentation files (the "Software"), to deal in the Software
+  without restriction, including without limitation the rights to use, copy, modify,
+  merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+  permit persons to whom the Software is furnished to do so.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+  INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+  PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+  HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+  SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+from __future__ import print_function
+import json, os, re, signal, subprocess, sys, tempfile, time
+
+NAMESPACE = 'IPSec'
+# PutMetricData accepts up to 1000 values per call
+MAX_DATUMS = 1000
+# values kept while the sink is not reachable
+MAX_BUFFER = 10 * MAX_DATUMS
+
+GLOBAL_VALUE = re.compile(r'^(?:\d{3} )?([\w.\-]+)=(\d+)\s*$')
+SA_LINE = re.compile(r'#(\d+): "([^"]*)"(?:\[\d+\])?\s+([^,\s]+)')
+SA_COUNTER = re.compile(r'\b(in|out)(Bytes|Packets)=(\d+)')
+
+METADATA = 'http://169.254.169.254/latest/'
+
+try:
+    from urllib.request import urlopen, Request
+except ImportError:
+    from urllib2 import urlopen, Request
+
+
+def metadata(path):
+    """ Reads instance metadata, with IMDSv2 token if the instance requires it """
+    headers = {}
+    try:
+        r = Request(METADATA + 'api/token', headers={'X-aws-ec2-metadata-token-ttl-seconds': '60'})
+        r.get_method = lambda: 'PUT'
+        headers['X-aws-ec2-metadata-token'] = urlopen(r, timeout=2).read().decode('utf-8')
+    except Exception:
+        pass
+    return urlopen(Request(METADATA + path, headers=headers), timeout=2).read().decode('utf-8')
+
+
+def parse_globalstatus(output):
+    """ Returns the metrics of ipsec whack --globalstatus: (connections, shunts, errors total) """
+    values = {}
+    for line in output.splitlines():
+        m = GLOBAL_VALUE.match(line.strip())
+        if m:
+            values[m.group(1)] = int(m.group(2))
+    errors = sum(v for k, v in values.items() if 'error' in k.lower())
+    return values.get('current.states.ipsec', 0), values.get('current.states.shunts', 0), errors
+
+
+def parse_trafficstatus(output):
+    """ Returns the counters of each IPSec SA of ipsec whack --trafficstatus: {serial: (peer, {counter: value})} """
+    sas = {}
+    for line in output.splitlines():
+        m = SA_LINE.search(line)
+        if not m:
+            continue
+        counters = dict((d + k, int(v)) for d, k, v in SA_COUNTER.findall(line))
+        sas[m.group(1)] = (m.group(3), counters)
+    return sas
+
+
+def write_lines(path, lines):
+    if path == '-':
+        sys.stdout.write(lines)
+        sys.stdout.flush()
+    else:
+        with open(path, 'a') as f:
+            f.write(lines)
+
+
+def increase(current, previous):
+    # a counter lower than before was reset (ipsec restart)
+    return current - previous if current >= previous else current
+
+
+class Sampler(object):
+    """ Reads libreswan once per sample and converts the cumulative counters to increases """
+
+    COUNTERS = [('inBytes', 'IPSec-InBytes', 'Bytes'), ('outBytes', 'IPSec-OutBytes', 'Bytes'),
+                ('inPackets', 'IPSec-InPackets', 'Count'), ('outPackets', 'IPSec-OutPackets', 'Count')]
+
+    def __init__(self, instance_id, ipsec='ipsec', per_peer=False):
+        self.instance_id = instance_id
+        self.ipsec = ipsec
+        self.per_peer = per_peer
+        self.errors = None
+        self.sas = None
+
+    def whack(self, option):
+        return subprocess.check_output([self.ipsec, 'whack', option]).decode('utf-8', 'replace')
+
+    def datum(self, name, value, unit, timestamp, peer=None):
+        dimensions = {'InstanceID': self.instance_id}
+        if peer:
+            dimensions['Peer'] = peer
+        return {'MetricName': name, 'Dimensions': dimensions, 'Value': value, 'Unit': unit, 'Timestamp': timestamp}
+
+    def sample(self, timestamp):
+        connections, shunts, errors = parse_globalstatus(self.whack('--globalstatus'))
+        sas = parse_trafficstatus(self.whack('--trafficstatus'))
+
+        datums = [self.datum('IPSec-Connections', connections, 'Count', timestamp),
+                  self.datum('IPSec-IKE-Errors', increase(errors, self.errors) if self.errors is not None else 0, 'Count', timestamp),
+                  self.datum('IPSec-Connection-Shunts', shunts, 'Count', timestamp)]
+
+        # the first reading is the baseline, SAs that appear later count from 0
+        if self.sas is not None:
+            totals = {}
+            peers = {}
+            for serial, (peer, counters) in sas.items():
+                before = self.sas.get(serial, (peer, {}))[1]
+                for counter, value in counters.items():
+                    d = increase(value, before.get(counter, 0))
+                    totals[counter] = totals.get(counter, 0) + d
+                    peers.setdefault(peer, {})[counter] = peers.get(peer, {}).get(counter, 0) + d
+            for counter, name, unit in self.COUNTERS:
+                if counter in totals:
+                    datums.append(self.datum(name, totals[counter], unit, timestamp))
+                if self.per_peer:
+                    for peer, counters in sorted(peers.items()):
+                        if counter in counters:
+                            datums.append(self.datum(name, counters[counter], unit, timestamp, peer))
+
+        self.errors = errors
+        self.sas = sas
+        return datums
+
+
+class CloudWatchSink(object):
+
+    def __init__(self, namespace, region, storage_resolution):
+        self.namespace = namespace
+        self.region = region
+        self.storage_resolution = storage_resolution
+        try:
+            import boto3
+            self.client = boto3.client('cloudwatch', region_name=region)
+        except ImportError:
+            self.client = None
+
+    def metric_data(self, datums):
+        return [{'MetricName': d['MetricName'], 'Value': d['Value'], 'Unit': d['Unit'],
+                 'Timestamp': d['Timestamp'], 'StorageResolution': self.storage_resolution,
+                 'Dimensions': [{'Name': k, 'Value': v} for k, v in sorted(d['Dimensions'].items())]}
+                for d in datums]
+
+    def publish(self, datums):
+        for i in range(0, len(datums), MAX_DATUMS):
+            data = self.metric_data(datums[i:i + MAX_DATUMS])
+            if self.client is not None:
+                self.client.put_metric_data(Namespace=self.namespace, MetricData=data)
+                continue
+            # awscli only: one process for the whole batch
+            for d in data:
+                d['Timestamp'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(d['Timestamp']))
+            with tempfile.NamedTemporaryFile('w', suffix='.json') as f:
+                json.dump(data, f)
+                f.flush()
+                subprocess.check_call(['aws', 'cloudwatch', 'put-metric-data', '--namespace', self.namespace,
+                                       '--region', self.region, '--metric-data', 'file://' + f.name])
+
+
+class EmfSink(object):
+    """ One Embedded Metric Format record per timestamp and dimensions """
+
+    def __init__(self, namespace, path, storage_resolution):
+        self.namespace = namespace
+        self.path = path
+        self.storage_resolution = storage_resolution
+
+    def records(self, datums):
+        groups = {}
+        for d in datums:
+            key = (d['Timestamp'], tuple(sorted(d['Dimensions'].items())))
+            groups.setdefault(key, []).append(d)
+        for (timestamp, dimensions), group in sorted(groups.items()):
+            record = dict(dimensions)
+            record['_aws'] = {'Timestamp': int(timestamp * 1000), 'CloudWatchMetrics': [{
+                'Namespace': self.namespace, 'Dimensions': [[k for k, v in dimensions]],
+                'Metrics': [{'Name': d['MetricName'], 'Unit': d['Unit'], 'StorageResolution': self.storage_resolution}
+                            for d in group]}]}
+            for d in group:
+                record[d['MetricName']] = d['Value']
+            yield record
+
+    def publish(self, datums):
+        write_lines(self.path, ''.join(json.dumps(r, sort_keys=True) + '\n' for r in self.records(datums)))
+
+
+class FileSink(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def publish(self, datums):
+        write_lines(self.path, ''.join(json.dumps(d, sort_keys=True) + '\n' for d in datums))
+
+
+class S3Sink(object):
+    """ Readings as JSON lines, one object per slot (the publish interval) and publish:
+        <prefix>samples/<slot>/<instance id>-<time of the first reading>.jsonl """
+
+    def __init__(self, url, instance_id, vpc_id, availability_zone, slot, region):
+        if not url.startswith('s3://'):
+            raise Exception('Error: --output of the s3 sink must be s3://<bucket>/<prefix>/')
+        self.bucket, _, self.prefix = url[len('s3://'):].partition('/')
+        self.instance_id = instance_id
+        self.vpc_id = vpc_id
+        self.availability_zone = availability_zone
+        self.slot = slot
+        self.region = region
+        try:
+            import boto3
+            self.client = boto3.client('s3', region_name=region)
+        except ImportError:
+            self.client = None
+
+    def records(self, datums):
+        # the per peer values stay on the host
+        readings = {}
+        for d in datums:
+            if 'Peer' not in d['Dimensions']:
+                readings.setdefault(d['Timestamp'], {})[d['MetricName']] = d['Value']
+        return [{'t': t, 'i': self.instance_id, 'vpc': self.vpc_id, 'az': self.availability_zone, 'm': m}
+                for t, m in sorted(readings.items())]
+
+    def put(self, key, body):
+        if self.client is not None:
+            self.client.put_object(Bucket=self.bucket, Key=key, Body=body.encode('utf-8'), ServerSideEncryption='AES256')
+            return
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl') as f:
+            f.write(body)
+            f.flush()
+            subprocess.check_call(['aws', 's3', 'cp', f.name, 's3://' + self.bucket + '/' + key, '--sse', 'AES256',
+                                   '--region', self.region, '--only-show-errors'])
+
+    def publish(self, datums):
+        slots = {}
+        for r in self.records(datums):
+            slots.setdefault(r['t'] // self.slot * self.slot, []).append(r)
+        # a publish repeated after an error writes the same keys again
+        for slot, records in sorted(slots.items()):
+            self.put(self.prefix + 'samples/' + str(slot) + '/' + self.instance_id + '-' + str(records[0]['t']) + '.jsonl',
+                     ''.join(json.dumps(r, sort_keys=True) + '\n' for r in records))
+
+
+class Agent(object):
+
+    def __init__(self, sampler, sink, resolution, publish_interval):
+        self.sampler = sampler
+        self.sink = sink
+        self.resolution = resolution
+        self.publish_interval = publish_interval
+        self.buffer = []
+        self.published = time.time()
+        self.running = True
+
+    def sample(self, timestamp):
+        try:
+            self.buffer.extend(self.sampler.sample(timestamp))
+        except Exception as e:
+            print('Error: can not read IPSec statistics: ' + str(e))
+
+    def flush(self):
+        self.published = time.time()
+        if not self.buffer:
+            return
+        try:
+            self.sink.publish(self.buffer)
+            self.buffer = []
+        except Exception as e:
+            # keep the values for the next try, oldest are dropped first
+            self.buffer = self.buffer[-MAX_BUFFER:]
+            print('Error: can not publish ' + str(len(self.buffer)) + ' IPSec statistics: ' + str(e))
+
+    def stop(self, *args):
+        self.running = False
+
+    def wait(self):
+        # samples are aligned to the resolution, so the values of all hosts share timestamps
+        due = (int(time.time()) // self.resolution + 1) * self.resolution
+        while self.running and time.time() < due:
+            time.sleep(min(1, max(0, due - time.time())))
+        return due
+
+    def run(self, once=False):
+        if once:
+            self.sample(int(time.time()))
+            self.flush()
+            return
+        while self.running:
+            due = self.wait()
+            if not self.running:
+                break
+            self.sample(due)
+            if due % self.publish_interval < self.resolution or time.time() - self.published >= self.publish_interval:
+                self.flush()
+        self.flush()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    p = argparse.ArgumentParser(description="Publishes IPSec statistics of libreswan")
+    p.add_argument("--resolution", type=int, default=60, help="Seconds between readings, 10 - 300 (default:60)")
+    p.add_argument("--publish-interval", type=int, default=60, help="Seconds between publishes (default:60)")
+    p.add_argument("--sink", choices=['cloudwatch', 'emf', 'file', 's3'], default='cloudwatch', help="Where the values go (default:cloudwatch)")
+    p.add_argument("--output", default='-', help="File of the emf and file sink, - for stdout, s3://<bucket>/<prefix>/ of the s3 sink (default:-)")
+    p.add_argument("--namespace", default=NAMESPACE, help="CloudWatch namespace (default:IPSec)")
+    p.add_argument("--per-peer", action='store_true', help="Also publish the traffic counters per peer IP")
+    p.add_argument("--instance-id", help="InstanceID dimension (default: from instance metadata)")
+    p.add_argument("--region", help="CloudWatch or S3 region (default: from instance metadata)")
+    p.add_argument("--vpc-id", help="VPC of the s3 sink readings (default: from instance metadata)")
+    p.add_argument("--availability-zone", help="Availability zone of the s3 sink readings (default: from instance metadata)")
+    p.add_argument("--ipsec", default='ipsec', help="ipsec command (default:ipsec)")
+    p.add_argument("--once", action='store_true', help="Read and publish once, then exit")
+    args = p.parse_args()
+
+    if not 10 <= args.resolution <= 300:
+        raise Exception('Error: --resolution must be between 10 and 300 seconds')
+
+    instance_id = args.instance_id or metadata('meta-data/instance-id')
+    # values below one minute are stored as high resolution metrics
+    storage_resolution = 1 if args.resolution < 60 else 60
+
+    if args.sink == 'cloudwatch':
+        region = args.region or json.loads(metadata('dynamic/instance-identity/document'))['region']
+        sink = CloudWatchSink(args.namespace, region, storage_resolution)
+    elif args.sink == 's3':
+        region = args.region or json.loads(metadata('dynamic/instance-identity/document'))['region']
+        vpc_id = args.vpc_id or metadata('meta-data/network/interfaces/macs/' + metadata('meta-data/mac') + '/vpc-id')
+        availability_zone = args.availability_zone or metadata('meta-data/placement/availability-zone')
+        sink = S3Sink(args.output, instance_id, vpc_id, availability_zone, max(args.resolution, args.publish_interval), region)
+    elif args.sink == 'emf':
+        sink = EmfSink(args.namespace, args.output, storage_resolution)
+    else:
+        sink = FileSink(args.output)
+
+    agent = Agent(Sampler(instance_id, args.ipsec, args.per_peer), sink, args.resolution, max(args.resolution, args.publish_interval))
+    signal.signal(signal.SIGTERM, agent.stop)
+    signal.signal(signal.SIGINT, agent.stop)
+    print('IPSec statistics agent started for ' + instance_id + ', resolution ' + str(args.resolution) + 's, sink ' + args.sink)
+    agent.run(args.once)
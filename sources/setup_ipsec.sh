@@ -9,9 +9,27 @@
 #	       	private 		- list of networks with mandaqtory protection
 #		clear			- list of netowrks to communication without encryption	
 #		installCert.py		- script to enroll certifcates
-#		cronIPSecStats.sh	- srcript that collects statistics
-#		cron.txt		- cron job definition
+#		ipsec_stats_agent.py	- agent that publishes the IPSec statistics
+#		cron.txt		- cron job that keeps the agent running
 #		generateCertbundleLambda - Lambda name for the certifcate generation. 
+#		bundleUrl, bundleVersion, bundleSha256 - presigned URL, version and checksum of the
+#					  bootstrap bundle with all of the files above (see aws_setup.py).
+#					  If empty, the files are downloaded one by one
+#		deliveryUrl		- s3://<bucket>/<prefix>/ holding the certificate of the instance as
+#					  <instance-id>.json. If empty, the certificate is inlined in certificate
+#		csrRequest		- true only generates the host key in the NSS DB and prints the certificate
+#					  request on stdout (IPSEC-CSR <base64 DER>). The signed certificate follows in
+#					  a second run, with CERT_PEM_B64 and CERT_CA_PEM_B64 instead of the PKCS12
+#		rotation		- hot replaces the certificate of a running IPSec in a certificate_only run
+#					  without wiping the NSS DB or restarting (see switch_certificate), wipe
+#					  recreates the NSS DB with the new certificate
+#		policyOnly		- true only updates the policy groups and oe-cert.conf of a set up host: the
+#					  files that differ are replaced and reread without a restart (see push_policies)
+#		metricsUrl		- s3://<bucket>/<prefix>/ the statistics agent writes its readings to, rolled up
+#					  to fleet metrics by the metrics rollup lambda. If empty, the agent publishes
+#					  per instance metrics to CloudWatch
+#		traceId			- trace of the setup. The duration of each step is reported at exit
+#					  on stderr in one line IPSEC-TRACE {...}, read by the IPSecSetup lambda
 #
 # Copyright 2018 Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: MIT-0#
@@ -23,26 +41,465 @@ set -u
 configBucket="{{configBucket}}"
 certificate='{{certificate}}'
 certificate_only='{{certificate_only}}'
+bundleUrl='{{bundleUrl}}'
+bundleVersion='{{bundleVersion}}'
+bundleSha256='{{bundleSha256}}'
+traceId='{{traceId}}'
+deliveryUrl='{{deliveryUrl}}'
+csrRequest='{{csrRequest}}'
+rotation='{{rotation}}'
+policyOnly='{{policyOnly}}'
+metricsUrl='{{metricsUrl}}'
 
+# ends the running step and starts the next, the timings are reported at exit
+traceSteps=''
+stepName=''
+stepStart=0
+step () {
+	now=`date +%s%3N`
+	if [ -n "$stepName" ]; then
+		traceSteps="$traceSteps${traceSteps:+,}{\"step\":\"$stepName\",\"start\":$stepStart,\"ms\":$((now - stepStart))}"
+	fi
+	stepName="$1"
+	stepStart=$now
+}
+
+rotationReport=''
+policyReport=''
+cacheHits=0
+cacheFetched=0
+report_trace () {
+	code=$?
+	step ''
+	cacheReport=''
+	if [ $((cacheHits + cacheFetched)) -gt 0 ]; then
+		cacheReport="{\"hits\":$cacheHits,\"fetched\":$cacheFetched}"
+	fi
+	echo "IPSEC-TRACE {\"trace\":\"$traceId\",\"exit\":$code,\"steps\":[$traceSteps]${rotationReport:+,\"rotation\":$rotationReport}${policyReport:+,\"policy\":$policyReport}${cacheReport:+,\"cache\":$cacheReport}}" >&2
+}
+trap report_trace EXIT
+
+# prints a field of the JSON document on stdin, empty if missing
+json_field () {
+	python -c 'import sys, json; print(json.load(sys.stdin).get(sys.argv[1], ""))' "$1"
+}
+
+# prints the member of the JSON document on stdin if present, otherwise the document
+json_select () {
+	python -c 'import sys, json; d = json.load(sys.stdin); print(json.dumps(d.get(sys.argv[1], d)))' "$1"
+}
+
+# downloads s3://$configBucket/$1 to the file $2 of /root/ipsec unless the copy there is current: the
+# ETag of the download is kept in .etags/$2 and revalidated with If-None-Match, S3 answers 304 without
+# transferring the object. The downloaded files must not be changed in place
+cacheRegion=''
+cached_cp () {
+	if [ -z "$cacheRegion" ]; then
+		cacheRegion=`curl --silent http://169.254.169.254/latest/dynamic/instance-identity/document | grep region | cut -f 4 -d '"'`
+	fi
+	etag=''
+	if [ -f "$2" ] && [ -f ".etags/$2" ]; then
+		etag=`cat ".etags/$2"`
+	fi
+	out=`aws s3api get-object --bucket "$configBucket" --key "$1" ${etag:+--if-none-match "$etag"} --region "$cacheRegion" "$2.download" 2>&1`
+	if [ $? -eq 0 ]; then
+		mkdir -p .etags && \
+		echo "$out" | json_field ETag > ".etags/$2" && \
+		mv "$2.download" "$2" || return 1
+		cacheFetched=$((cacheFetched + 1))
+		return 0
+	fi
+	rm -f "$2.download"
+	if [ -n "$etag" ] && echo "$out" | grep -q '(304)'; then
+		cacheHits=$((cacheHits + 1))
+		return 0
+	fi
+	echo "$out"
+	return 1
+}
+
+# downloads the bootstrap bundle in one request and verifies it, skipped if the version is installed
+install_bundle () {
+
+	if [ -f bundle.version ] && [ "`cat bundle.version`" == "$bundleVersion" ]; then
+		echo "bootstrap bundle $bundleVersion already installed"
+		cacheHits=$((cacheHits + 1))
+		return 0
+	fi
+
+	curl --silent --fail -o bundle.tar.gz "$bundleUrl"
+	if [ $? -ne 0 ]; then
+		echo "Error: Failed to download bootstrap bundle $bundleVersion"
+		exit 4
+	fi
+
+	echo "$bundleSha256  bundle.tar.gz" | sha256sum -c --quiet - && \
+	tar -xzf bundle.tar.gz && \
+	sha256sum -c --quiet SHA256SUMS
+	if [ $? -ne 0 ]; then
+		echo "Error: Bootstrap bundle $bundleVersion corrupted, checksums do not match"
+		exit 12
+	fi
+	rm bundle.tar.gz
+	echo "$bundleVersion" > bundle.version
+	cacheFetched=$((cacheFetched + 1))
+	echo "bootstrap bundle $bundleVersion installed"
+}
+
+
+# prints the P12 password, encrypted with KMS or, in envelope mode, with a KMS encrypted data key:
+# AES-256-CBC with the first 32 bytes of the data key, HMAC-SHA256 of IV and ciphertext with the last 32
+decrypt_password () {
+
+	dataKey=`echo $certificate | json_field CERT_P12_DATA_KEY`
+	if [ -z "$dataKey" ]; then
+		echo $certificate | json_field CERT_P12_ENCRYPTED_PWD  |  base64 -i -d > ./tmp
+		aws kms decrypt --ciphertext-blob fileb://tmp --region "$region" --query Plaintext --output text | base64 -d -i
+		return
+	fi
+
+	echo "$dataKey" | base64 -i -d > ./tmp
+	keyHex=`aws kms decrypt --ciphertext-blob fileb://tmp --region "$region" --query Plaintext --output text | base64 -d -i | od -An -v -tx1 | tr -d ' \n'`
+	iv=`echo $certificate | json_field CERT_P12_PWD_IV`
+	sealed=`echo $certificate | json_field CERT_P12_ENVELOPE_PWD`
+	mac=`printf '%s.%s' "$iv" "$sealed" | openssl dgst -sha256 -mac HMAC -macopt hexkey:${keyHex:64:64} | awk '{print $NF}'`
+	if [ ${#keyHex} -ne 128 ] || [ "$mac" != "`echo $certificate | json_field CERT_P12_PWD_MAC`" ]; then
+		return 1
+	fi
+	echo "$sealed" | base64 -i -d | openssl enc -d -aes-256-cbc -K ${keyHex:0:64} -iv $iv
+}
+
+# generates the host key in the NSS DB and prints the certificate request, the key never leaves the host
+request_certificate () {
+
+	step csr
+	hostname=`curl --silent http://169.254.169.254/latest/meta-data/local-hostname`
+	certutil -L -d sql:/etc/ipsec.d > /dev/null 2>&1 || ipsec initnss
+	head -c 64 /dev/urandom > ./noise && \
+	certutil -R -d sql:/etc/ipsec.d -s "CN=$hostname" -k rsa -g 4096 -Z SHA256 -z ./noise -a -o ./req.pem
+	if [ $? -ne 0 ]; then
+		rm -f ./noise
+		echo "Error: Failed to generate the key and certificate request"
+		exit 14
+	fi
+	rm ./noise
+	# the key of the request, the signed certificate is checked against it before a hot rotation
+	sed -n '/BEGIN/,/END/p' ./req.pem | openssl req -pubkey -noout > ./request.pub 2>/dev/null || rm -f ./request.pub
+	echo "IPSEC-CSR `sed -n '/BEGIN/,/END/p' ./req.pem | grep -v -- ----- | tr -d '\r\n'`"
+	rm ./req.pem
+}
+
+# true if the certificate of a running IPSec is replaced in place
+hot_rotation () {
+	[ "$rotation" == "hot" ] && [ "$certificate_only" == "true" ] && \
+	grep -q '^[[:space:]]*leftcert=' /etc/ipsec.d/oe-cert.conf 2>/dev/null && \
+	ipsec whack --status > /dev/null 2>&1
+}
+
+# state numbers of the established IPsec SAs
+ipsec_sas () {
+	ipsec whack --trafficstatus 2>/dev/null | grep -o '#[0-9]*:' | sort -u
+}
+
+# nicknames of the host certificates in the NSS DB
+host_certificates () {
+	certutil -L -d sql:/etc/ipsec.d 2>/dev/null | awk '$1 ~ /^hostcert(-[0-9]+)?$/ { print $1 }' | sort -u
+}
+
+# ids of the private keys in the NSS DB of the certificate with the nickname $1, (orphan) for the keys
+# without a certificate
+host_keys () {
+	certutil -K -d sql:/etc/ipsec.d 2>/dev/null | \
+	awk -v n="$1" '{ for (i = 1; i < NF; i++) if (length($i) == 40 && $i ~ /^[0-9a-f]+$/) {
+		rest = $(i + 1); for (j = i + 2; j <= NF; j++) rest = rest " " $j
+		if (rest == n || substr(rest, length(rest) - length(n)) == ":" n) print $i } }'
+}
+
+# points leftcert back to hostcert after a hot rotation, the certificate is installed as hostcert
+reset_leftcert () {
+	if [ -f /etc/ipsec.d/oe-cert.conf ]; then
+		sed "s/^\([[:space:]]*leftcert=\).*/\1hostcert/" /etc/ipsec.d/oe-cert.conf > /etc/ipsec.d/oe-cert.conf.new && \
+		mv /etc/ipsec.d/oe-cert.conf.new /etc/ipsec.d/oe-cert.conf
+	fi
+}
+
+# name and auto of each connection of the config file $2 that is not in $1 or defined differently,
+# the policy push adds only these again
+changed_conns () {
+	awk '{ f = FILENAME == ARGV[1] ? 1 : 2 }
+	     FNR == 1 { c = "" }
+	     /^conn /{ c = $2; if (f == 2) { a[c] = "add"; order[++n] = c } }
+	     c != "" { b[f, c] = b[f, c] $0 "\n" }
+	     f == 2 && c != "" && /^[[:space:]]*auto=/{ split($1, v, "="); a[c] = v[2] }
+	     END { for (i = 1; i <= n; i++) if (b[1, order[i]] != b[2, order[i]]) print order[i], a[order[i]] }' "$1" "$2"
+}
+
+# switches the running IPSec to a new certificate without a restart and without replacing its
+# connections. $1 checks the new certificate against its key and stages it before anything in the NSS
+# DB is touched and the certificate in use is saved. Then the certificate in use is deleted and $2
+# imports the new one under the same nickname, the leftcert of the loaded connections: between these
+# two commands pluto has no certificate for leftcert. Secrets and certificates are reread (ipsec auto
+# --rereadsecrets, ipsec whack --rereadcerts). Adding the connections again would replace them and
+# delete their SAs, the reread keeps them: they change to the new certificate at their next rekey.
+# The key of the previous certificate is kept for them, keys of older rotations are deleted.
+# If the import fails the previous certificate is imported again, if that fails too the script exits
+# with 16 and leaves it in ./previous.pem. If the reread fails IPSec is restarted. The SAs before,
+# after and the ones that are gone are reported
+switch_certificate () {
+
+	step rotate
+	nickname=`sed -n 's/^[[:space:]]*leftcert=//p' /etc/ipsec.d/oe-cert.conf | head -1`
+	ipsec_sas > ./sas.before
+
+	previous_keys=`host_keys "$nickname"`
+	certutil -L -d sql:/etc/ipsec.d -n "$nickname" -a > ./previous.pem 2>/dev/null && [ -s ./previous.pem ] && \
+	$1 "$nickname"
+	if [ $? -ne 0 ]; then
+		rm -f ./previous.pem ./rotated.p12 ./sas.before
+		echo "Error: Failed to install certifcate, it does not match its key or the certificate in use can not be saved"
+		exit 5
+	fi
+
+	while certutil -D -d sql:/etc/ipsec.d -n "$nickname" > /dev/null 2>&1; do :; done
+	$2 "$nickname"
+	if [ $? -ne 0 ]; then
+		certutil -A -d sql:/etc/ipsec.d -n "$nickname" -t ",," -a -i ./previous.pem
+		if [ $? -ne 0 ]; then
+			rm -f ./rotated.p12 ./sas.before
+			echo "Error: Failed to restore the previous certificate, IPSec has no certificate $nickname, it is kept in ./previous.pem"
+			exit 16
+		fi
+		rm -f ./previous.pem ./rotated.p12 ./sas.before
+		echo "Error: Failed to install certifcate"
+		exit 5
+	fi
+	rm -f ./previous.pem ./rotated.p12 ./request.pub
+
+	mode=hot
+	ipsec auto --rereadsecrets > /dev/null && \
+	ipsec whack --rereadcerts > /dev/null
+	if [ $? -ne 0 ]; then
+		echo "hot rotation failed, restarting IPSec"
+		mode=restart
+		sudo ipsec restart
+		if [ $? -ne 0 ]; then
+			echo "Error: Failed to restart ipsec"
+			exit 7
+		fi
+	fi
+
+	for key in `host_keys "(orphan)"`; do
+		if ! echo "$previous_keys" | grep -qx "$key"; then
+			certutil -F -d sql:/etc/ipsec.d -k "$key" > /dev/null 2>&1
+		fi
+	done
+	for old in `host_certificates`; do
+		if [ "$old" != "$nickname" ]; then
+			certutil -F -d sql:/etc/ipsec.d -n "$old" > /dev/null 2>&1
+		fi
+	done
+
+	ipsec_sas > ./sas.after
+	before=`wc -l < ./sas.before`
+	after=`wc -l < ./sas.after`
+	disrupted=`comm -23 ./sas.before ./sas.after | wc -l`
+	rm ./sas.before ./sas.after
+	rotationReport="{\"mode\":\"$mode\",\"nickname\":\"$nickname\",\"sasBefore\":$before,\"sasAfter\":$after,\"disrupted\":$disrupted}"
+	echo "certificate $nickname rotated ($mode), $disrupted of $before SAs disrupted"
+}
+
+# downloads the policy groups and oe-cert.conf, from the bootstrap bundle if there is one
+download_policies () {
+	if [ -n "$bundleUrl" ]; then
+		install_bundle
+		return
+	fi
+	for f in private private-or-clear clear-or-private clear oe-cert.conf; do
+		cached_cp "config/$f" $f || { echo "Error: Failed to download configs from s3://$configBucket file: $f"; exit 4; }
+	done
+}
+
+# updates the policy groups and oe-cert.conf of a running IPSec in place: only the files that differ from
+# the installed ones are replaced (atomically), the groups are reread and, if oe-cert.conf changed, only
+# the connections defined differently are added again, which replaces them and deletes their SAs.
+# Established SAs of unchanged policies and connections are kept. The leftcert of a hot rotation is kept
+# in oe-cert.conf. If the reload fails, IPSec is restarted
+push_policies () {
+
+	if [ ! -f /etc/ipsec.d/oe-cert.conf ] || ! ipsec whack --status > /dev/null 2>&1; then
+		echo "Error: IPSec is not set up on this instance, run the setup first"
+		exit 15
+	fi
+
+	step download
+	download_policies
+
+	step policies
+	leftcert=`sed -n 's/^[[:space:]]*leftcert=//p' /etc/ipsec.d/oe-cert.conf | head -1`
+	if [ -n "$leftcert" ]; then
+		sed "s/^\([[:space:]]*leftcert=\).*/\1$leftcert/" oe-cert.conf > oe-cert.conf.host
+	else
+		cp oe-cert.conf oe-cert.conf.host
+	fi
+	cp /etc/ipsec.d/oe-cert.conf ./oe-cert.conf.installed
+	changed=''
+	for f in private private-or-clear clear-or-private clear oe-cert.conf; do
+		src=$f
+		dst=/etc/ipsec.d/policies/$f
+		if [ "$f" == "oe-cert.conf" ]; then
+			src=oe-cert.conf.host
+			dst=/etc/ipsec.d/oe-cert.conf
+		fi
+		if ! cmp -s $src $dst; then
+			sudo cp $src $dst.new && sudo mv $dst.new $dst
+			if [ $? -ne 0 ]; then
+				echo "Error: Failed to copy localy file: $f"
+				exit 6
+			fi
+			changed="$changed${changed:+,}\"$f\""
+		fi
+	done
+	rm oe-cert.conf.host
+
+	mode=none
+	before=0
+	after=0
+	disrupted=0
+	if [ -n "$changed" ]; then
+		step reload
+		ipsec_sas > ./sas.before
+		mode=reread
+		{ ! echo "$changed" | grep -q oe-cert.conf || {
+			ipsec auto --rereadall > /dev/null && \
+			changed_conns ./oe-cert.conf.installed /etc/ipsec.d/oe-cert.conf | while read conn auto; do
+				ipsec auto --add $conn > /dev/null && { [ "$auto" != "ondemand" ] && [ "$auto" != "route" ] || ipsec auto --route $conn > /dev/null; } || exit 1
+			done; }; } && \
+		ipsec auto --rereadgroups > /dev/null
+		if [ $? -ne 0 ]; then
+			echo "policy reload failed, restarting IPSec"
+			mode=restart
+			sudo ipsec restart
+			if [ $? -ne 0 ]; then
+				echo "Error: Failed to restart ipsec"
+				exit 7
+			fi
+		fi
+		ipsec_sas > ./sas.after
+		before=`wc -l < ./sas.before`
+		after=`wc -l < ./sas.after`
+		disrupted=`comm -23 ./sas.before ./sas.after | wc -l`
+		rm ./sas.before ./sas.after
+	fi
+	rm ./oe-cert.conf.installed
+	policyReport="{\"mode\":\"$mode\",\"changed\":[$changed],\"sasBefore\":$before,\"sasAfter\":$after,\"disrupted\":$disrupted}"
+	echo "policies updated ($mode): [$changed], $disrupted of $before SAs disrupted"
+}
+
+# checks ./cert.pem: issued by ./ca.pem and, with the request of request_certificate, for its key
+check_signed_certificate () {
+	openssl verify -CAfile ./ca.pem ./cert.pem > /dev/null 2>&1 && \
+	{ [ ! -s ./request.pub ] || openssl x509 -in ./cert.pem -pubkey -noout | cmp -s - ./request.pub; }
+}
+
+# imports ./cert.pem under the nickname $1, its key is in the NSS DB since request_certificate
+import_signed_certificate () {
+	certutil -A -d sql:/etc/ipsec.d -n "$1" -t ",," -a -i ./cert.pem
+}
+
+# checks ./cert.p12 with the password P12PWD, its key matches its certificate, and stages it as
+# ./rotated.p12 under the nickname $1 if pk12util can read it. The key passes through pipes only
+check_pkcs12 () {
+	pub=`openssl pkcs12 -in ./cert.p12 -passin env:P12PWD -nocerts -nodes | openssl pkey -pubout` && \
+	certpub=`openssl pkcs12 -in ./cert.p12 -passin env:P12PWD -clcerts -nokeys | openssl x509 -pubkey -noout` && \
+	[ -n "$pub" ] && [ "$pub" == "$certpub" ] && \
+	openssl pkcs12 -export -name "$1" -inkey <(openssl pkcs12 -in ./cert.p12 -passin env:P12PWD -nocerts -nodes) \
+		-in <(openssl pkcs12 -in ./cert.p12 -passin env:P12PWD -nokeys) -out ./rotated.p12 -passout env:P12PWD && \
+	pk12util -l ./rotated.p12 -W "$P12PWD" > /dev/null
+}
+
+# imports ./rotated.p12 staged by check_pkcs12
+import_pkcs12 () {
+	pk12util -i ./rotated.p12 -d sql:/etc/ipsec.d -W "$P12PWD" > /dev/null
+}
+
+# installs the certificate signed for the key generated by request_certificate, replaces the previous one
+install_signed_certificate () {
+
+	echo $certificate | json_field CERT_CA_PEM_B64 | base64 -i -d > ./ca.pem && \
+	echo $certificate | json_field CERT_PEM_B64 | base64 -i -d > ./cert.pem
+	if [ $? -ne 0 ]; then
+		echo "Error: Failed to extract certifcate from variable"
+		exit 10
+	fi
+
+	if hot_rotation; then
+		certutil -A -d sql:/etc/ipsec.d -n ca -t "CT,," -a -i ./ca.pem
+		if [ $? -ne 0 ]; then
+			echo "Error: Failed to install certifcate"
+			exit 5
+		fi
+		switch_certificate check_signed_certificate import_signed_certificate
+		rm ./ca.pem ./cert.pem
+		return
+	fi
+
+	# deletes the previous certificates and their keys, the new key has no certificate yet
+	for old in `host_certificates`; do
+		while certutil -F -d sql:/etc/ipsec.d -n "$old" > /dev/null 2>&1; do :; done
+	done
+	reset_leftcert
+	certutil -A -d sql:/etc/ipsec.d -n ca -t "CT,," -a -i ./ca.pem && \
+	certutil -A -d sql:/etc/ipsec.d -n hostcert -t ",," -a -i ./cert.pem
+	if [ $? -ne 0 ]; then
+		echo "Error: Failed to install certifcate"
+		exit 5
+	fi
+	rm -f ./ca.pem ./cert.pem ./request.pub
+	echo "certificate installed successful"
+}
 
 install_certificate () {
 
+	step certificate
 	region=`curl --silent http://169.254.169.254/latest/dynamic/instance-identity/document | grep region | cut -f 4 -d '"'`
 
-	echo $certificate | ./jq  .CERT_P12_B64 | base64 -i -d > ./cert.p12
+	# batched commands carry the certificates of all instances of the batch keyed by instance id
+	instance=`curl --silent http://169.254.169.254/latest/meta-data/instance-id`
+	if [ -n "$deliveryUrl" ]; then
+		certificate=`aws s3 cp "$deliveryUrl$instance.json" - --region "$region"`
+		if [ $? -ne 0 ] || [ -z "$certificate" ]; then
+			echo "Error: Failed to fetch the certificate from $deliveryUrl"
+			exit 13
+		fi
+	fi
+	certificate=`echo $certificate | json_select "$instance"`
+
+	if [ -z "`echo $certificate | json_field CERT_P12_B64`" ]; then
+		install_signed_certificate
+		return
+	fi
+
+	echo $certificate | json_field CERT_P12_B64 | base64 -i -d > ./cert.p12
 	if [ $? -ne 0 ]; then
 		echo "Error: Failed to extract certifcate from variable"
 		exit 10 
 	fi
 
-	echo $certificate | ./jq  .CERT_P12_ENCRYPTED_PWD  |  base64 -i -d > ./tmp
-	password=`aws kms decrypt --ciphertext-blob fileb://tmp --region "$region" | ./jq .Plaintext | base64 -d -i | tr -d '"'`
+	password=`decrypt_password`
 	if [ $? -ne 0 ]; then
 		echo "Error: Failed to decrypt the password"
 		exit 11 
 	fi
 	rm ./tmp
+
+	if hot_rotation; then
+		export P12PWD="$password"
+		switch_certificate check_pkcs12 import_pkcs12
+		return
+	fi
+
         rm /etc/ipsec.d/*db || echo ok
+	reset_leftcert
 
     	ipsec initnss
 
@@ -56,51 +513,80 @@ install_certificate () {
 
 
 # config and files will be stored in folder /root/ipsec 
+step prepare
 cd /root
 mkdir ipsec || echo "ignorre"  
 cd ipsec
 
 
+if [ "$policyOnly" == "true" ]; then
+	push_policies
+	exit 0
+fi
+
+if [ "$csrRequest" == "true" ]; then
+	if [ $certificate_only != "true" ]; then
+		# certutil and the NSS DB come with libreswan, the setup run installs the rest
+		step packages
+		rpm -q libreswan > /dev/null || sudo yum -y install libreswan
+		if [ $? -ne 0 ]; then
+			echo "Error: (Libreswan) can not be installed"
+			exit 2
+		fi
+	fi
+	request_certificate
+	exit 0
+fi
+
 if [ $certificate_only == "true" ]; then
 	install_certificate
 	#sudo ipsec restart
 	exit 0
 fi 
 
-pip --version || curl https://bootstrap.pypa.io/get-pip.py -o get-pip.py && sudo python get-pip.py
-curl https://stedolan.github.io/jq/download/linux64/jq > jq && chmod 755 jq 
-aws --version || sudo pip install boto3 awscli 
+# pip and awscli are installed from the internet only if the AMI does not have the awscli
+step awscli
+aws --version || { pip --version || { curl https://bootstrap.pypa.io/get-pip.py -o get-pip.py && sudo python get-pip.py; } ; sudo pip install boto3 awscli; } 
 if [ $? -ne 0 ]; then 
 	echo "Error: (PIP, boto3 or awscli) can not be installed"
 	exit 1
 fi 
 
+step packages
 sudo yum -y install libreswan curl
 if [ $? -ne 0 ]; then 
 	echo "Error: (Libreswan or curl) can not be installed"
 	exit 2
 fi
 
-# download ipsec policies
-aws s3 cp "s3://$configBucket/config/private" . && \
-aws s3 cp "s3://$configBucket/config/private-or-clear" . && \
-aws s3 cp "s3://$configBucket/config/clear-or-private" . && \
-aws s3 cp "s3://$configBucket/config/clear" . && \
-aws s3 cp "s3://$configBucket/config/oe-cert.conf" . && \
+step download
+if [ -n "$bundleUrl" ]; then
+	install_bundle
+else
+
+# download ipsec policies, the ones not changed since the previous setup are kept
+cached_cp config/private private && \
+cached_cp config/private-or-clear private-or-clear && \
+cached_cp config/clear-or-private clear-or-private && \
+cached_cp config/clear clear && \
+cached_cp config/oe-cert.conf oe-cert.conf
 if [ $? -ne 0 ]; then
 	echo "Error: Failed to download configs from s3://$configBucket files: oe-cert.conf, private, clear "
 	exit 4
 fi
 
 # download the ipsec statistics
-aws s3 cp "s3://$configBucket/sources/cronIPSecStats.sh" . && \
-aws s3 cp "s3://$configBucket/sources/cron.txt" .
+cached_cp sources/ipsec_stats_agent.py ipsec_stats_agent.py && \
+cached_cp sources/cron.txt cron.txt
 if [ $? -ne 0 ]; then
-	echo "Error: Failed to download IPSec stats scripts from s3://$configBucket files: cronIPSecStats.sh and cron.txt "
+	echo "Error: Failed to download IPSec stats scripts from s3://$configBucket files: ipsec_stats_agent.py and cron.txt "
 	exit 9
 fi
 
+fi
+
 # copy policy to ipsec folder
+step policies
 sudo cp private /etc/ipsec.d/policies/private && \
 sudo cp private-or-clear /etc/ipsec.d/policies/private-or-clear && \
 sudo cp clear-or-private /etc/ipsec.d/policies/clear-or-private && \
@@ -113,17 +599,22 @@ fi
 
 # enroll certificate 
 install_certificate
+step restart
 sudo ipsec restart
 if [ $? -ne 0 ]; then
 	echo "Error: Failed to restart ipsec"
 	exit 7 
 fi
 
-i=`curl http://169.254.169.254/latest/meta-data/instance-id`
-sed -i.bak "s/INSTANCE/$i/" cronIPSecStats.sh 
-chmod 755 cronIPSecStats.sh
-# install statistics with cronjob
-sudo crontab ./cron.txt
+# install statistics agent with cronjob, a running agent of a previous setup is replaced within a minute
+step agent
+chmod 755 ipsec_stats_agent.py
+cp cron.txt cron.host
+if [ -n "$metricsUrl" ]; then
+	sed "s#ipsec_stats_agent.py #ipsec_stats_agent.py --sink s3 --publish-interval 300 --output $metricsUrl #" cron.txt > cron.host
+fi
+sudo crontab ./cron.host && \
+{ sudo pkill -f ipsec_stats_agent.py || true; }
 if [ $? -ne 0 ]; then
 	echo "Error: Failed to install cron job"
 	exit 8 